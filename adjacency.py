@@ -0,0 +1,395 @@
+import os
+import shutil
+import sys
+
+import numpy as np
+
+from global_vars import ADJACENCY_TAIL_BYTES
+
+COUNT_KEYS = ("followers", "friends")
+HEAD_FNAME = "head"
+TAIL_FNAME = "tail.npy"
+
+
+def csr_dirname(fname_base):
+    return fname_base + ".csr"
+
+
+def generation_dirname(fname_base):
+    """
+    The directory holding the current arrays: the generation named in
+    the head file, or the store directory itself for stores written
+    before there were generations.
+    """
+    dirname = csr_dirname(fname_base)
+    try:
+        with open(os.path.join(dirname, HEAD_FNAME)) as head_file:
+            return os.path.join(dirname, head_file.read().strip())
+    except FileNotFoundError:
+        return dirname
+
+
+def new_generation(fname_base):
+    dirname = os.path.join(csr_dirname(fname_base), "g" + os.urandom(8).hex())
+    os.makedirs(dirname)
+    return dirname
+
+
+def swap_generation(fname_base, gen_dirname):
+    """
+    Make the complete arrays in `gen_dirname` the current ones with a
+    single rename of the head file, then remove every other generation.
+    """
+    dirname = csr_dirname(fname_base)
+    head = os.path.join(dirname, HEAD_FNAME)
+    with open(head + ".tmp", "w") as head_file:
+        head_file.write(os.path.basename(gen_dirname))
+    os.replace(head + ".tmp", head)
+    for entry in os.scandir(dirname):
+        if entry.name in (HEAD_FNAME, os.path.basename(gen_dirname)):
+            continue
+        if entry.is_dir():
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            os.remove(entry.path)
+
+
+def _read_tail(path):
+    """
+    The record arrays appended to a tail file, and the bytes they take
+    up; a record cut short by a crash is dropped.
+    """
+    records = []
+    good_bytes = 0
+    try:
+        with open(path, "rb") as tail_file:
+            while True:
+                try:
+                    records.append(np.load(tail_file))
+                except (EOFError, ValueError):
+                    break
+                good_bytes = tail_file.tell()
+    except FileNotFoundError:
+        pass
+    return records, good_bytes
+
+
+def _concatenate(records):
+    if not records:
+        return np.zeros((0, 3), dtype=np.int64)
+    return np.concatenate(records)
+
+
+def _kept_after_cuts(src_ids, seqs, cuts, cut_seqs):
+    """
+    Mask of the list entries, owned by `src_ids` and added by the record
+    at `seqs` (-1 for those already in the arrays), that are left after
+    each (owner id, length) in `cuts`, the records at `cut_seqs`, cuts
+    its owner's list back to that length.
+    """
+    keep = np.ones(len(src_ids), dtype=bool)
+    # each owner's entries in one run, in the order they were added
+    order = np.argsort(src_ids, kind="stable")
+    sorted_ids = src_ids[order]
+    for (user_id, length), seq in zip(cuts.tolist(), cut_seqs.tolist()):
+        start = np.searchsorted(sorted_ids, user_id, side="left")
+        stop = np.searchsorted(sorted_ids, user_id, side="right")
+        entries = order[start:stop]
+        entries = entries[(seqs[entries] < seq) & keep[entries]]
+        keep[entries[length:]] = False
+    return keep
+
+
+class AdjacencyStore:
+    """
+    Compressed-sparse-row store of friend/follower lists.
+
+    Every user id seen (seed users and their neighbors) gets a dense index
+    into the sorted `nodes` array.  For each key in COUNT_KEYS, the
+    neighbors of the node at index i are
+    `nodes[neighbors[key][offsets[key][i]:offsets[key][i + 1]]]`.
+    The arrays are saved as .npy files in a generation directory under
+    csr_dirname() and memory-mapped on load.
+
+    New lists are added with add(), and lists cut back with truncate().
+    save() appends both to the generation's tail file, as (key index,
+    user id, other id) and (len(COUNT_KEYS) + key index, user id,
+    length) records, so a checkpoint only writes what is new; they are
+    merged into the arrays, in order, in memory the first time the
+    arrays are read, and on disk by compact() once the tail passes
+    ADJACENCY_TAIL_BYTES.
+    """
+
+    def __init__(self, fname_base, nodes=None, offsets=None, neighbors=None):
+        self.fname_base = fname_base
+        self._nodes = np.zeros(0, dtype=np.int64) if nodes is None else nodes
+        empty_offsets = np.zeros(len(self._nodes) + 1, dtype=np.int64)
+        empty_neighbors = np.zeros(0, dtype=np.int32)
+        self._offsets = offsets or {key: empty_offsets for key in COUNT_KEYS}
+        self._neighbors = neighbors or {key: empty_neighbors for key in COUNT_KEYS}
+        # the generation directory the tail is appended to, None until
+        # the store is first written
+        self.dirname = None
+        self.tail_bytes = 0
+        self.unmerged = []
+        self.pending = []
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __bool__(self):
+        return len(self.nodes) > 0
+
+    @property
+    def nodes(self):
+        self._merge_tail()
+        return self._nodes
+
+    @property
+    def offsets(self):
+        self._merge_tail()
+        return self._offsets
+
+    @property
+    def neighbors(self):
+        self._merge_tail()
+        return self._neighbors
+
+    @classmethod
+    def load(cls, fname_base, mmap=True):
+        dirname = generation_dirname(fname_base)
+        mmap_mode = "r" if mmap else None
+        try:
+            nodes = np.load(os.path.join(dirname, "nodes.npy"), mmap_mode=mmap_mode)
+            offsets = {}
+            neighbors = {}
+            for key in COUNT_KEYS:
+                offsets[key] = np.load(
+                    os.path.join(dirname, f"{key}_offsets.npy"), mmap_mode=mmap_mode
+                )
+                neighbors[key] = np.load(
+                    os.path.join(dirname, f"{key}_neighbors.npy"), mmap_mode=mmap_mode
+                )
+        except FileNotFoundError:
+            print(f"Existing adjacency not found at {dirname}, reinitializing...")
+            return cls(fname_base)
+        store = cls(fname_base, nodes, offsets, neighbors)
+        store.dirname = dirname
+        store.unmerged, store.tail_bytes = _read_tail(os.path.join(dirname, TAIL_FNAME))
+        return store
+
+    @classmethod
+    def from_user_dict(cls, user_dict, fname_base):
+        store = cls(fname_base)
+        for user_id, info in user_dict.items():
+            for key in COUNT_KEYS:
+                others = info.get(key)
+                if others:
+                    store.add(user_id, key, others)
+        return store
+
+    def add(self, user_id, key, ids):
+        """
+        Queue `ids` to be appended to `user_id`'s `key` list on save().
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        records = np.empty((len(ids), 3), dtype=np.int64)
+        records[:, 0] = COUNT_KEYS.index(key)
+        records[:, 1] = int(user_id)
+        records[:, 2] = ids
+        self.pending.append(records)
+
+    def truncate(self, user_id, key, length):
+        """
+        Queue cutting `user_id`'s `key` list back to its first `length`
+        ids, after everything queued before it, on save().
+        """
+        record = [len(COUNT_KEYS) + COUNT_KEYS.index(key), int(user_id), length]
+        self.pending.append(np.array([record], dtype=np.int64))
+
+    def has_pending(self):
+        return bool(self.pending)
+
+    def index_of(self, user_ids):
+        """
+        Dense indices for an array of user ids, -1 where the id is unknown.
+        """
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        idx = np.searchsorted(self.nodes, user_ids)
+        idx = np.minimum(idx, max(len(self.nodes) - 1, 0))
+        found = len(self.nodes) > 0
+        if found:
+            found = self.nodes[idx] == user_ids
+        return np.where(found, idx, -1)
+
+    def degrees(self, key):
+        return np.diff(self.offsets[key])
+
+    def degrees_of(self, user_ids, key):
+        idx = self.index_of(user_ids)
+        degrees = self.degrees(key)
+        if len(degrees) == 0:
+            return np.zeros(len(idx), dtype=np.int64)
+        return np.where(idx >= 0, degrees[np.maximum(idx, 0)], 0)
+
+    def neighbor_indices(self, user_id, key):
+        idx = self.index_of([int(user_id)])[0]
+        if idx < 0:
+            return np.zeros(0, dtype=np.int32)
+        offsets = self.offsets[key]
+        return self.neighbors[key][offsets[idx] : offsets[idx + 1]]
+
+    def neighbors_of(self, user_id, key):
+        return self.nodes[self.neighbor_indices(user_id, key)]
+
+    def edge_indices(self, key, rows=None):
+        """
+        (source, neighbor) dense index arrays for every stored pair, or
+        only for the pairs of the nodes at indices `rows`.
+        """
+        degrees = self.degrees(key)
+        if rows is None:
+            srcs = np.repeat(np.arange(len(degrees), dtype=np.int32), degrees)
+            return srcs, np.asarray(self.neighbors[key])
+        rows = np.asarray(rows, dtype=np.int64)
+        counts = degrees[rows]
+        starts = self.offsets[key][rows] - (np.cumsum(counts) - counts)
+        positions = np.repeat(starts, counts) + np.arange(counts.sum(), dtype=np.int64)
+        srcs = np.repeat(rows, counts).astype(np.int32)
+        return srcs, np.asarray(self.neighbors[key][positions])
+
+    def checksums(self, key, rows):
+        """
+        A checksum of the `key` list of each node at the indices `rows`
+        that changes whenever its set of ids does, for noticing lists
+        that were cut and fetched again to the same length.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        _, others = self.edge_indices(key, rows)
+        ids = np.asarray(self.nodes)[others].astype(np.uint64)
+        # spread the bits of nearby ids before summing; sums wrap
+        mixed = ids * np.uint64(0x9E3779B97F4A7C15)
+        mixed ^= mixed >> np.uint64(29)
+        counts = self.degrees(key)[rows]
+        starts = np.cumsum(counts) - counts
+        nonempty = counts > 0
+        sums = np.zeros(len(rows), dtype=np.uint64)
+        if nonempty.any():
+            sums[nonempty] = np.add.reduceat(mixed, starts[nonempty])
+        return sums
+
+    def seed_ids(self):
+        """
+        Ids of users that have at least one stored friend or follower.
+        """
+        has_list = np.zeros(len(self.nodes), dtype=bool)
+        for key in COUNT_KEYS:
+            has_list |= self.degrees(key) > 0
+        return self.nodes[has_list]
+
+    def _merged(self, records):
+        """
+        The arrays with `records` (see the class docstring) applied in
+        order, or None if there are too many users.
+        """
+        pairs = {}
+        id_arrays = [self._nodes]
+        for k, key in enumerate(COUNT_KEYS):
+            degrees = np.diff(self._offsets[key])
+            added = np.flatnonzero(records[:, 0] == k)
+            src_ids = np.repeat(self._nodes, degrees)
+            src_ids = np.concatenate([src_ids, records[added, 1]])
+            dst_ids = self._nodes[self._neighbors[key]]
+            dst_ids = np.concatenate([dst_ids, records[added, 2]])
+            cuts = np.flatnonzero(records[:, 0] == len(COUNT_KEYS) + k)
+            if len(cuts):
+                seqs = np.full(len(src_ids), -1, dtype=np.int64)
+                seqs[len(src_ids) - len(added) :] = added
+                keep = _kept_after_cuts(src_ids, seqs, records[cuts, 1:], cuts)
+                src_ids, dst_ids = src_ids[keep], dst_ids[keep]
+            pairs[key] = (src_ids, dst_ids)
+            id_arrays.extend(pairs[key])
+        nodes = np.unique(np.concatenate(id_arrays))
+        if len(nodes) > np.iinfo(np.int32).max:
+            sys.stderr.write("ERROR: too many users for an int32 node index\n")
+            return None
+
+        offsets = {}
+        neighbors = {}
+        for key in COUNT_KEYS:
+            src_ids, dst_ids = pairs[key]
+            src_idx = np.searchsorted(nodes, src_ids)
+            order = np.argsort(src_idx, kind="stable")
+            neighbors[key] = np.searchsorted(nodes, dst_ids[order]).astype(np.int32)
+            counts = np.bincount(src_idx, minlength=len(nodes))
+            offsets[key] = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        return nodes, offsets, neighbors
+
+    def _merge_tail(self):
+        if not self.unmerged:
+            return
+        merged = self._merged(_concatenate(self.unmerged))
+        if merged is not None:
+            self._nodes, self._offsets, self._neighbors = merged
+            self.unmerged = []
+
+    def save(self):
+        """
+        Append the pending lists to the tail file, or compact() once the
+        tail would pass ADJACENCY_TAIL_BYTES (or there is no store yet).
+        """
+        records = _concatenate(self.pending)
+        if self.dirname is None:
+            return self.compact()
+        if self.tail_bytes + records.nbytes > ADJACENCY_TAIL_BYTES:
+            return self.compact()
+        if not len(records):
+            return True
+        path = os.path.join(self.dirname, TAIL_FNAME)
+        try:
+            with open(path, "ab") as tail_file:
+                # drop whatever a crash left of a record past the last one
+                tail_file.truncate(self.tail_bytes)
+                np.save(tail_file, records)
+                self.tail_bytes = tail_file.tell()
+        except OSError:
+            sys.stderr.write(f"ERROR: {path} is not writeable!\n")
+            return False
+        self.unmerged.append(records)
+        self.pending = []
+        return True
+
+    def compact(self):
+        """
+        Merge the tail and the pending lists into the arrays and write
+        them to a new generation directory, swapped in for the current
+        one with swap_generation().
+        """
+        merged = self._merged(_concatenate(self.unmerged + self.pending))
+        if merged is None:
+            return False
+        nodes, offsets, neighbors = merged
+
+        store_dirname = csr_dirname(self.fname_base)
+        print(f"Saving adjacency of {len(nodes)} users to {store_dirname}")
+        try:
+            dirname = new_generation(self.fname_base)
+            arrays = {"nodes": nodes}
+            for key in COUNT_KEYS:
+                arrays[f"{key}_offsets"] = offsets[key]
+                arrays[f"{key}_neighbors"] = neighbors[key]
+            for name, array in arrays.items():
+                np.save(os.path.join(dirname, f"{name}.npy"), array)
+            swap_generation(self.fname_base, dirname)
+        except OSError:
+            sys.stderr.write(f"ERROR: {store_dirname} is not writeable!\n")
+            return False
+
+        self._nodes = nodes
+        self._offsets = offsets
+        self._neighbors = neighbors
+        self.dirname = dirname
+        self.tail_bytes = 0
+        self.unmerged = []
+        self.pending = []
+        return True
@@ -1,29 +1,71 @@
-import random
 import sys
 from enum import Enum, unique
-from statistics import mean, stdev
 
-import matplotlib.pyplot as plt
 import networkx as nx
 import numpy as np
-import pandas as pd
-import ujson
-from networkx.drawing.nx_agraph import to_agraph
 
-from global_vars import (NO_DATA_EXIT_CODE, RNG_FNAME, TWEETS_FNAME,
-                         USER_DICT_FNAME, USER_FRAME_FNAME, USER_GRAPH_FNAME)
-from utils import json_it, pickle_it, reload_json, reload_object
-
-USER_FRAME = pd.DataFrame(reload_json(USER_DICT_FNAME, dict)).transpose()
-
-friends = USER_FRAME["friends"]
-followers = USER_FRAME["followers"]
-with_friends = USER_FRAME.loc[USER_FRAME["friends"].astype(bool)]
-VALID_USER_FRAME = with_friends.loc[with_friends["followers"].astype(bool)]
-USER_LIST = VALID_USER_FRAME.axes[0]
+from adjacency import COUNT_KEYS
+from centrality import load_centrality
+from columnar import ColumnStore, has_columns
+from context import DataContext, lazy
+from global_vars import (FULL_GRAPH_FNAME, GRAPH_MEMORY_BUDGET,
+                         NO_DATA_EXIT_CODE, RNG_FNAME, USER_DICT_FNAME,
+                         USER_GRAPH_FNAME)
+from graph_store import DEGREE_KINDS, GraphStore, contains_edges, edge_records
+from instrument import STAGE_SECONDS
+from layout import invalidate_layout
+from out_of_core import build_graph_store
+from segment_log import has_log
+from snapshots import SnapshotStore
+from utils import (drop_neighbor_lists, json_it, load_adjacency, pickle_it,
+                   reload_json, reload_object)
+
+
+def load_user_frame():
+    """
+    The users dictionary as a frame, without the friends/followers lists.
+    A column store is read column by column and never touches the lists.
+    """
+    import pandas as pd
+
+    if has_columns(USER_DICT_FNAME) and not has_log(USER_DICT_FNAME):
+        store = ColumnStore(USER_DICT_FNAME)
+        return store.to_frame([c for c in store.columns if c not in COUNT_KEYS])
+    return pd.DataFrame(
+        reload_json(USER_DICT_FNAME, dict, transform=drop_neighbor_lists)
+    ).transpose()
+
+
+class AnalyzeData(DataContext):
+    @lazy
+    def adjacency(self):
+        return load_adjacency()
+
+    @lazy
+    def user_frame(self):
+        frame = load_user_frame()
+        # friends/followers hold the number of stored ids; the ids
+        # themselves live in the adjacency store
+        for key in ("friends", "followers"):
+            frame[key] = self.adjacency.degrees_of(frame.index.astype(np.int64), key)
+        return frame
+
+    @lazy
+    def valid_user_frame(self):
+        frame = self.user_frame
+        with_friends = frame.loc[frame["friends"].astype(bool)]
+        return with_friends.loc[with_friends["followers"].astype(bool)]
+
+    @lazy
+    def user_list(self):
+        return self.valid_user_frame.axes[0]
+
+
+DATA = AnalyzeData()
 
 STDEV_MOD = 1
 OTHERS_MOD = 0.001
+MISMATCH_REPORT_LIMIT = 20
 
 
 @unique
@@ -43,6 +85,15 @@ class Direct(Enum):
         elif self.name == "OUT":
             return graph.out_degree
 
+    def deg_column(self):
+        """
+        Column of an (n, 2) edge array whose counts give this degree.
+        """
+        if self.name == "IN":
+            return 1
+        elif self.name == "OUT":
+            return 0
+
     def make_edge(self, user, other):
         if self.name == "IN":
             return (other, user)
@@ -50,123 +101,358 @@ class Direct(Enum):
             return (user, other)
 
 
-def get_expected_connection_bounds(graph, user_id, direct=Direct.IN):
-    try:
-        num = direct.deg_view(graph)[user_id]
-    except KeyError:
-        num = 0
-
-    try:
-        expected = len((VALID_USER_FRAME.loc[user_id])[direct.twit_key()])
-    except TypeError:
-        sys.stderr.write(f"Unexpected type for {direct.twit_key()} list on {user_id}")
-        expected = 0
-    return num, expected
+def build_edge_array(user_ids=None):
+    """
+    Every edge implied by the friends/followers lists of `user_ids`
+    (by default all valid users), as an (n, 2) array of (source, target)
+    adjacency indices, deduplicated.
+    """
+    adjacency = DATA.adjacency
+    num_nodes = len(adjacency)
+    if user_ids is None:
+        user_ids = DATA.user_list.astype(np.int64)
+    user_idx = adjacency.index_of(user_ids)
+    user_idx = user_idx[user_idx >= 0]
+
+    edge_keys = []
+    for direct in (Direct.IN, Direct.OUT):
+        users, others = adjacency.edge_indices(direct.twit_key(), user_idx)
+        source, target = direct.make_edge(
+            users.astype(np.int64), others.astype(np.int64)
+        )
+        edge_keys.append(source * num_nodes + target)
+    edge_keys = np.unique(np.concatenate(edge_keys))
+    return np.stack((edge_keys // num_nodes, edge_keys % num_nodes), axis=1)
+
+
+def implied_edges(edges, user_ids):
+    """
+    Mask of the `edges` (records of source and target ids) that the
+    lists of `user_ids` imply: the friends list of the source or the
+    followers list of the target has the other end.
+    """
+    adjacency = DATA.adjacency
+    implied = np.zeros(len(edges), dtype=bool)
+    for direct in (Direct.IN, Direct.OUT):
+        if direct is Direct.IN:
+            owners, others = edges["target"], edges["source"]
+        else:
+            owners, others = edges["source"], edges["target"]
+        candidates = np.isin(owners, user_ids)
+        rows = adjacency.index_of(np.unique(owners[candidates]))
+        users, neighbors = adjacency.edge_indices(direct.twit_key(), rows[rows >= 0])
+        listed = np.unique(
+            edge_records(adjacency.nodes[users], adjacency.nodes[neighbors])
+        )
+        pairs = edge_records(owners[candidates], others[candidates])
+        implied[candidates] |= contains_edges(listed, pairs)
+    return implied
+
+
+def report_mismatches(edges, user_ids=None):
+    """
+    Compare, for every user in `user_ids` (by default all valid users),
+    the number of distinct neighbors that made it into the edge array
+    with the length of the stored list, and print the users where they
+    differ.
+    """
+    adjacency = DATA.adjacency
+    if user_ids is None:
+        user_ids = DATA.user_list.astype(np.int64)
+    user_idx = adjacency.index_of(user_ids)
+    user_idx = user_idx[user_idx >= 0]
+    num_nodes = len(adjacency)
+    for direct in (Direct.IN, Direct.OUT):
+        users, others = adjacency.edge_indices(direct.twit_key(), user_idx)
+        pairs = np.unique(users.astype(np.int64) * num_nodes + others)
+        num = np.bincount(pairs // num_nodes, minlength=num_nodes)[user_idx]
+        expected = adjacency.degrees(direct.twit_key())[user_idx]
+        degree = np.bincount(edges[:, direct.deg_column()], minlength=num_nodes)
+        degree = degree[user_idx]
+        mismatched = np.flatnonzero(num != expected)
+        print(
+            f"{len(mismatched)} of {len(user_idx)} users have duplicate "
+            f"{direct.twit_key()} ({direct}); mean degree {degree.mean():.1f}"
+        )
+        for i in mismatched[:MISMATCH_REPORT_LIMIT]:
+            user_id = adjacency.nodes[user_idx[i]]
+            print(
+                f"{direct.twit_key()} mismatch for node {user_id}: {num[i]}, {expected[i]}, {direct}"
+            )
 
 
-def build_graph(pickle=False, from_scratch=True):
-    user_graph = nx.DiGraph()
-    if not from_scratch:
+@STAGE_SECONDS.time(stage="update_graph")
+def update_graph(from_scratch=False, memory_budget=None):
+    """
+    Bring the full graph in FULL_GRAPH_FNAME up to date with the
+    adjacency store.  Only users that are new, or whose lists changed
+    since the graph's watermark, have their edges rebuilt: every edge
+    into or out of them is removed, then their lists' edges, and the
+    removed edges other users' lists still imply, are merged back in.
+    from_scratch starts from an empty graph instead.
+
+    With `memory_budget` (bytes), the adjacency store, if it has to be
+    built, and the graph are built from scratch out of core instead; see
+    out_of_core.py.
+    """
+    if memory_budget is not None:
+        adjacency = load_adjacency(memory_budget=memory_budget)
+        if not adjacency:
+            sys.stderr.write("ERROR:  A user or tweet dictionary is empty.")
+            sys.exit(NO_DATA_EXIT_CODE)
+        return build_graph_store(adjacency, FULL_GRAPH_FNAME, memory_budget)
+    if from_scratch:
+        store = GraphStore(FULL_GRAPH_FNAME)
+    else:
         print("Loading graph data.")
-        user_graph = reload_object(USER_GRAPH_FNAME, nx.DiGraph)
-        if user_graph:
-            return user_graph
-    print("Building graph...")
-    if VALID_USER_FRAME.empty:
+        store = GraphStore.load(FULL_GRAPH_FNAME)
+    if DATA.valid_user_frame.empty:
         sys.stderr.write("ERROR:  A user or tweet dictionary is empty.")
         sys.exit(NO_DATA_EXIT_CODE)
 
-    for i, user_id in enumerate(USER_LIST):
-        new_edges = {Direct.IN: [], Direct.OUT: []}
-        for direct in (Direct.IN, Direct.OUT):
-            num, expected = get_expected_connection_bounds(
-                user_graph, user_id, direct=direct
-            )
-            if num == 0:
-                others = (VALID_USER_FRAME.loc[user_id])[direct.twit_key()]
-                for ident in others:
-                    edge = direct.make_edge(int(user_id), int(ident))
-                    new_edges[direct].append(edge)
-            elif num != expected:
-                print(
-                    f"followers mismatch for node {user_id}: {num}, {expected}, {direct}"
-                )
-                print("Skipping")
-                print()
-        new_in = new_edges[Direct.IN]
-        new_out = new_edges[Direct.OUT]
-        if len(new_in) != 0 or len(new_out) != 0:
-            user_graph.add_edges_from(new_in)
-            user_graph.add_edges_from(new_out)
-
-        if (i + 1) % 100 == 0:
-            print(f"Analyzed %d users" % (i + 1))
-    if pickle:
-        pickle_it(user_graph, FULL_GRAPH_FNAME)
-    return user_graph
-
-
+    adjacency = DATA.adjacency
+    user_idx = adjacency.index_of(DATA.user_list.astype(np.int64))
+    user_idx = user_idx[user_idx >= 0]
+    user_ids = adjacency.nodes[user_idx]
+    list_degrees = {key: adjacency.degrees(key)[user_idx] for key in COUNT_KEYS}
+    list_sums = {key: adjacency.checksums(key, user_idx) for key in COUNT_KEYS}
+    stale = store.stale_users(user_ids, list_degrees, list_sums)
+    print(f"Building graph for {stale.sum()} of {len(user_ids)} users...")
+
+    removed = store.remove_edges(store.touching(user_ids[stale]))
+    edges = build_edge_array(user_ids[stale])
+    report_mismatches(edges, user_ids[stale])
+    added = store.add_edges(adjacency.nodes[edges[:, 0]], adjacency.nodes[edges[:, 1]])
+    kept = removed[implied_edges(removed, user_ids[~stale])]
+    added += store.add_edges(kept["source"], kept["target"])
+    stale_degrees = {key: lists[stale] for key, lists in list_degrees.items()}
+    stale_sums = {key: sums[stale] for key, sums in list_sums.items()}
+    store.mark(user_ids[stale], stale_degrees, stale_sums)
+    print(
+        f"Removed {len(removed)} and added {added} edges, "
+        f"{len(store.edges)} in the full graph"
+    )
+    return store
+
+
+def snapshot_graph(seq=None):
+    """
+    The full graph as of follower snapshot `seq` (by default the latest),
+    built from the users with both lists non-empty in that snapshot.
+    It is saved, if at all, next to FULL_GRAPH_FNAME rather than over it.
+    """
+    snapshots = SnapshotStore()
+    lists = snapshots.lists(seq)
+    if seq is None:
+        seq = snapshots.snapshots()[-1][0]
+    users = np.intersect1d(lists["followers"][0], lists["friends"][0])
+    print(f"Building graph for {len(users)} users as of snapshot {seq}...")
+
+    store = GraphStore(f"{FULL_GRAPH_FNAME}_{seq}")
+    for direct in (Direct.IN, Direct.OUT):
+        owners, others = lists[direct.twit_key()]
+        included = np.isin(owners, users)
+        store.add_edges(*direct.make_edge(owners[included], others[included]))
+    print(f"{len(store.edges)} edges in the graph as of snapshot {seq}")
+    return store
+
+
+@STAGE_SECONDS.time(stage="build_graph")
+def build_graph(pickle=False, from_scratch=True, snapshot=None, memory_budget=None):
+    """
+    The full graph as a DiGraph; with `snapshot`, the graph as of that
+    follower snapshot instead (see snapshots.py).  `memory_budget` is
+    passed on to update_graph.  The full graph is always saved, since
+    load_centrality() reads it from FULL_GRAPH_FNAME; a snapshot's only
+    with `pickle`.
+    """
+    if snapshot is None:
+        store = update_graph(from_scratch=from_scratch, memory_budget=memory_budget)
+    else:
+        store = snapshot_graph(snapshot)
+    if pickle or snapshot is None:
+        store.save()
+    return store.to_networkx()
+
+
+def graph_arrays(graph):
+    """
+    Node ids of a networkx graph (in the graph's node order), and its
+    edges as an (n, 2) array of (source, target) positions into them.
+    """
+    node_ids = np.fromiter(graph, dtype=np.int64, count=len(graph))
+    order = np.argsort(node_ids)
+    edge_ids = np.array(graph.edges(), dtype=np.int64).reshape(-1, 2)
+    edges = order[np.searchsorted(node_ids, edge_ids, sorter=order)]
+    return node_ids, edges
+
+
+def significant_nodes(edges, num_nodes):
+    """
+    Mask of the nodes whose in- or out-degree is more than STDEV_MOD
+    standard deviations away from the mean.
+    """
+    significant = np.zeros(num_nodes, dtype=bool)
+    for direct in (Direct.IN, Direct.OUT):
+        degrees = np.bincount(edges[:, direct.deg_column()], minlength=num_nodes)
+        sample_mean = degrees.mean()
+        pop_stdev = degrees.std(ddof=1)
+        significant |= np.abs(degrees - sample_mean) > STDEV_MOD * pop_stdev
+    return significant
+
+
+def sample_edges(edges, num_nodes, significant, rng, reduce_sample=True):
+    """
+    Positions in `edges` of a sample of OTHERS_MOD of each significant
+    node's out-edges, drawn without replacement for all nodes at once:
+    every candidate edge gets a random key, and each source keeps the
+    edges with its smallest keys.
+    """
+    out_degree = np.bincount(edges[:, 0], minlength=num_nodes)
+    quota = out_degree
+    if reduce_sample:
+        quota = (out_degree * OTHERS_MOD).astype(np.int64)
+    quota[~significant] = 0
+
+    candidates = np.flatnonzero(quota[edges[:, 0]] > 0)
+    sources = edges[candidates, 0]
+    order = np.lexsort((rng.random(len(candidates)), sources))
+    sources = sources[order]
+    rank = np.arange(len(sources)) - np.searchsorted(sources, sources)
+    return candidates[order[rank < quota[sources]]]
+
+
+def sample_neighbors(edges, num_nodes, significant, rng, reduce_sample=True):
+    """
+    Mask of the significant nodes plus a sample of OTHERS_MOD of each
+    one's successors; see sample_edges.
+    """
+    chosen = sample_edges(edges, num_nodes, significant, rng, reduce_sample)
+    keep = np.zeros(num_nodes, dtype=bool)
+    keep[edges[chosen, 0]] = True
+    keep[edges[chosen, 1]] = True
+    return keep
+
+
+def load_rng():
+    rng_state = reload_object(RNG_FNAME, lambda: np.random.PCG64().state)
+    if not isinstance(rng_state, dict):
+        print(f"Discarding old random state in {RNG_FNAME}")
+        rng_state = np.random.PCG64().state
+    rng = np.random.Generator(np.random.PCG64())
+    rng.bit_generator.state = rng_state
+    return rng, rng_state
+
+
+@STAGE_SECONDS.time(stage="trim_graph")
 def trim_graph(graph, reduce_sample=True, pickle=True, from_scratch=True):
     if not graph and not from_scratch:
         graph = reload_json(USER_GRAPH_FNAME, transform=nx.node_link_graph)
         return graph
 
-    rng_state = reload_object(RNG_FNAME, random.getstate)
-    random.setstate(rng_state)
+    rng, rng_state = load_rng()
     print("Trimming graph...")
-    significant_id_set = set()
+    node_ids, edges = graph_arrays(graph)
+    num_nodes = len(node_ids)
 
-    for direct in (Direct.IN, Direct.OUT):
-        sample = []
-        ids = []
-        for user_id in graph:
-            ids.append(user_id)
-            num_neighb = direct.deg_view(graph)[user_id]
-            sample.append(num_neighb)
-        sample_mean = mean(sample)
-        pop_stdev = stdev(sample)
-        for i, degree in enumerate(sample):
-            if abs(degree - sample_mean) > STDEV_MOD * pop_stdev:
-                user_id = ids[i]
-                significant_id_set.add((user_id, degree))
-
-    by_asc_degree = sorted(list(significant_id_set), key=lambda x: x[1])
-    significant_ids = [i[0] for i in by_asc_degree]
-
-    to_subgraph = set()
-    for user_id in significant_ids:
-        try:
-            others = set(graph.neighbors(user_id))
-        except KeyError:
-            continue
-        if reduce_sample and len(others) != 0:
-            others = random.sample(others, int(len(others) * OTHERS_MOD))
-
-        if len(others) == 0:
-            continue
-
-        to_subgraph.add(user_id)
-        for other in others:
-            to_subgraph.add(other)
+    significant = significant_nodes(edges, num_nodes)
+    keep = sample_neighbors(edges, num_nodes, significant, rng, reduce_sample)
 
     pickle_it(rng_state, RNG_FNAME)
 
-    user_graph = graph.subgraph(to_subgraph)
+    kept_edges = edges[keep[edges[:, 0]] & keep[edges[:, 1]]]
+    user_graph = nx.DiGraph()
+    user_graph.add_nodes_from(node_ids[keep].tolist())
+    user_graph.add_edges_from(
+        zip(node_ids[kept_edges[:, 0]].tolist(), node_ids[kept_edges[:, 1]].tolist())
+    )
 
     if pickle:
-        json_it(user_graph, USER_GRAPH_FNAME, nx.node_link_data)
+        save_trimmed_graph(user_graph)
 
     return user_graph
 
 
+@STAGE_SECONDS.time(stage="update_trimmed")
+def update_trimmed(store, reduce_sample=True, from_scratch=False):
+    """
+    Bring the trimmed subgraph up to date with the full graph in
+    `store`.  Significance is recomputed from the store's running degree
+    statistics, but neighbors are only resampled for nodes whose
+    significance or out-degree changed since the last trim; every other
+    node keeps its previous sample.
+    """
+    rng, rng_state = load_rng()
+    print("Trimming graph...")
+    nodes = store.nodes
+    significant = np.zeros(len(nodes), dtype=bool)
+    for kind in DEGREE_KINDS:
+        mean, stdev = store.degree_stats(kind)
+        significant |= np.abs(store.degrees[kind] - mean) > STDEV_MOD * stdev
+
+    out_degree = store.degrees["out"]
+    dirty = significant.copy()
+    sampled = store.sampled[:0]
+    if not from_scratch:
+        was_significant = np.zeros(len(nodes), dtype=bool)
+        sampled_out = np.zeros(len(nodes), dtype=np.int64)
+        previous = np.searchsorted(nodes, store.significant)
+        was_significant[previous] = True
+        sampled_out[previous] = store.sampled_out
+        dirty = (significant != was_significant) | (
+            significant & (out_degree != sampled_out)
+        )
+        sampled = store.sampled[~np.isin(store.sampled["source"], nodes[dirty])]
+
+    resample = significant & dirty
+    print(f"Resampling {resample.sum()} of {significant.sum()} significant nodes")
+    candidates = store.edges[store.out_edges(nodes[resample])]
+    local_edges = np.stack(
+        (
+            np.searchsorted(nodes, candidates["source"]),
+            np.searchsorted(nodes, candidates["target"]),
+        ),
+        axis=1,
+    )
+    chosen = sample_edges(local_edges, len(nodes), resample, rng, reduce_sample)
+    store.sampled = np.sort(np.concatenate((sampled, candidates[chosen])))
+    store.significant = nodes[significant]
+    store.sampled_out = out_degree[significant]
+    pickle_it(rng_state, RNG_FNAME)
+
+    kept = np.unique(np.concatenate((store.sampled["source"], store.sampled["target"])))
+    positions = store.out_edges(kept)
+    positions = positions[np.isin(store.edges["target"][positions], kept)]
+    return store.to_networkx(kept, positions)
+
+
+def save_trimmed_graph(user_graph):
+    """
+    Write the trimmed graph for the web app and drop the layout computed
+    for the previous one.
+    """
+    invalidate_layout()
+    return json_it(user_graph, USER_GRAPH_FNAME, nx.node_link_data)
+
+
 def main():
-    graph = build_graph(pickle=False, from_scratch=True)
-    small_graph = trim_graph(graph, pickle=False, from_scratch=True)
+    from_scratch = "--from-scratch" in sys.argv[1:]
+    memory_budget = None
+    if "--streaming" in sys.argv[1:]:
+        from_scratch = True
+        memory_budget = GRAPH_MEMORY_BUDGET
+    store = update_graph(from_scratch=from_scratch, memory_budget=memory_budget)
+    small_graph = update_trimmed(store, from_scratch=from_scratch)
+    store.save()
+    if memory_budget is None:
+        # warm the centrality cache for the app; it needs the whole graph
+        # in memory, so --streaming leaves it to the app
+        load_centrality(store)
     small_graph.name = "Twitter User Graph"
-    print(f"full graph: {len(graph)} nodes")
+    print(f"full graph: {len(store)} nodes")
     print(f"trim graph: {len(small_graph)} nodes")
     print("Generating JSON")
-    json_it(small_graph, USER_GRAPH_FNAME, nx.node_link_data)
+    save_trimmed_graph(small_graph)
 
 
 if __name__ == "__main__":
@@ -1,35 +1,49 @@
 import json
 import sys
+import time
 from enum import Enum, auto, unique
 
 import flask
 import networkx as nx
+import numpy as np
 from bokeh.embed import components, json_item
 from bokeh.io import output_file, show
 from bokeh.layouts import column
-from bokeh.models import (BoxSelectTool, Circle, CustomJS, HoverTool,
-                          MultiLine, Plot, Range1d, TapTool, WheelZoomTool)
-from bokeh.models.graphs import (EdgesAndLinkedNodes, NodesAndLinkedEdges,
-                                 from_networkx)
+from bokeh.models import (BoxSelectTool, Circle, ColumnDataSource, CustomJS,
+                          CustomJSTransform, GraphRenderer, HoverTool,
+                          LinearColorMapper, MultiLine, Plot, Range1d,
+                          StaticLayoutProvider, TapTool, WheelZoomTool)
+from bokeh.models.graphs import EdgesAndLinkedNodes, NodesAndLinkedEdges
 from bokeh.models.widgets import RadioButtonGroup
 from bokeh.palettes import GnBu8, Spectral4
 from bokeh.plotting import figure
 from bokeh.resources import CDN, INLINE
-from networkx.drawing.nx_agraph import graphviz_layout
-
-from global_vars import (PLOT_FILE_NAME, TWEETS_FNAME, USER_DICT_FNAME,
-                         USER_GRAPH_FNAME)
-from utils import json_it, pickle_it, reload_json, reload_object
+from bokeh.transform import transform
+
+from centrality import load_centrality
+from columnar import ColumnStore, has_columns, write_columns
+from context import DataContext, lazy
+from global_vars import (LAYOUT_PROG, LOD_NODE_THRESHOLD, PLOT_FILE_NAME,
+                         TILE_CACHE_SIZE, TILE_MAX_ZOOM, TOOLTIP_MAX_AGE,
+                         TOOLTIPS_FNAME, USER_GRAPH_FNAME)
+from instrument import (CONTENT_TYPE, REGISTRY, STAGE_SECONDS, histogram,
+                        profile_report, profiled)
+from layout import cached_layout, graph_version
+from payload_cache import PayloadCache
+from tiles import TileIndex
+from utils import (json_it, load_adjacency, load_tweet_rollups, pickle_it,
+                   reload_json)
 
 app = flask.Flask(__name__)
 app.vars = {}
 
-USER_DICT = None
-TWEET_DICT = None
-NETWORK = None
-GRAPH_DATA = None
 PALETTE = GnBu8
+# bumped whenever graph_data's layout changes, to rebuild cached copies
+GRAPH_DATA_FORMAT = 2
 SOURCE = None
+PAYLOADS = PayloadCache(PLOT_FILE_NAME)
+TILE_PAYLOADS = PayloadCache(max_entries=TILE_CACHE_SIZE)
+REQUEST_SECONDS = histogram("http_request_seconds", "Time spent serving requests")
 
 
 @unique
@@ -38,6 +52,10 @@ class DataSource(Enum):
     TWEETS = auto()
     FRIENDS = auto()
     FOLLOWERS = auto()
+    PAGERANK = auto()
+    HUBS = auto()
+    AUTHORITIES = auto()
+    KCORE = auto()
 
     def to_title(self):
         if self.name == "TWEETS":
@@ -46,6 +64,14 @@ class DataSource(Enum):
             return " by Number of Friends"
         elif self.name == "FOLLOWERS":
             return " by Number of Followers"
+        elif self.name == "PAGERANK":
+            return " by PageRank"
+        elif self.name == "HUBS":
+            return " by Hub Score"
+        elif self.name == "AUTHORITIES":
+            return " by Authority Score"
+        elif self.name == "KCORE":
+            return " by k-Core"
         else:
             return ""
 
@@ -53,80 +79,246 @@ class DataSource(Enum):
         return self.name.lower()
 
 
-def run_tweets():
-    global TWEET_DICT
-    global NETWORK
-    if not TWEET_DICT:
-        TWEET_DICT = reload_object(TWEETS_FNAME, dict)
-    if not NETWORK:
-        NETWORK = reload_json(
-            USER_GRAPH_FNAME, nx.DiGraph, transform=nx.node_link_graph
+# button labels, which the plots' callbacks lowercase into DataSource names
+DATA_LABELS = [
+    "None",
+    "Friends",
+    "Followers",
+    "Tweets",
+    "PageRank",
+    "Hubs",
+    "Authorities",
+    "KCore",
+]
+
+
+class AppData(DataContext):
+    @lazy
+    def adjacency(self):
+        return load_adjacency()
+
+    @lazy
+    def tweet_rollups(self):
+        return load_tweet_rollups()
+
+    @lazy
+    def tweet_counts(self):
+        """
+        Sorted user ids from the tweet rollups and their tweet counts.
+        """
+        rollups = self.tweet_rollups
+        user_ids = np.fromiter(rollups, dtype=np.int64, count=len(rollups))
+        counts = np.fromiter(
+            (rollup["count"] for rollup in rollups.values()),
+            dtype=np.int64,
+            count=len(rollups),
         )
-    tweets = []
-    for node in NETWORK:
-        try:
-            node_tweets = TWEET_DICT[str(node)]
-        except KeyError:
-            node_tweets = []
-        if node_tweets:
-            tweets.append(node_tweets[0]["text"])
-        else:
-            tweets.append("")
-    return tweets
+        order = np.argsort(user_ids)
+        return user_ids[order], counts[order]
 
+    @lazy
+    def centrality(self):
+        return load_centrality()
 
-def run_data(d_source):
-    global USER_DICT
-    global TWEET_DICT
-    global NETWORK
-    if not USER_DICT:
-        USER_DICT = reload_object(USER_DICT_FNAME, dict)
-    if not TWEET_DICT:
-        TWEET_DICT = reload_object(TWEETS_FNAME, dict)
-    if not NETWORK:
-        NETWORK = reload_json(
-            USER_GRAPH_FNAME, nx.DiGraph, transform=nx.node_link_graph
-        )
+    @lazy
+    def network(self):
+        return reload_json(USER_GRAPH_FNAME, nx.DiGraph, transform=nx.node_link_graph)
 
-    values = []
-    for node in NETWORK:
-        try:
-            node_info = USER_DICT[str(node)]
-        except KeyError:
-            # some nodes may not show up in the user dictionary!
-            node_info = {"followers": [], "friends": []}
-
-        if d_source in [DataSource.FRIENDS, DataSource.FOLLOWERS]:
-            values.append(len(node_info[str(d_source)]))
-        elif d_source == DataSource.TWEETS:
-            try:
-                num_tweets = len(TWEET_DICT[str(node)])
-                values.append(num_tweets)
-            except KeyError:
-                values.append(0)
-        else:
-            values.append(1)
+    @lazy
+    def graph_data(self):
+        return construct_graph_data()
+
+    @lazy
+    def tiles(self):
+        from analyze import graph_arrays
+
+        network = self.network
+        positions = cached_layout(network)
+        node_ids, edges = graph_arrays(network)
+        xy = np.array([positions[node] for node in node_ids.tolist()], dtype=np.float64)
+        return TileIndex(xy.reshape(-1, 2), edges, self.graph_data["range"])
+
+    @lazy
+    def node_styles(self):
+        """
+        Every DataSource's palette indices as uint8 arrays, in network
+        order.
+        """
+        return {
+            d_source: np.array(self.graph_data[str(d_source)], dtype=np.uint8)
+            for d_source in DataSource
+        }
+
+    @lazy
+    def tooltips(self):
+        return ColumnStore(TOOLTIPS_FNAME)
+
+
+DATA = AppData()
+
+
+def write_tooltips():
+    """
+    Store each node's first tweet, in network order, for /tooltip to
+    look up by row instead of sending every tweet with the plot.
+    """
+    rollups = DATA.tweet_rollups
+    records = {}
+    for node in DATA.network:
+        rollup = rollups.get(str(node))
+        records[str(node)] = {"desc": rollup["first_text"] if rollup else ""}
+    written = write_columns(records, TOOLTIPS_FNAME)
+    DATA.reset("tooltips")
+    return written
+
+
+METRICS = {}
+
+
+def metric(d_source):
+    """
+    Register a function computing `d_source`'s value for every node at
+    once, given the node ids as an int64 array.
+    """
+
+    def register(func):
+        METRICS[d_source] = func
+        return func
+
+    return register
+
+
+@metric(DataSource.NONE)
+def constant_metric(node_ids):
+    return np.ones(len(node_ids), dtype=np.int64)
+
+
+@metric(DataSource.FRIENDS)
+def friends_metric(node_ids):
+    # nodes missing from the adjacency store count as 0
+    return DATA.adjacency.degrees_of(node_ids, "friends")
 
-    maximum = max(values)
-    minimum = min(values)
 
-    colors = []
-    sizes = []
-    for value in values:
-        index_ratio = (value - minimum) / maximum
-        color_index = int(index_ratio * (len(PALETTE) - 1))
-        sizes.append(2 ** (color_index + 1))
-        colors.append(PALETTE[color_index])
-    return sizes, colors
+@metric(DataSource.FOLLOWERS)
+def followers_metric(node_ids):
+    return DATA.adjacency.degrees_of(node_ids, "followers")
+
+
+@metric(DataSource.TWEETS)
+def tweets_metric(node_ids):
+    user_ids, counts = DATA.tweet_counts
+    if len(user_ids) == 0:
+        return np.zeros(len(node_ids), dtype=np.int64)
+    idx = np.minimum(np.searchsorted(user_ids, node_ids), len(user_ids) - 1)
+    return np.where(user_ids[idx] == node_ids, counts[idx], 0)
+
+
+def score_metric(name, node_ids):
+    # scores are heavy-tailed, so color by order of magnitude relative
+    # to a uniform score
+    scores = DATA.centrality.lookup(name, node_ids)
+    return np.log1p(scores * max(len(DATA.centrality.nodes), 1))
+
+
+@metric(DataSource.PAGERANK)
+def pagerank_metric(node_ids):
+    return score_metric("pagerank", node_ids)
+
+
+@metric(DataSource.HUBS)
+def hubs_metric(node_ids):
+    return score_metric("hubs", node_ids)
+
+
+@metric(DataSource.AUTHORITIES)
+def authorities_metric(node_ids):
+    return score_metric("authorities", node_ids)
+
+
+@metric(DataSource.KCORE)
+def kcore_metric(node_ids):
+    return DATA.centrality.lookup("kcore", node_ids)
+
+
+def style_indices(values):
+    """
+    Bin metric values into palette indices with np.digitize, scaled over
+    the range of the values.  The plots map an index i to PALETTE[i]
+    and a size of 2 ** (i + 1) themselves.
+    """
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    minimum = values.min()
+    maximum = values.max()
+    num_colors = len(PALETTE)
+    if maximum == minimum:
+        color_index = np.zeros(len(values), dtype=np.int64)
+    else:
+        steps = np.arange(1, num_colors) / (num_colors - 1)
+        color_index = np.digitize(values, minimum + (maximum - minimum) * steps)
+    return color_index.astype(np.uint8)
+
+
+def palette_specs():
+    """
+    Fill color and size specs that map a "color" column of palette
+    indices as style_indices() describes.
+    """
+    mapper = LinearColorMapper(palette=PALETTE, low=-0.5, high=len(PALETTE) - 0.5)
+    sizes = CustomJSTransform(
+        func="return Math.pow(2, x + 1)",
+        v_func="return Array.from(xs, function(x) { return Math.pow(2, x + 1) })",
+    )
+    return transform("color", mapper), transform("color", sizes)
+
+
+TOOLTIP_CODE = """
+    var cache = window.tooltip_cache = window.tooltip_cache || {}
+    var data = source.data
+    if (data.desc === undefined) {
+      data.desc = Array.from(data.index, function() { return "" })
+    }
+    source.inspected.indices.forEach(function(i) {
+      var row = data.index[i]
+      if (row < 0 || data.desc[i]) {
+        return
+      }
+      if (row in cache) {
+        data.desc[i] = cache[row]
+        return
+      }
+      data.desc[i] = "..."
+      fetch("/tooltip/" + row + "?v=" + version).then(function(response) {
+        return response.ok ? response.json() : {desc: ""}
+      }).then(function(tooltip) {
+        cache[row] = tooltip.desc
+        if (source.data.index[i] == row) {
+          source.data.desc[i] = tooltip.desc
+          source.change.emit()
+        }
+      })
+    })
+    """
+
+
+def tooltip_callback(source, version):
+    """
+    Hover callback filling in the "desc" column of `source` from
+    /tooltip as nodes are hovered; rows in its "index" column that are
+    negative have their desc already.
+    """
+    return CustomJS(args={"source": source, "version": version}, code=TOOLTIP_CODE)
+
+
+def run_data(d_source):
+    network = DATA.network
+    node_ids = np.fromiter(network, dtype=np.int64, count=len(network))
+    values = np.asarray(METRICS[d_source](node_ids))
+    return style_indices(values)
 
 
 def get_square_bounds():
-    global NETWORK
-    if not NETWORK:
-        NETWORK = reload_json(
-            USER_GRAPH_FNAME, nx.DiGraph, transform=nx.node_link_graph
-        )
-    positions = graphviz_layout(NETWORK, prog="sfdp")
+    positions = cached_layout(DATA.network)
     xs = []
     ys = []
     for node in positions:
@@ -156,28 +348,37 @@ def get_square_bounds():
     return (min_x, max_x), (min_y, max_y)
 
 
-def make_plottable(colors=None, sizes=None, tweets=None):
-    global NETWORK
-    if not NETWORK:
-        NETWORK = reload_json(
-            USER_GRAPH_FNAME, nx.DiGraph, transform=nx.node_link_graph
-        )
-    graph = from_networkx(NETWORK, graphviz_layout, prog="sfdp")
-
-    if not colors:
-        node_color = Spectral4[0]
-    else:
-        node_color = "color"
-        graph.node_renderer.data_source.add(colors, "color")
-
-    if not sizes:
-        node_size = 8
-    else:
-        node_size = "size"
-        graph.node_renderer.data_source.add(sizes, "size")
-
-    if tweets:
-        graph.node_renderer.data_source.add(tweets, "desc")
+def make_plottable(colors):
+    """
+    A GraphRenderer for the network with its nodes numbered by their row
+    in network order, and every column a typed array, which bokeh sends
+    as binary rather than as JSON lists.
+    """
+    from analyze import graph_arrays
+
+    network = DATA.network
+    positions = cached_layout(network)
+    node_ids, edges = graph_arrays(network)
+    row_dtype = np.uint16 if len(node_ids) <= 1 << 16 else np.int32
+    graph = GraphRenderer()
+    graph.node_renderer.data_source.data = {
+        "index": np.arange(len(node_ids), dtype=row_dtype),
+        "color": np.asarray(colors, dtype=np.uint8),
+    }
+    graph.edge_renderer.data_source.data = {
+        "start": edges[:, 0].astype(row_dtype),
+        "end": edges[:, 1].astype(row_dtype),
+    }
+    # the layout can only go as JSON; a ten-thousandth of its extent is
+    # well under a pixel, so that's all the precision it gets
+    xy = np.array([positions[node] for node in node_ids.tolist()], dtype=np.float64)
+    xy = xy.reshape(-1, 2)
+    extent = np.ptp(xy) if len(xy) else 0
+    digits = max(0, 4 - int(np.floor(np.log10(extent)))) if extent > 0 else 0
+    graph.layout_provider = StaticLayoutProvider(
+        graph_layout=dict(enumerate(np.round(xy, digits).tolist()))
+    )
+    node_color, node_size = palette_specs()
 
     edge_width = 0.3
     select_edge_width = 2
@@ -216,83 +417,370 @@ def make_plottable(colors=None, sizes=None, tweets=None):
     return graph
 
 
+@STAGE_SECONDS.time(stage="construct_graph_data")
+@profiled
 def construct_graph_data():
-    global GRAPH_DATA
-    GRAPH_DATA = reload_json("graph_data", lambda: None)
-
-    if GRAPH_DATA:
-        return
-
-    GRAPH_DATA = {}
-    GRAPH_DATA["raw_tweets"] = run_tweets()
+    # the centrality metrics come from the full graph, which can change
+    # without the trimmed one changing, and the positions from the layout
+    version = graph_version(DATA.network)
+    version = f"{version}-{DATA.centrality.version}-{LAYOUT_PROG}-{GRAPH_DATA_FORMAT}"
+    graph_data = reload_json("graph_data", lambda: None)
+
+    if graph_data and graph_data.get("version") == version:
+        if not has_columns(TOOLTIPS_FNAME):
+            write_tooltips()
+        render_payloads(graph_data)
+        return graph_data
+
+    graph_data = {"version": version}
     for name, d_source in DataSource.__members__.items():
-        sizes, colors = run_data(d_source)
-        GRAPH_DATA[str(d_source)] = (sizes, colors)
+        graph_data[str(d_source)] = run_data(d_source).tolist()
     x_range, y_range = get_square_bounds()
-    GRAPH_DATA["range"] = (x_range, y_range)
+    graph_data["range"] = (x_range, y_range)
+
+    # tooltips first, so graph_data never claims a version they don't have
+    write_tooltips()
+    json_it(graph_data, "graph_data")
+    render_payloads(graph_data)
+    return graph_data
+
+
+def render_payloads(graph_data):
+    """
+    Serialize the plot for every DataSource up front, so /plot only has
+    to look the payload up.  Payloads for other graph versions are
+    dropped.
+    """
+    version = graph_data["version"]
+    PAYLOADS.clear(keep_version=version)
+    for d_source in DataSource:
+        if PAYLOADS.get(version, str(d_source)) is None:
+            PAYLOADS.put(version, str(d_source), render_plot(graph_data, d_source))
+
+
+def preload():
+    """
+    Load the graph data and render every payload now, for a preloading
+    gunicorn master to share with the workers it forks.
+    """
+    DATA.snapshot(["graph_data"])
+
+
+def payload_response(payload):
+    """
+    Serve a cached payload in the best encoding the client accepts,
+    answering conditional GETs against its strong ETag.
+    """
+    request = flask.request
+    encodings = [enc for enc in ("br", "gzip", "identity") if enc in payload.bodies]
+    encoding = request.accept_encodings.best_match(encodings, default="identity")
+    etag = payload.etag if encoding == "identity" else f"{payload.etag}-{encoding}"
+
+    response = flask.Response(mimetype="application/json")
+    response.set_etag(etag)
+    response.vary.add("Accept-Encoding")
+    response.cache_control.no_cache = True
+    if request.if_none_match.contains(etag):
+        response.status_code = 304
+        return response
+    response.set_data(payload.bodies[encoding])
+    if encoding != "identity":
+        response.content_encoding = encoding
+    return response
+
+
+@app.before_request
+def start_timer():
+    flask.g.request_start = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    start = flask.g.get("request_start")
+    if start is not None:
+        rule = flask.request.url_rule
+        REQUEST_SECONDS.observe(
+            time.perf_counter() - start,
+            endpoint=rule.rule if rule else "unmatched",
+            status=response.status_code,
+        )
+    return response
+
+
+@app.route("/metrics")
+def metrics():
+    return flask.Response(REGISTRY.render(), content_type=CONTENT_TYPE)
 
-    json_it(GRAPH_DATA, "graph_data")
+
+@app.route("/metrics/profiles")
+def profiles():
+    return flask.Response(profile_report(), content_type="text/plain")
 
 
 @app.route("/")
 def root():
-    return flask.render_template("index.html", resources=CDN.render())
+    plot_url = "/lod" if len(DATA.network) > LOD_NODE_THRESHOLD else "/plot"
+    return flask.render_template(
+        "index.html", resources=CDN.render(), plot_url=plot_url
+    )
 
 
-@app.route("/plot", methods=["GET"])
-def plot():
-    global GRAPH_DATA
-    if not GRAPH_DATA:
-        construct_graph_data()
+def requested_data_source():
+    data_form = flask.request.values.get("Data", "none")
+    return DataSource.__members__.get(data_form.upper(), DataSource.NONE)
 
-    d_source = DataSource.NONE
 
-    if flask.request.method == "POST":
-        data_form = flask.request.form.get("Data")
-        if data_form == "none":
-            d_source = DataSource.NONE
-        elif data_form == "followers":
-            d_source = DataSource.FOLLOWERS
-        elif data_form == "friends":
-            d_source = DataSource.FRIENDS
-        elif data_form == "tweets":
-            d_source = DataSource.TWEETS
+@app.route("/plot", methods=["GET", "POST"])
+def plot():
+    graph_data = DATA.graph_data
+    d_source = requested_data_source()
+
+    version = graph_data["version"]
+    payload = PAYLOADS.get(version, str(d_source))
+    if payload is None:
+        payload = PAYLOADS.put(
+            version, str(d_source), render_plot(graph_data, d_source)
+        )
+    return payload_response(payload)
+
 
-    tweets = GRAPH_DATA["raw_tweets"]
-    sizes, colors = GRAPH_DATA[str(d_source)]
-    graph = make_plottable(colors=colors, sizes=sizes, tweets=tweets)
+@profiled
+def render_plot(graph_data, d_source):
+    """
+    The whole network as one plot.  Tweets are left out and fetched from
+    /tooltip on hover, and the other DataSources' styles are sent as one
+    uint8 column each for the buttons to switch between.
+    """
+    styles = {
+        str(other): np.array(graph_data[str(other)], dtype=np.uint8)
+        for other in DataSource
+    }
+    graph = make_plottable(styles[str(d_source)])
 
-    x_range, y_range = GRAPH_DATA["range"]
+    x_range, y_range = graph_data["range"]
 
+    source = graph.node_renderer.data_source
     tooltips = [("tweets", "@desc")]
+    hover = HoverTool(
+        tooltips=tooltips, callback=tooltip_callback(source, graph_data["version"])
+    )
     plot = figure(x_range=x_range, y_range=y_range, plot_width=600, plot_height=600)
     plot.title.text = "User Graph" + d_source.to_title()
     plot.background_fill_color = "black"
     plot.background_fill_alpha = 0.9
     plot.axis.visible = False
     plot.grid.visible = False
-    plot.add_tools(
-        HoverTool(tooltips=tooltips), TapTool(), BoxSelectTool(), WheelZoomTool()
-    )
+    plot.add_tools(hover, TapTool(), BoxSelectTool(), WheelZoomTool())
     plot.renderers = [graph]
 
-    source = graph.node_renderer.data_source
     callback = CustomJS(
-        args=({"source": source, "graph_data": GRAPH_DATA}),
+        args=({"source": source, "styles": ColumnDataSource(styles)}),
         code="""
     var label_arr = cb_obj.attributes.labels
     var active_ix = cb_obj.attributes.active
     d_source_str = label_arr[active_ix].toLowerCase()
-    sizes = graph_data[d_source_str][0]
-    colors = graph_data[d_source_str][1]
-    source.data.color = colors
-    source.data.size = sizes
+    source.data.color = styles.data[d_source_str]
     source.change.emit();
     """,
     )
-    button_group = RadioButtonGroup(
-        labels=["None", "Friends", "Followers", "Tweets"], active=0, callback=callback
+    button_group = RadioButtonGroup(labels=DATA_LABELS, active=0, callback=callback)
+
+    layout = column(plot, button_group)
+    return json.dumps(json_item(layout, "container"))
+
+
+@app.route("/tooltip/<int:node>")
+def tooltip(node):
+    """
+    The tweet shown for the node in row `node` of the network.  Plots
+    ask with their graph version, so the answer can be cached for long.
+    """
+    graph_data = DATA.graph_data
+    if flask.request.args.get("v", graph_data["version"]) != graph_data["version"]:
+        flask.abort(404)
+    store = DATA.tooltips
+    if node >= len(store):
+        flask.abort(404)
+    response = flask.jsonify({"desc": store.read("desc", node, node + 1)[0] or ""})
+    response.cache_control.public = True
+    response.cache_control.max_age = TOOLTIP_MAX_AGE
+    return response
+
+
+@app.route("/lod")
+def lod_plot():
+    graph_data = DATA.graph_data
+    version = graph_data["version"]
+    payload = PAYLOADS.get(version, "lod")
+    if payload is None:
+        payload = PAYLOADS.put(version, "lod", render_lod_plot(graph_data))
+    return payload_response(payload)
+
+
+@app.route("/tiles/<int:zoom>/<int:tile_x>/<int:tile_y>")
+def tile(zoom, tile_x, tile_y):
+    num_tiles = 2 ** zoom
+    if zoom > TILE_MAX_ZOOM or tile_x >= num_tiles or tile_y >= num_tiles:
+        flask.abort(404)
+    graph_data = DATA.graph_data
+    d_source = requested_data_source()
+
+    version = graph_data["version"]
+    name = f"{d_source}-{zoom}-{tile_x}-{tile_y}"
+    payload = TILE_PAYLOADS.get(version, name)
+    if payload is None:
+        body = json.dumps(tile_columns(graph_data, d_source, zoom, tile_x, tile_y))
+        payload = TILE_PAYLOADS.put(version, name, body)
+    return payload_response(payload)
+
+
+@profiled
+def tile_columns(graph_data, d_source, zoom, tile_x, tile_y):
+    """
+    A tile as node and edge columns ready for a ColumnDataSource.
+    Detailed nodes are styled like /plot, with their row for /tooltip;
+    aggregated ones are styled by how many users they stand for, and
+    have a row of -1 and their description filled in.
+    """
+    tile = DATA.tiles.tile(zoom, tile_x, tile_y)
+    if tile["detail"]:
+        rows = tile["rows"]
+        colors = DATA.node_styles[d_source][rows]
+        desc = [""] * len(rows)
+    else:
+        rows = np.full(len(tile["counts"]), -1)
+        colors = style_indices(np.log2(tile["counts"]))
+        desc = [f"{count} users" for count in tile["counts"].tolist()]
+    return {
+        "zoom": zoom,
+        "detail": tile["detail"],
+        "nodes": {
+            "x": tile["x"].tolist(),
+            "y": tile["y"].tolist(),
+            "color": colors.tolist(),
+            "index": rows.tolist(),
+            "desc": desc,
+        },
+        "edges": {
+            "x0": tile["x0"].tolist(),
+            "y0": tile["y0"].tolist(),
+            "x1": tile["x1"].tolist(),
+            "y1": tile["y1"].tolist(),
+            "width": (0.3 * (1 + np.log2(tile["weights"]))).tolist(),
+        },
+    }
+
+
+def render_lod_plot(graph_data):
+    """
+    A plot that starts from the zoom 0 tile and, whenever it is panned,
+    zoomed or switched to another data source, fetches the tiles
+    covering the view from /tiles.
+    """
+    first = tile_columns(graph_data, DataSource.NONE, 0, 0, 0)
+    nodes = ColumnDataSource(first["nodes"])
+    edges = ColumnDataSource(first["edges"])
+    (min_x, max_x), (min_y, max_y) = graph_data["range"]
+
+    tooltips = [("tweets", "@desc")]
+    plot = figure(
+        x_range=Range1d(min_x, max_x),
+        y_range=Range1d(min_y, max_y),
+        plot_width=600,
+        plot_height=600,
+    )
+    plot.title.text = "User Graph"
+    plot.background_fill_color = "black"
+    plot.background_fill_alpha = 0.9
+    plot.axis.visible = False
+    plot.grid.visible = False
+    plot.segment(
+        "x0",
+        "y0",
+        "x1",
+        "y1",
+        source=edges,
+        line_color="#666666",
+        line_alpha=0.3,
+        line_width="width",
+    )
+    node_color, node_size = palette_specs()
+    node_glyph = plot.circle(
+        "x",
+        "y",
+        size=node_size,
+        source=nodes,
+        fill_color=node_color,
+        line_color=node_color,
+        fill_alpha=0.95,
+        line_alpha=0.95,
+    )
+    hover = HoverTool(
+        tooltips=tooltips,
+        renderers=[node_glyph],
+        callback=tooltip_callback(nodes, graph_data["version"]),
+    )
+    plot.add_tools(hover)
+
+    button_group = RadioButtonGroup(labels=DATA_LABELS, active=0)
+    callback = CustomJS(
+        args={
+            "nodes": nodes,
+            "edges": edges,
+            "x_range": plot.x_range,
+            "y_range": plot.y_range,
+            "buttons": button_group,
+            "bounds": [min_x, max_x, min_y, max_y],
+            "max_zoom": TILE_MAX_ZOOM,
+        },
+        code="""
+    var data = buttons.labels[buttons.active].toLowerCase()
+    var seq = window.lod_seq = (window.lod_seq || 0) + 1
+    clearTimeout(window.lod_timer)
+    window.lod_timer = setTimeout(function() {
+      var size = bounds[1] - bounds[0]
+      var zoom = Math.round(Math.log2(size / (x_range.end - x_range.start)))
+      zoom = Math.max(0, Math.min(max_zoom, zoom))
+      var tile_size = size / Math.pow(2, zoom)
+      var last = Math.pow(2, zoom) - 1
+      function tile_of(value, origin) {
+        var index = Math.floor((value - origin) / tile_size)
+        return Math.max(0, Math.min(last, index))
+      }
+      var requests = []
+      var x_end = tile_of(x_range.end, bounds[0])
+      var y_end = tile_of(y_range.end, bounds[2])
+      for (var x = tile_of(x_range.start, bounds[0]); x <= x_end; x++) {
+        for (var y = tile_of(y_range.start, bounds[2]); y <= y_end; y++) {
+          var url = "/tiles/" + zoom + "/" + x + "/" + y + "?Data=" + data
+          requests.push(fetch(url).then(function(response) {
+            return response.json()
+          }))
+        }
+      }
+      Promise.all(requests).then(function(tiles) {
+        if (seq != window.lod_seq) {
+          return
+        }
+        var node_data = {x: [], y: [], color: [], index: [], desc: []}
+        var edge_data = {x0: [], y0: [], x1: [], y1: [], width: []}
+        tiles.forEach(function(tile) {
+          for (var key in node_data) {
+            node_data[key] = node_data[key].concat(tile.nodes[key])
+          }
+          for (var key in edge_data) {
+            edge_data[key] = edge_data[key].concat(tile.edges[key])
+          }
+        })
+        nodes.data = node_data
+        edges.data = edge_data
+      })
+    }, 150)
+    """,
     )
+    plot.x_range.js_on_change("end", callback)
+    plot.y_range.js_on_change("end", callback)
+    button_group.js_on_change("active", callback)
 
     layout = column(plot, button_group)
     return json.dumps(json_item(layout, "container"))
@@ -0,0 +1,56 @@
+"""
+Scraping backends.  A backend supplies the fetcher (and rate-limit
+buckets) the expansion engine pages friends/followers through, and
+streams statuses, as raw tweet JSON, into a store function.
+"""
+from expand import TweepyFetcher, make_buckets
+from global_vars import LOG_FLUSH_EVERY, STREAM_SHARDS
+from shard_stream import RoundRobin, ShardedStreamer, TwitterSource
+from utils import authenticate_twitter, compile_users_n_others
+
+
+class TwitterBackend:
+    def fetcher(self, user_dict):
+        return TweepyFetcher(authenticate_twitter(wait_on_rate_limit=False))
+
+    def buckets(self):
+        return make_buckets()
+
+    def stream(
+        self,
+        store,
+        checkpoint,
+        checkpoint_every=LOG_FLUSH_EVERY,
+        source=None,
+        num_shards=STREAM_SHARDS,
+        policy=None,
+    ):
+        """
+        Stream every follow-filter batch from compile_users_n_others,
+        `num_shards` batches at a time.
+        """
+        groups = compile_users_n_others()
+        streamer = ShardedStreamer(
+            source or TwitterSource(),
+            groups,
+            store,
+            num_shards=num_shards,
+            policy=policy or RoundRobin(groups),
+            checkpoint=checkpoint,
+            checkpoint_every=checkpoint_every,
+        )
+        return streamer.run()
+
+    def close(self):
+        pass
+
+
+def make_backend(name):
+    if name == "twitter":
+        return TwitterBackend()
+    if name == "mastodon":
+        # aiohttp is only needed for Mastodon
+        from mastodon_backend import MastodonBackend
+
+        return MastodonBackend()
+    raise ValueError(f"unknown scrape backend {name}")
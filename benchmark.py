@@ -0,0 +1,238 @@
+"""
+Benchmarks for the analyze/app pipeline on synthetic data.
+
+    python benchmark.py run 10000 100000 1000000 --seed 0 --others-mod 0.05
+    python benchmark.py compare bench_results/a.json bench_results/b.json
+
+Every size runs in its own process and working directory, since analyze
+and app load their data when imported, and runs twice: once timing each
+stage, and once measuring its peak traced memory, since tracing every
+allocation slows the stages down.  Both are written to RESULTS_DIR as
+JSON.
+"""
+import argparse
+import importlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+RESULTS_DIR = "bench_results"
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class StageTimer:
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.stages = {}
+
+    def run(self, name, func, *args, **kwargs):
+        """
+        Time `func`, or with `memory`, record its peak traced memory
+        instead; failures are recorded rather than raised so later
+        stages still run.
+        """
+        if self.memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        result = None
+        try:
+            result = func(*args, **kwargs)
+            error = None
+        except Exception as err:
+            error = f"{type(err).__name__}: {err}"
+        seconds = time.perf_counter() - start
+        if self.memory:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.stages[name] = {"peak_mb": peak / 2 ** 20}
+            print(f"{name:>24}: {peak / 2 ** 20:9.1f}MB {error or ''}")
+        else:
+            self.stages[name] = {"seconds": seconds}
+            print(f"{name:>24}: {seconds:9.3f}s {error or ''}")
+        if error:
+            self.stages[name]["error"] = error
+        return result
+
+
+def cold_plot(app, client):
+    """
+    GET /plot as the first request of a fresh worker: no payloads
+    rendered, in memory or on disk, and nothing loaded.
+    """
+    app.PAYLOADS.clear()
+    app.DATA.reset()
+    return client.get("/plot")
+
+
+def run_size(num_edges, seed, others_mod=None, memory=False):
+    """
+    Generate a dataset in the current directory and time every stage,
+    or with `memory`, measure their memory.  `others_mod` overrides
+    analyze.OTHERS_MOD, so that small datasets still trim down to a
+    non-empty graph.
+    """
+    import synthetic
+    from global_vars import USER_DICT_FNAME
+    from utils import compile_users_n_others, json_it, reload_json
+
+    timer = StageTimer(memory)
+    users, _ = timer.run("generate", synthetic.write_dataset, num_edges, seed)
+    timer.run("json_it", json_it, users, USER_DICT_FNAME)
+    del users
+    timer.run("reload_json", reload_json, USER_DICT_FNAME, dict)
+    timer.run(
+        "reload followers_count",
+        reload_json,
+        USER_DICT_FNAME,
+        dict,
+        columns=["followers_count"],
+    )
+
+    analyze = timer.run("import analyze", importlib.import_module, "analyze")
+    if others_mod is not None:
+        analyze.OTHERS_MOD = others_mod
+    graph = timer.run("build_graph", analyze.build_graph)
+    timer.run("centrality", analyze.load_centrality)
+    timer.run("trim_graph", analyze.trim_graph, graph)
+    num_graph_edges = graph.number_of_edges() if graph is not None else 0
+    del graph
+
+    batches = {}
+    for by_community in (False, True):
+        name = "follow batches" + (" by community" if by_community else "")
+        packed = timer.run(
+            name, compile_users_n_others, reset=True, by_community=by_community
+        )
+        batches[name] = len(packed or ())
+
+    app = timer.run("import app", importlib.import_module, "app")
+    for d_source in app.DataSource:
+        timer.run(f"run_data {d_source}", app.run_data, d_source)
+    timer.run("construct_graph_data", app.construct_graph_data)
+    client = app.app.test_client()
+    timer.run("/plot cold", cold_plot, app, client)
+    timer.run("/plot warm", client.get, "/plot")
+
+    return {
+        "meta": {
+            "edges_requested": num_edges,
+            "graph_edges": num_graph_edges,
+            "seed_users": len(analyze.DATA.adjacency.seed_ids()),
+            "stream_batches": batches,
+            "seed": seed,
+            "others_mod": others_mod,
+            "python": sys.version.split()[0],
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": git_commit(),
+        },
+        "stages": timer.stages,
+    }
+
+
+def git_commit():
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_DIR,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        )
+    except OSError:
+        return None
+    return out.stdout.strip() or None
+
+
+def run_child(num_edges, seed, others_mod, out_path, memory=False):
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        sys.path.insert(0, REPO_DIR)
+        result = run_size(num_edges, seed, others_mod, memory)
+    with open(out_path, "w") as out_file:
+        json.dump(result, out_file, indent=2)
+
+
+def run(sizes, seed, others_mod=None):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    paths = []
+    for num_edges in sizes:
+        print(f"=== {num_edges} edges (seed {seed}) ===")
+        out_path = os.path.abspath(
+            os.path.join(RESULTS_DIR, f"{stamp}-{num_edges}.json")
+        )
+        command = [sys.executable, __file__, "child", str(num_edges), str(seed)]
+        if others_mod is not None:
+            command += ["--others-mod", str(others_mod)]
+        subprocess.run(command + [out_path], check=True)
+        memory_path = out_path + ".memory"
+        subprocess.run(command + ["--memory", memory_path], check=True)
+        merge_memory(out_path, memory_path)
+        paths.append(out_path)
+    return paths
+
+
+def merge_memory(out_path, memory_path):
+    """
+    Add the peak memory of every stage from the memory run to the
+    timings in `out_path`.
+    """
+    with open(out_path) as out_file, open(memory_path) as memory_file:
+        result, memory = json.load(out_file), json.load(memory_file)
+    for name, stage in result["stages"].items():
+        stage["peak_mb"] = memory["stages"].get(name, {}).get("peak_mb", 0.0)
+    with open(out_path, "w") as out_file:
+        json.dump(result, out_file, indent=2)
+    os.remove(memory_path)
+
+
+def compare(old_path, new_path):
+    with open(old_path) as old_file, open(new_path) as new_file:
+        old, new = json.load(old_file), json.load(new_file)
+    header = ("stage", "old s", "new s", "ratio", "old MB", "new MB")
+    print("{:>24} {:>9} {:>9} {:>6} {:>9} {:>9}".format(*header))
+    for name, after in new["stages"].items():
+        before = old["stages"].get(name)
+        if before is None:
+            continue
+        ratio = after["seconds"] / before["seconds"] if before["seconds"] else 0
+        print(
+            f"{name:>24} {before['seconds']:9.3f} {after['seconds']:9.3f} "
+            f"{ratio:6.2f} {before['peak_mb']:9.1f} {after['peak_mb']:9.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    commands = parser.add_subparsers(dest="command")
+    run_parser = commands.add_parser("run")
+    run_parser.add_argument("sizes", type=int, nargs="+", help="edges per dataset")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--others-mod", type=float, default=None)
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    child_parser = commands.add_parser("child")
+    child_parser.add_argument("edges", type=int)
+    child_parser.add_argument("seed", type=int)
+    child_parser.add_argument("--others-mod", type=float, default=None)
+    child_parser.add_argument("--memory", action="store_true")
+    child_parser.add_argument("out")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        for path in run(args.sizes, args.seed, args.others_mod):
+            print(f"Results written to {path}")
+    elif args.command == "compare":
+        compare(args.old, args.new)
+    elif args.command == "child":
+        run_child(args.edges, args.seed, args.others_mod, args.out, args.memory)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+PageRank, HITS and k-core numbers of the full graph, by power iteration
+and peeling over a SciPy sparse adjacency matrix, cached on disk under
+the full graph's version.
+
+The three metrics are computed on a thread pool; SciPy's sparse
+products release the GIL, so they run in parallel.
+"""
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import sparse
+
+from global_vars import (CENTRALITY_FNAME, CENTRALITY_MAX_ITER, CENTRALITY_TOL,
+                         FULL_GRAPH_FNAME, PAGERANK_ALPHA)
+from graph_store import GraphStore, stored_version
+
+METRIC_NAMES = ("pagerank", "hubs", "authorities", "kcore")
+
+
+def adjacency_matrix(store):
+    """
+    The graph in `store` as a CSR matrix, rows and columns in the order
+    of store.nodes.
+    """
+    num_nodes = len(store.nodes)
+    sources = np.searchsorted(store.nodes, store.edges["source"])
+    targets = np.searchsorted(store.nodes, store.edges["target"])
+    weights = np.ones(len(sources), dtype=np.float64)
+    return sparse.csr_matrix((weights, (sources, targets)), shape=(num_nodes,) * 2)
+
+
+def pagerank(
+    matrix, alpha=PAGERANK_ALPHA, tol=CENTRALITY_TOL, max_iter=CENTRALITY_MAX_ITER
+):
+    """
+    PageRank by power iteration, with dangling nodes' rank spread evenly
+    over every node (as networkx does).
+    """
+    num_nodes = matrix.shape[0]
+    if num_nodes == 0:
+        return np.zeros(0)
+    out_degree = np.asarray(matrix.sum(axis=1)).ravel()
+    dangling = out_degree == 0
+    inverse = np.divide(1.0, out_degree, out=np.zeros(num_nodes), where=~dangling)
+    transition = (sparse.diags(inverse) @ matrix).T.tocsr()
+
+    scores = np.full(num_nodes, 1.0 / num_nodes)
+    for _ in range(max_iter):
+        previous = scores
+        teleport = (alpha * previous[dangling].sum() + 1 - alpha) / num_nodes
+        scores = alpha * (transition @ previous) + teleport
+        if np.abs(scores - previous).sum() < num_nodes * tol:
+            break
+    return scores
+
+
+def hits(matrix, tol=CENTRALITY_TOL, max_iter=CENTRALITY_MAX_ITER):
+    """
+    HITS hub and authority scores by power iteration, each summing to 1.
+    """
+    num_nodes = matrix.shape[0]
+    if num_nodes == 0:
+        return np.zeros(0), np.zeros(0)
+    transpose = matrix.T.tocsr()
+    hubs = np.full(num_nodes, 1.0 / num_nodes)
+    authorities = hubs
+    for _ in range(max_iter):
+        previous = hubs
+        authorities = transpose @ hubs
+        authorities /= authorities.max() or 1.0
+        hubs = matrix @ authorities
+        hubs /= hubs.max() or 1.0
+        if np.abs(hubs - previous).sum() < num_nodes * tol:
+            break
+    return hubs / (hubs.sum() or 1.0), authorities / (authorities.sum() or 1.0)
+
+
+def core_numbers(matrix):
+    """
+    k-core number of every node of the undirected graph underlying
+    `matrix`, peeling every node of degree <= k at once and updating the
+    remaining degrees with one sparse product per round.
+    """
+    num_nodes = matrix.shape[0]
+    undirected = ((matrix + matrix.T) > 0).astype(np.int64).tocsr()
+    # drop self-loops without leaving the compressed format
+    loops = sparse.diags(undirected.diagonal(), format="csr", dtype=np.int64)
+    undirected = undirected - loops
+    undirected.eliminate_zeros()
+
+    degree = np.asarray(undirected.sum(axis=1)).ravel()
+    core = np.zeros(num_nodes, dtype=np.int64)
+    alive = np.ones(num_nodes, dtype=bool)
+    k = 0
+    while alive.any():
+        k = max(k, degree[alive].min())
+        while True:
+            peel = alive & (degree <= k)
+            if not peel.any():
+                break
+            core[peel] = k
+            alive[peel] = False
+            degree -= undirected @ peel.astype(np.int64)
+    return core
+
+
+class Centrality:
+    """
+    Every metric for the sorted node ids `nodes` of the graph `version`.
+    """
+
+    def __init__(self, version, nodes, values):
+        self.version = version
+        self.nodes = nodes
+        self.values = values
+
+    def lookup(self, name, node_ids):
+        """
+        `name`'s value for each of `node_ids`; nodes not in the full graph
+        get 0.
+        """
+        values = self.values[name]
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        if len(self.nodes) == 0:
+            return np.zeros(len(node_ids), dtype=values.dtype)
+        idx = np.minimum(np.searchsorted(self.nodes, node_ids), len(self.nodes) - 1)
+        return np.where(self.nodes[idx] == node_ids, values[idx], 0)
+
+    @classmethod
+    def compute(cls, store):
+        start = time.perf_counter()
+        matrix = adjacency_matrix(store)
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            ranks = pool.submit(pagerank, matrix)
+            hub_authority = pool.submit(hits, matrix)
+            cores = pool.submit(core_numbers, matrix)
+            hubs, authorities = hub_authority.result()
+            values = {
+                "pagerank": ranks.result(),
+                "hubs": hubs,
+                "authorities": authorities,
+                "kcore": cores.result(),
+            }
+        seconds = time.perf_counter() - start
+        print(f"Computed centrality for {len(store)} nodes in {seconds:.1f}s")
+        return cls(store.version(), store.nodes, values)
+
+    @classmethod
+    def load(cls, fname_base, version):
+        try:
+            with np.load(fname_base + ".npz") as data:
+                if str(data["version"]) != version:
+                    return None
+                values = {name: data[name] for name in METRIC_NAMES}
+                return cls(version, data["nodes"], values)
+        except (FileNotFoundError, KeyError, ValueError):
+            return None
+
+    def save(self, fname_base):
+        fname = fname_base + ".npz"
+        try:
+            with open(fname + ".tmp", "wb") as centrality_file:
+                np.savez(
+                    centrality_file,
+                    version=self.version,
+                    nodes=self.nodes,
+                    **self.values,
+                )
+            os.replace(fname + ".tmp", fname)
+        except OSError:
+            sys.stderr.write(f"ERROR: {fname} is not writeable!\n")
+            return False
+        return True
+
+
+def load_centrality(store=None, fname_base=CENTRALITY_FNAME):
+    """
+    Centrality of the full graph (`store`, or the one saved under
+    FULL_GRAPH_FNAME), from the cache if it is for the same version.
+    """
+    if store is None:
+        version = stored_version(FULL_GRAPH_FNAME)
+    else:
+        version = store.version()
+    centrality = Centrality.load(fname_base, version)
+    if centrality is not None:
+        return centrality
+    if store is None:
+        store = GraphStore.load(FULL_GRAPH_FNAME)
+    centrality = Centrality.compute(store)
+    centrality.save(fname_base)
+    return centrality
@@ -0,0 +1,325 @@
+"""
+Columnar on-disk format for dictionaries of records (the users dict).
+
+A store lives in a `<fname_base>.cols` directory holding schema.json and
+one or more .npy files per column.  Scalar columns are typed arrays,
+strings and anything nested are a byte blob plus offsets, and lists of
+ids (friends/followers) are an offsets array plus a flat int64 array.
+Every array is memory-mapped on read, so reading a few columns, or a
+chunk of rows, only touches those bytes.
+
+    python columnar.py users_dict
+
+converts an existing users_dict.pkl.gz/.json.gz (plus its log) in place.
+"""
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+import ujson
+
+from global_vars import COLUMN_CHUNK_ROWS
+
+ID_LIST_KEYS = ("followers", "friends")
+_MISSING = object()
+
+
+def columns_dirname(fname_base):
+    return fname_base + ".cols"
+
+
+def _recover(dirname):
+    """
+    Move the previous store back into place if write_columns() was
+    stopped between moving it aside and moving the new one in.  Its
+    log's fold marker names the new store, so the log is replayed over
+    the old one in full.
+    """
+    old_dirname = dirname + ".old"
+    if not os.path.isdir(dirname) and os.path.isdir(old_dirname):
+        print(f"Restoring {dirname} from {old_dirname}")
+        os.rename(old_dirname, dirname)
+
+
+def has_columns(fname_base):
+    dirname = columns_dirname(fname_base)
+    _recover(dirname)
+    return os.path.isfile(os.path.join(dirname, "schema.json"))
+
+
+def _fits_int64(value):
+    return not isinstance(value, int) or -(2 ** 63) <= value < 2 ** 63
+
+
+def _infer_kind(name, values):
+    present = [value for value in values if value is not _MISSING]
+    if name in ID_LIST_KEYS and all(isinstance(value, list) for value in present):
+        return "idlist"
+    if all(isinstance(value, bool) for value in present):
+        return "bool"
+    if all(isinstance(value, int) and not isinstance(value, bool) for value in present):
+        # ints past 64 bits are kept exact rather than rounded to floats
+        return "int" if all(_fits_int64(value) for value in present) else "json"
+    if all(
+        isinstance(value, (int, float)) and not isinstance(value, bool)
+        for value in present
+    ):
+        return "float" if all(_fits_int64(value) for value in present) else "json"
+    if all(isinstance(value, str) for value in present):
+        return "str"
+    return "json"
+
+
+def _dumps(value):
+    try:
+        return ujson.dumps(value)
+    except OverflowError:
+        # older ujson can't encode ints past 64 bits
+        return json.dumps(value)
+
+
+def _loads(item):
+    try:
+        return ujson.loads(item)
+    except (OverflowError, ValueError):
+        return json.loads(item)
+
+
+def _encode(kind, values):
+    """
+    Arrays for one column, keyed by file suffix.
+    """
+    arrays = {}
+    missing = [value is _MISSING for value in values]
+    if any(missing):
+        arrays["present"] = ~np.array(missing, dtype=bool)
+    if kind == "int":
+        arrays["data"] = np.array([0 if m else v for v, m in zip(values, missing)])
+        arrays["data"] = arrays["data"].astype(np.int64)
+    elif kind == "float":
+        data = [np.nan if m else v for v, m in zip(values, missing)]
+        arrays["data"] = np.array(data, dtype=np.float64)
+    elif kind == "bool":
+        arrays["data"] = np.array([bool(m or v) for v, m in zip(values, missing)])
+    elif kind == "idlist":
+        lists = [[] if m else v for v, m in zip(values, missing)]
+        lengths = np.fromiter((len(ids) for ids in lists), dtype=np.int64)
+        arrays["offsets"] = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        flat = [other for ids in lists for other in ids]
+        arrays["data"] = np.array(flat, dtype=np.int64)
+    else:
+        dumps = (lambda v: v) if kind == "str" else _dumps
+        encoded = [b"" if m else dumps(v).encode("utf-8") for v, m in zip(values, missing)]
+        lengths = np.fromiter((len(item) for item in encoded), dtype=np.int64)
+        arrays["offsets"] = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        arrays["data"] = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    return arrays
+
+
+def write_columns(records, fname_base, mark=None):
+    """
+    Write a dict of record dicts as a column store, replacing any
+    existing one only once the new one is complete.  `mark` is called
+    with the complete and final directory names just before the swap,
+    see SegmentLog.fold().
+    """
+    dirname = columns_dirname(fname_base)
+    _recover(dirname)
+    print(f"Writing {len(records)} records as columns to {dirname}")
+    names = []
+    seen = set()
+    for record in records.values():
+        for name in record:
+            if name not in seen:
+                seen.add(name)
+                names.append(name)
+
+    tmp_dirname = dirname + ".tmp"
+    shutil.rmtree(tmp_dirname, ignore_errors=True)
+    try:
+        os.makedirs(tmp_dirname)
+        # a fresh token per write, so no two stores' schemas are the same
+        token = os.urandom(8).hex()
+        schema = {"rows": len(records), "token": token, "columns": []}
+        columns = [("__index__", list(records))]
+        for name in names:
+            columns.append((name, [r.get(name, _MISSING) for r in records.values()]))
+        for i, (name, values) in enumerate(columns):
+            kind = _infer_kind(name, values) if i else "str"
+            arrays = _encode(kind, values)
+            schema["columns"].append({"name": name, "kind": kind, "files": list(arrays)})
+            for suffix, array in arrays.items():
+                np.save(os.path.join(tmp_dirname, f"c{i}.{suffix}.npy"), array)
+        with open(os.path.join(tmp_dirname, "schema.json"), "w") as schema_file:
+            json.dump(schema, schema_file)
+        if mark is not None:
+            mark(tmp_dirname, dirname)
+
+        old_dirname = dirname + ".old"
+        shutil.rmtree(old_dirname, ignore_errors=True)
+        if os.path.isdir(dirname):
+            os.rename(dirname, old_dirname)
+        os.rename(tmp_dirname, dirname)
+        shutil.rmtree(old_dirname, ignore_errors=True)
+    except OSError:
+        sys.stderr.write(f"ERROR: {dirname} is not writeable!\n")
+        return False
+    return True
+
+
+class ColumnStore:
+    """
+    Read side of a column store.  Columns can be projected and rows read
+    in chunks; nothing is decoded until it is asked for.
+    """
+
+    def __init__(self, fname_base):
+        self.dirname = columns_dirname(fname_base)
+        _recover(self.dirname)
+        with open(os.path.join(self.dirname, "schema.json")) as schema_file:
+            schema = json.load(schema_file)
+        self.rows = schema["rows"]
+        self.specs = {}
+        for i, spec in enumerate(schema["columns"]):
+            self.specs[spec["name"]] = (i, spec["kind"], spec["files"])
+        self._arrays = {}
+
+    def __len__(self):
+        return self.rows
+
+    @property
+    def columns(self):
+        return [name for name in self.specs if name != "__index__"]
+
+    def kind(self, name):
+        return self.specs[name][1]
+
+    def _array(self, name, suffix):
+        key = (name, suffix)
+        if key not in self._arrays:
+            i = self.specs[name][0]
+            path = os.path.join(self.dirname, f"c{i}.{suffix}.npy")
+            self._arrays[key] = np.load(path, mmap_mode="r")
+        return self._arrays[key]
+
+    def present(self, name, start=0, stop=None):
+        stop = self.rows if stop is None else stop
+        if "present" not in self.specs[name][2]:
+            return np.ones(stop - start, dtype=bool)
+        return np.asarray(self._array(name, "present")[start:stop])
+
+    def read(self, name, start=0, stop=None):
+        """
+        Values of one column for rows [start, stop): a NumPy array for
+        scalar columns, a list of int64 arrays for id lists, and a list
+        of Python objects otherwise.  Missing values are NaN/0/False in
+        arrays and None in lists; see present().
+        """
+        stop = self.rows if stop is None else stop
+        kind = self.kind(name)
+        data = self._array(name, "data")
+        if kind in ("int", "float", "bool"):
+            return np.asarray(data[start:stop])
+        offsets = np.asarray(self._array(name, "offsets")[start : stop + 1])
+        if kind == "idlist":
+            return [data[offsets[i] : offsets[i + 1]] for i in range(len(offsets) - 1)]
+        raw = data[offsets[0] : offsets[-1]].tobytes()
+        offsets = offsets - offsets[0]
+        present = self.present(name, start, stop)
+        values = []
+        for i in range(len(offsets) - 1):
+            if not present[i]:
+                values.append(None)
+                continue
+            item = raw[offsets[i] : offsets[i + 1]].decode("utf-8")
+            values.append(item if kind == "str" else _loads(item))
+        return values
+
+    def index(self, start=0, stop=None):
+        return self.read("__index__", start, stop)
+
+    def iter_chunks(self, columns=None, chunk_rows=COLUMN_CHUNK_ROWS):
+        """
+        Yield (ids, {column: values}) for consecutive chunks of rows.
+        """
+        columns = self.columns if columns is None else columns
+        for start in range(0, self.rows, chunk_rows):
+            stop = min(start + chunk_rows, self.rows)
+            yield self.index(start, stop), {
+                name: self.read(name, start, stop) for name in columns
+            }
+
+    def to_dict(self, columns=None):
+        """
+        Rebuild the original dict of records, optionally with only some
+        columns.
+        """
+        columns = self.columns if columns is None else columns
+        result = {}
+        for ids, chunk in self.iter_chunks(columns):
+            records = [{} for _ in ids]
+            start = len(result)
+            for name, values in chunk.items():
+                present = self.present(name, start, start + len(ids))
+                kind = self.kind(name)
+                if kind in ("int", "float", "bool"):
+                    values = values.tolist()
+                elif kind == "idlist":
+                    values = [ids_.tolist() for ids_ in values]
+                for record, value, here in zip(records, values, present):
+                    if here:
+                        record[name] = value
+            result.update(zip(ids, records))
+        return result
+
+    def to_frame(self, columns=None):
+        """
+        A DataFrame indexed by record key, built column by column.
+        """
+        import pandas as pd
+
+        columns = self.columns if columns is None else columns
+        data = {}
+        for name in columns:
+            values = self.read(name)
+            if self.kind(name) == "idlist":
+                values = [ids.tolist() for ids in values]
+            elif self.kind(name) in ("int", "bool") and not self.present(name).all():
+                values = np.where(self.present(name), values, np.nan)
+            data[name] = values
+        return pd.DataFrame(data, index=self.index(), columns=columns)
+
+
+def convert(fname_base):
+    """
+    Convert an existing .pkl.gz or .json.gz dict into a column store.
+    Its log is folded in and removed; the original blob is left in place.
+    """
+    import gzip
+
+    import dill
+
+    from segment_log import SegmentLog, replay_log
+
+    if os.path.isfile(fname_base + ".pkl.gz"):
+        with gzip.open(fname_base + ".pkl.gz", "rb") as pickle_file:
+            records = dill.load(pickle_file)
+    elif os.path.isfile(fname_base + ".json.gz"):
+        with gzip.open(fname_base + ".json.gz", "rt") as json_file:
+            records = ujson.load(json_file)
+    else:
+        records = {}
+    records = replay_log(records, fname_base)
+    if not records:
+        sys.stderr.write(f"ERROR: nothing to convert at {fname_base}\n")
+        return False
+    return SegmentLog(fname_base).fold(
+        lambda mark: write_columns(records, fname_base, mark)
+    )
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:]:
+        convert(name)
@@ -0,0 +1,66 @@
+"""
+Lazily loaded data shared by a module's functions, in place of data
+loaded into module globals at import time.
+
+Each module subclasses DataContext and marks its loaders with @lazy;
+a loader runs the first time its attribute is read and the result is
+kept on the instance.  For the web app, snapshot() loads everything up
+front so that a preloading gunicorn master can build it once and fork
+workers that share it copy-on-write (see gunicorn.conf.py).
+"""
+import gc
+
+
+class lazy:
+    """
+    Decorator for a DataContext loader; the loaded value replaces the
+    descriptor on the instance, so later reads are plain attribute reads.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.name = loader.__name__
+        self.__doc__ = loader.__doc__
+
+    def __get__(self, context, owner):
+        if context is None:
+            return self
+        value = self.loader(context)
+        context.__dict__[self.name] = value
+        return value
+
+
+class DataContext:
+    def loaders(self):
+        return [
+            name
+            for klass in type(self).__mro__
+            for name, attr in vars(klass).items()
+            if isinstance(attr, lazy)
+        ]
+
+    def loaded(self, name):
+        return name in self.__dict__
+
+    def reset(self, *names):
+        """
+        Forget loaded values (all of them by default) so that the next
+        read loads them again.
+        """
+        for name in names or self.loaders():
+            self.__dict__.pop(name, None)
+
+    def set(self, name, value):
+        self.__dict__[name] = value
+
+    def snapshot(self, names=None):
+        """
+        Load every value (or just `names`) now, then move everything
+        allocated so far out of the garbage collector's reach, so that
+        forked workers don't dirty the shared pages by scanning them.
+        """
+        for name in names or self.loaders():
+            getattr(self, name)
+        gc.collect()
+        gc.freeze()
+        return self
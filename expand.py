@@ -0,0 +1,389 @@
+import datetime as dt
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+import tweepy
+
+from adjacency import COUNT_KEYS
+from global_vars import EXPAND_WORKERS, RATE_LIMIT_WINDOW, RATE_LIMITS
+from instrument import counter
+
+API_CALLS = counter("api_calls_total", "REST API page requests by result")
+RATE_LIMIT_SLEEP = counter(
+    "rate_limit_sleep_seconds_total", "Time spent waiting on rate-limit buckets"
+)
+
+
+class RateLimited(Exception):
+    def __init__(self, reset_at=None):
+        super().__init__(reset_at)
+        self.reset_at = reset_at
+
+
+class Unavailable(Exception):
+    pass
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket modeled on a Twitter rate-limit window:
+    `capacity` requests per `window` seconds, refilled continuously.
+    """
+
+    def __init__(self, capacity, window=RATE_LIMIT_WINDOW, name=None):
+        self.name = name
+        self.capacity = capacity
+        self.rate = capacity / window
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.slept = 0.0
+        self.cond = threading.Condition()
+
+    def _refill(self, now):
+        if now < self.paused_until:
+            self.updated = now
+            return
+        elapsed = now - max(self.updated, self.paused_until)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+    def acquire(self, stopping=None):
+        """
+        Take a token, waiting for one if need be.  Returns False without
+        one if the event `stopping` is set first; whoever sets it should
+        call wake() so that waiters notice.
+        """
+        with self.cond:
+            while True:
+                if stopping is not None and stopping.is_set():
+                    return False
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    wait = (1 - self.tokens) / self.rate
+                # wait() can return early, on a notify or spuriously, so
+                # count the time actually spent
+                self.cond.wait(wait)
+                waited = time.monotonic() - now
+                self.slept += waited
+                RATE_LIMIT_SLEEP.inc(waited, endpoint=self.name)
+
+    def wake(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    def pause_until(self, reset_at):
+        """
+        Empty the bucket until the wall-clock time `reset_at`, as reported
+        by the API after we were rate limited anyway.
+        """
+        if reset_at is None:
+            delay = 1 / self.rate
+        else:
+            delay = max(0.0, reset_at - time.time())
+        with self.cond:
+            self.tokens = 0.0
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            self.cond.notify_all()
+
+
+def progress_key(user_id, count_key):
+    return f"{user_id}/{count_key}"
+
+
+def make_buckets(window=RATE_LIMIT_WINDOW):
+    return {
+        key: TokenBucket(limit, window, name=key) for key, limit in RATE_LIMITS.items()
+    }
+
+
+class TweepyFetcher:
+    """
+    Fetch one page of friend/follower ids through a tweepy API object.
+    The API should be built with wait_on_rate_limit=False so that the
+    engine's buckets do the scheduling.
+    """
+
+    def __init__(self, api):
+        self.endpoints = {"followers": api.followers_ids, "friends": api.friends_ids}
+
+    def fetch(self, count_key, user_id, cursor):
+        try:
+            ids, (_, next_cursor) = self.endpoints[count_key](
+                user_id=user_id, cursor=cursor
+            )
+        except tweepy.RateLimitError:
+            raise RateLimited()
+        except tweepy.TweepError as err:
+            raise Unavailable(str(err))
+        return ids, next_cursor
+
+
+class HttpFetcher:
+    """
+    Fetch pages straight from a v1.1-style REST endpoint, e.g. the local
+    server in fake_api.py.
+    """
+
+    def __init__(self, base_url, session=None):
+        self.base_url = base_url.rstrip("/")
+        self.session = session or requests.Session()
+
+    def fetch(self, count_key, user_id, cursor):
+        response = self.session.get(
+            f"{self.base_url}/1.1/{count_key}/ids.json",
+            params={"user_id": user_id, "cursor": cursor},
+        )
+        if response.status_code == 429:
+            reset_at = response.headers.get("x-rate-limit-reset")
+            raise RateLimited(int(reset_at) if reset_at else None)
+        if response.status_code != 200:
+            raise Unavailable(f"{response.status_code} for {user_id}")
+        payload = response.json()
+        return payload["ids"], payload["next_cursor"]
+
+
+class ExpansionEngine:
+    """
+    Expand the friends/followers of many users at once.  Every (user,
+    direction) pair is a job on a thread pool; each page request first
+    takes a token from that endpoint's bucket, and each page is added to
+    the adjacency store as soon as it arrives.  Without an adjacency
+    store, pages go to the user dictionary and its log instead; with
+    one, the user dictionary and its log hold no lists at all.
+
+    `progress` maps progress_key(user, direction) to the cursor of the
+    next page, how many ids are already stored, and when the last page
+    was fetched.  With a
+    `progress_log`, the lists are flushed after every page, the ids
+    before the cursor past them, so an interrupted run can be resumed
+    from the page it stopped at.
+    """
+
+    def __init__(
+        self,
+        fetcher,
+        user_dict,
+        user_log,
+        workers=EXPAND_WORKERS,
+        buckets=None,
+        adjacency=None,
+        progress=None,
+        progress_log=None,
+    ):
+        self.fetcher = fetcher
+        self.user_dict = user_dict
+        self.user_log = user_log
+        self.adjacency = adjacency
+        self.workers = workers
+        self.buckets = buckets or make_buckets()
+        self.progress = {} if progress is None else progress
+        self.progress_log = progress_log
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.stats = {
+            "users": 0,
+            "jobs": 0,
+            "pages": 0,
+            "requests": 0,
+            "rate_limited": 0,
+            "unavailable": 0,
+            "elapsed": 0.0,
+        }
+
+    def set_progress(self, user_id, count_key, cursor, stored):
+        key = progress_key(user_id, count_key)
+        self.progress[key] = {"cursor": cursor, "stored": stored, "at": time.time()}
+        if self.progress_log is not None:
+            self.progress_log.set(key, self.progress[key])
+
+    def store_page(self, user_id, count_key, ids, cursor):
+        with self.lock:
+            if self.adjacency is None:
+                self.user_log.extend(user_id, ids, field=count_key)
+                self.user_dict[user_id][count_key].extend(ids)
+            else:
+                self.adjacency.add(user_id, count_key, ids)
+            saved = self.progress.get(progress_key(user_id, count_key), {})
+            stored = saved.get("stored", 0) + len(ids)
+            self.set_progress(user_id, count_key, cursor, stored)
+            if self.progress_log is not None and self.flush_lists():
+                self.progress_log.flush()
+            self.stats["pages"] += 1
+
+    def flush_lists(self):
+        if not self.user_log.flush():
+            return False
+        return self.adjacency is None or self.adjacency.save()
+
+    def list_lengths(self, user_ids, count_key):
+        """
+        How many ids are stored for each user's list: in the adjacency
+        store if there is one (the user dictionary then has no lists),
+        else in the user dictionary.
+        """
+        if self.adjacency is None:
+            return [len(self.user_dict[user_id][count_key]) for user_id in user_ids]
+        return self.adjacency.degrees_of([int(u) for u in user_ids], count_key)
+
+    def restart(self, user_ids, count_keys=COUNT_KEYS):
+        """
+        Fetch these users' lists again, from the first page, on the next
+        run(); resume() cuts what is stored of them back to nothing.
+        """
+        for user_id in user_ids:
+            for count_key in count_keys:
+                self.set_progress(user_id, count_key, -1, 0)
+
+    def last_fetched(self, user_id, count_keys=COUNT_KEYS):
+        """
+        When the user's lists were last fetched, or 0 if some list has
+        never been, as far as the saved progress knows.
+        """
+        saved = [self.progress.get(progress_key(user_id, key)) for key in count_keys]
+        return min(entry.get("at", 0) if entry else 0 for entry in saved)
+
+    def resume(self, user_ids, count_keys):
+        """
+        Cut each list back to the ids its saved progress counts (pages
+        written after the last saved cursor will be fetched again), or
+        to nothing if it has none, in the adjacency store, or else in the
+        user dictionary and its log.
+        """
+        for count_key in count_keys:
+            lengths = self.list_lengths(user_ids, count_key)
+            for user_id, length in zip(user_ids, lengths):
+                saved = self.progress.get(progress_key(user_id, count_key))
+                stored = saved["stored"] if saved else 0
+                if length < stored:
+                    print(f"(id={user_id}) lost {count_key} pages, starting over")
+                    stored = 0
+                    self.set_progress(user_id, count_key, -1, 0)
+                if length <= stored:
+                    continue
+                if self.adjacency is None:
+                    del self.user_dict[user_id][count_key][stored:]
+                    kept = list(self.user_dict[user_id][count_key])
+                    self.user_log.set(user_id, kept, field=count_key)
+                else:
+                    self.adjacency.truncate(user_id, count_key, stored)
+        # lists before progress, as after every page
+        if self.flush_lists() and self.progress_log is not None:
+            self.progress_log.flush()
+
+    def expand_user_list(self, user_id, count_key):
+        bucket = self.buckets[count_key]
+        saved = self.progress.get(progress_key(user_id, count_key), {})
+        cursor = saved.get("cursor", -1)
+        while cursor != 0:
+            if not bucket.acquire(self.stopping):
+                return False
+            with self.lock:
+                self.stats["requests"] += 1
+            try:
+                ids, cursor = self.fetcher.fetch(count_key, user_id, cursor)
+            except RateLimited as err:
+                API_CALLS.inc(endpoint=count_key, result="rate_limited")
+                with self.lock:
+                    self.stats["rate_limited"] += 1
+                bucket.pause_until(err.reset_at)
+                continue
+            except Unavailable:
+                API_CALLS.inc(endpoint=count_key, result="unavailable")
+                print(f"(id={user_id}) {count_key} unavailable, skipping")
+                with self.lock:
+                    self.stats["unavailable"] += 1
+                return False
+            API_CALLS.inc(endpoint=count_key, result="ok")
+            self.store_page(user_id, count_key, ids, cursor)
+        return True
+
+    def run(self, user_ids, count_keys=COUNT_KEYS):
+        start = time.monotonic()
+        self.resume(user_ids, count_keys)
+        remaining = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {}
+            for user_id in user_ids:
+                remaining[user_id] = len(count_keys)
+                for count_key in count_keys:
+                    future = pool.submit(self.expand_user_list, user_id, count_key)
+                    futures[future] = user_id
+            try:
+                for future in as_completed(futures):
+                    self.job_done(future, futures[future], remaining)
+            except BaseException:
+                # workers finish the page they are on; jobs not started
+                # yet never start
+                self.stop()
+                for future in futures:
+                    future.cancel()
+                raise
+        if self.adjacency is not None and self.adjacency.has_pending():
+            self.adjacency.save()
+        self.stats["elapsed"] = time.monotonic() - start
+        self.stats["slept"] = {key: b.slept for key, b in self.buckets.items()}
+        return self.stats
+
+    def stop(self):
+        """
+        Make every job stop before its next page, including jobs waiting
+        on a bucket.
+        """
+        self.stopping.set()
+        for bucket in self.buckets.values():
+            bucket.wake()
+
+    def job_done(self, future, user_id, remaining):
+        try:
+            future.result()
+        except Exception as err:
+            sys.stderr.write(f"Failed expanding {user_id}: {err}\n")
+        with self.lock:
+            self.stats["jobs"] += 1
+            remaining[user_id] -= 1
+            if remaining[user_id] == 0:
+                self.stats["users"] += 1
+                if not self.user_log.flush():
+                    sys.stderr.write(
+                        f"failed to pickle after processing user {user_id}"
+                    )
+                if self.stats["users"] % 100 == 0:
+                    now = dt.datetime.now().strftime("%a, %b %d %I:%M %p")
+                    print(f"({now}) Expanded {self.stats['users']} users")
+
+    def users_per_window(self, window=RATE_LIMIT_WINDOW):
+        if not self.stats["elapsed"]:
+            return 0.0
+        return self.stats["users"] * window / self.stats["elapsed"]
+
+
+def main():
+    import fake_api
+    from segment_log import NullLog
+
+    window = 15
+    server = fake_api.serve(port=0, window=window)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    users = {str(uid): {"followers": [], "friends": []} for uid in range(1, 51)}
+
+    engine = ExpansionEngine(
+        HttpFetcher(base_url), users, NullLog(), buckets=make_buckets(window)
+    )
+    stats = engine.run(list(users))
+    server.shutdown()
+    print(stats)
+    print(f"{engine.users_per_window(window):.1f} users expanded per window")
+
+
+if __name__ == "__main__":
+    main()
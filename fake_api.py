@@ -0,0 +1,202 @@
+"""
+A local stand-in for the v1.1 friends/ids and followers/ids endpoints,
+enforcing the same per-window rate limits, and for the statuses/filter
+streaming endpoint.  Used to measure the expansion engine in expand.py
+and the sharded streamer in shard_stream.py without spending real API
+calls.
+"""
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from global_vars import RATE_LIMIT_WINDOW, RATE_LIMITS
+
+PAGE_SIZE = 5000
+MAX_NEIGHBORS = 20000
+PROTECTED_EVERY = 17
+STREAM_INTERVAL = 0.01
+
+
+def neighbor_ids(user_id, count_key):
+    rng = random.Random(f"{user_id}-{count_key}")
+    num = int(rng.paretovariate(1.2) * 50) % MAX_NEIGHBORS
+    return [rng.randrange(1, 10 ** 9) for _ in range(num)]
+
+
+def fake_tweet(rng, user_id):
+    tweet_id = rng.randrange(1, 2 ** 62)
+    return {
+        "id": tweet_id,
+        "id_str": str(tweet_id),
+        "created_at": time.strftime("%a %b %d %H:%M:%S +0000 %Y", time.gmtime()),
+        "text": f"fake tweet {tweet_id} from {user_id}",
+        "user": {
+            "id": int(user_id),
+            "id_str": str(user_id),
+            "screen_name": f"user{user_id}",
+            "followers_count": len(neighbor_ids(user_id, "followers")),
+            "friends_count": len(neighbor_ids(user_id, "friends")),
+        },
+    }
+
+
+class RateWindow:
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.reset_at = time.time() + window
+        self.remaining = limit
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.time()
+            if now >= self.reset_at:
+                self.reset_at = now + self.window
+                self.remaining = self.limit
+            if self.remaining == 0:
+                return False, 0, self.reset_at
+            self.remaining -= 1
+            return True, self.remaining, self.reset_at
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def write_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def send_json(self, status, payload, window_state):
+        _, remaining, reset_at = window_state
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("x-rate-limit-limit", str(self.server.limits[self.count_key]))
+        self.send_header("x-rate-limit-remaining", str(remaining))
+        self.send_header("x-rate-limit-reset", str(int(reset_at) + 1))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        if len(parts) != 3 or parts[1] not in self.server.windows:
+            self.send_error(404)
+            return
+        self.count_key = parts[1]
+        params = parse_qs(url.query)
+        user_id = params.get("user_id", ["0"])[0]
+        cursor = int(params.get("cursor", ["-1"])[0])
+
+        window_state = self.server.windows[self.count_key].take()
+        if not window_state[0]:
+            self.server.count("rate_limited")
+            error = {"errors": [{"code": 88, "message": "Rate limit exceeded"}]}
+            self.send_json(429, error, window_state)
+            return
+        self.server.count("requests")
+        if int(user_id) % PROTECTED_EVERY == 0:
+            error = {"errors": [{"code": 179, "message": "Not authorized."}]}
+            self.send_json(401, error, window_state)
+            return
+
+        ids = neighbor_ids(user_id, self.count_key)
+        start = 0 if cursor == -1 else cursor
+        end = start + PAGE_SIZE
+        payload = {
+            "ids": ids[start:end],
+            "next_cursor": end if end < len(ids) else 0,
+            "previous_cursor": -start if start else 0,
+        }
+        self.send_json(200, payload, window_state)
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/1.1/statuses/filter.json":
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length).decode())
+        follow = form.get("follow", [""])[0].split(",")
+        follow = [user_id for user_id in follow if user_id]
+        if not follow:
+            self.send_error(406)
+            return
+
+        self.server.count("streams")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        rng = random.Random(",".join(follow[:3]))
+        try:
+            while not self.server.closing:
+                # most followed users are quiet; only a few tweet
+                if rng.random() < self.server.tweet_prob:
+                    tweet = fake_tweet(rng, rng.choice(follow))
+                    self.write_chunk(json.dumps(tweet).encode() + b"\r\n")
+                else:
+                    self.write_chunk(b"\r\n")
+                time.sleep(STREAM_INTERVAL)
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        self.close_connection = True
+
+
+class FakeApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self, address, window=RATE_LIMIT_WINDOW, limits=None, tweet_prob=0.5
+    ):
+        super().__init__(address, FakeApiHandler)
+        self.limits = limits or RATE_LIMITS
+        self.windows = {
+            key: RateWindow(limit, window) for key, limit in self.limits.items()
+        }
+        self.tweet_prob = tweet_prob
+        self.closing = False
+        self.counts = {"requests": 0, "rate_limited": 0, "streams": 0}
+        self.counts_lock = threading.Lock()
+
+    def shutdown(self):
+        self.closing = True
+        super().shutdown()
+
+    def count(self, key):
+        with self.counts_lock:
+            self.counts[key] += 1
+
+    def handle_error(self, request, client_address):
+        # clients hanging up, e.g. closing their connection pool, are
+        # not errors
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def serve(port=0, window=RATE_LIMIT_WINDOW, limits=None, tweet_prob=0.5):
+    """
+    Start a fake API server on a background thread and return it; call
+    shutdown() on the result to stop it.
+    """
+    server = FakeApiServer(
+        ("127.0.0.1", port), window=window, limits=limits, tweet_prob=tweet_prob
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    server = FakeApiServer(("127.0.0.1", 8088))
+    print("Serving fake friends/followers API on http://127.0.0.1:8088")
+    server.serve_forever()
@@ -0,0 +1,195 @@
+"""
+A local stand-in for a Mastodon instance: the streaming API (as
+server-sent events) and the paged followers/following endpoints, with
+one rate-limit window for every request.  Used to exercise the Mastodon
+backend in mastodon_backend.py without touching a real instance.
+"""
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from fake_api import PROTECTED_EVERY, RateWindow, neighbor_ids
+from global_vars import MAST_RATE_LIMIT, MAST_RATE_WINDOW
+
+STREAM_INTERVAL = 0.02
+HEARTBEAT_EVERY = 50
+REBLOG_PROB = 0.2
+NUM_ACCOUNTS = 10 ** 6
+COUNT_KEYS = {"followers": "followers", "following": "friends"}
+
+
+def iso_time(seconds):
+    return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(seconds))
+
+
+def fake_account(local_id):
+    return {
+        "id": str(local_id),
+        "username": f"user{local_id}",
+        "acct": f"user{local_id}",
+        "display_name": f"User {local_id}",
+        "followers_count": len(neighbor_ids(local_id, "followers")),
+        "following_count": len(neighbor_ids(local_id, "friends")),
+        "statuses_count": 0,
+        "created_at": "2019-01-01T00:00:00.000Z",
+    }
+
+
+def fake_status(rng, domain, reblog=True):
+    local_id = rng.randrange(1, NUM_ACCOUNTS)
+    status_id = rng.randrange(1, 2 ** 62)
+    status = {
+        "id": str(status_id),
+        "uri": f"https://{domain}/users/user{local_id}/statuses/{status_id}",
+        "created_at": iso_time(time.time()),
+        "content": f"<p>fake status {status_id} from user{local_id}</p>",
+        "language": "en",
+        "account": fake_account(local_id),
+        "reblog": None,
+    }
+    if reblog and rng.random() < REBLOG_PROB:
+        status["reblog"] = fake_status(rng, domain, reblog=False)
+        status["content"] = ""
+    return status
+
+
+class FakeMastodonHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def write_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def send_json(self, status, payload, headers=()):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        if parts[:3] == ["api", "v1", "streaming"]:
+            self.stream(url)
+        elif len(parts) == 5 and parts[:3] == ["api", "v1", "accounts"]:
+            self.neighbors(url, parts[3], parts[4])
+        else:
+            self.send_error(404)
+
+    def neighbors(self, url, local_id, endpoint):
+        if endpoint not in COUNT_KEYS or not local_id.isdigit():
+            self.send_error(404)
+            return
+        allowed, remaining, reset_at = self.server.window.take()
+        rate_headers = (
+            ("X-RateLimit-Limit", str(self.server.window.limit)),
+            ("X-RateLimit-Remaining", str(remaining)),
+            ("X-RateLimit-Reset", iso_time(reset_at + 1)),
+        )
+        if not allowed:
+            self.server.count("rate_limited")
+            self.send_json(429, {"error": "Too many requests"}, rate_headers)
+            return
+        self.server.count("requests")
+        if int(local_id) % PROTECTED_EVERY == 0:
+            self.send_json(404, {"error": "Record not found"}, rate_headers)
+            return
+
+        params = parse_qs(url.query)
+        limit = int(params.get("limit", ["40"])[0])
+        start = int(params.get("max_id", ["0"])[0])
+        ids = neighbor_ids(local_id, COUNT_KEYS[endpoint])
+        end = start + limit
+        headers = rate_headers
+        if end < len(ids):
+            next_url = (
+                f"http://{self.server.domain}{url.path}?limit={limit}&max_id={end}"
+            )
+            headers += (("Link", f'<{next_url}>; rel="next"'),)
+        accounts = [fake_account(other % NUM_ACCOUNTS) for other in ids[start:end]]
+        self.send_json(200, accounts, headers)
+
+    def stream(self, url):
+        self.server.count("streams")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        rng = random.Random(url.path + url.query)
+        try:
+            sent = 0
+            while not self.server.closing:
+                if rng.random() < self.server.status_prob:
+                    status = json.dumps(fake_status(rng, self.server.domain))
+                    self.write_chunk(f"event: update\ndata: {status}\n\n".encode())
+                sent += 1
+                if sent % HEARTBEAT_EVERY == 0:
+                    self.write_chunk(b":thump\n")
+                time.sleep(STREAM_INTERVAL)
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        self.close_connection = True
+
+
+class FakeMastodonServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address,
+        window=MAST_RATE_WINDOW,
+        limit=MAST_RATE_LIMIT,
+        status_prob=0.5,
+    ):
+        super().__init__(address, FakeMastodonHandler)
+        self.domain = "%s:%d" % self.server_address[:2]
+        self.window = RateWindow(limit, window)
+        self.status_prob = status_prob
+        self.closing = False
+        self.counts = {"requests": 0, "rate_limited": 0, "streams": 0}
+        self.counts_lock = threading.Lock()
+
+    def shutdown(self):
+        self.closing = True
+        super().shutdown()
+
+    def count(self, key):
+        with self.counts_lock:
+            self.counts[key] += 1
+
+    def handle_error(self, request, client_address):
+        # clients hanging up, e.g. closing their connection pool, are
+        # not errors
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def serve(port=0, window=MAST_RATE_WINDOW, limit=MAST_RATE_LIMIT, status_prob=0.5):
+    """
+    Start a fake instance on a background thread and return it; call
+    shutdown() on the result to stop it.
+    """
+    server = FakeMastodonServer(
+        ("127.0.0.1", port), window=window, limit=limit, status_prob=status_prob
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    server = FakeMastodonServer(("127.0.0.1", 8089))
+    print("Serving fake Mastodon instance on http://127.0.0.1:8089")
+    server.serve_forever()
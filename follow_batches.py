@@ -0,0 +1,125 @@
+"""
+Pack the users to stream into as few follow-filter batches as possible.
+
+Every seed user's friends and followers overlap heavily, so instead of
+one stream per seed, the union of all their ids is deduplicated and
+packed into batches of at most FOLLOW_LIMIT ids.  In plain order the
+ids are chunked in the order their seeds list them, which already gives
+the minimum number of batches.  By community, whole communities (from
+label propagation over the friend/follower graph) are packed first-fit
+decreasing, so related users tend to share a stream at the cost of at
+most a few extra batches.
+"""
+import numpy as np
+
+from adjacency import COUNT_KEYS
+from global_vars import COMMUNITY_ITERATIONS, FOLLOW_LIMIT
+
+
+def seed_order(adjacency, seed_ids):
+    """
+    Adjacency indices of the seeds and everyone they list, deduplicated,
+    in order of first appearance: each seed, then its neighbors.
+    """
+    seed_idx = adjacency.index_of(seed_ids)
+    seed_idx = seed_idx[seed_idx >= 0]
+    groups = [seed_idx]
+    members = [seed_idx]
+    for key in COUNT_KEYS:
+        srcs, others = adjacency.edge_indices(key, seed_idx)
+        groups.append(srcs.astype(np.int64))
+        members.append(others.astype(np.int64))
+    groups = np.concatenate(groups)
+    members = np.concatenate(members)
+    # seeds come before their neighbors within a group
+    rank = np.ones(len(members), dtype=np.int8)
+    rank[: len(seed_idx)] = 0
+    members = members[np.lexsort((rank, groups))]
+    _, first = np.unique(members, return_index=True)
+    return members[np.sort(first)]
+
+
+def label_communities(adjacency, iterations=COMMUNITY_ITERATIONS):
+    """
+    Community label for every node in the adjacency store, by
+    synchronous label propagation over the undirected friend/follower
+    graph.  Every node also votes for its own label, which keeps the
+    labels from oscillating on the (nearly bipartite) seed graph; ties
+    go to the smallest label.
+    """
+    num_nodes = len(adjacency)
+    srcs = [np.arange(num_nodes, dtype=np.int64)]
+    dsts = [np.arange(num_nodes, dtype=np.int64)]
+    for key in COUNT_KEYS:
+        users, others = adjacency.edge_indices(key)
+        srcs += [users.astype(np.int64), others.astype(np.int64)]
+        dsts += [others.astype(np.int64), users.astype(np.int64)]
+    srcs = np.concatenate(srcs)
+    dsts = np.concatenate(dsts)
+
+    labels = np.arange(num_nodes, dtype=np.int64)
+    for _ in range(iterations):
+        votes = srcs * num_nodes + labels[dsts]
+        votes, counts = np.unique(votes, return_counts=True)
+        nodes, voted = votes // num_nodes, votes % num_nodes
+        order = np.lexsort((voted, -counts, nodes))
+        winners = order[np.r_[True, nodes[order][1:] != nodes[order][:-1]]]
+        new_labels = labels.copy()
+        new_labels[nodes[winners]] = voted[winners]
+        if (new_labels == labels).all():
+            break
+        labels = new_labels
+    return labels
+
+
+def pack_batches(members, communities=None, limit=FOLLOW_LIMIT):
+    """
+    Split `members` into batches of at most `limit`.  Without
+    `communities` (one label per member) they are chunked in order;
+    with them, communities are split into `limit`-sized pieces and the
+    pieces packed first-fit decreasing.
+    """
+    if communities is None:
+        starts = range(0, len(members), limit)
+        return [members[start : start + limit] for start in starts]
+
+    order = np.argsort(communities, kind="stable")
+    members = members[order]
+    bounds = np.flatnonzero(np.diff(communities[order])) + 1
+    pieces = []
+    for community in np.split(members, bounds):
+        for start in range(0, len(community), limit):
+            pieces.append(community[start : start + limit])
+    pieces.sort(key=len, reverse=True)
+
+    batches = []
+    room = np.zeros(0, dtype=np.int64)
+    for piece in pieces:
+        fits = np.flatnonzero(room >= len(piece))
+        if len(fits):
+            batches[fits[0]].append(piece)
+            room[fits[0]] -= len(piece)
+        else:
+            batches.append([piece])
+            room = np.append(room, limit - len(piece))
+    return [np.concatenate(batch) for batch in batches]
+
+
+def follow_batches(adjacency, seed_ids, by_community=False, limit=FOLLOW_LIMIT):
+    """
+    Follow-filter batches covering `seed_ids` and everyone they list,
+    as a dict of batch key to set of id strings.
+    """
+    members = seed_order(adjacency, seed_ids)
+    communities = None
+    if by_community:
+        communities = label_communities(adjacency)[members]
+    batches = pack_batches(members, communities, limit)
+    print(
+        f"Packed {len(members)} users from {len(seed_ids)} seeds "
+        f"into {len(batches)} batches"
+    )
+    return {
+        f"batch{i:05d}": set(map(str, adjacency.nodes[batch].tolist()))
+        for i, batch in enumerate(batches)
+    }
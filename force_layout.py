@@ -0,0 +1,320 @@
+"""
+In-process force-directed layout, in place of Graphviz's sfdp.
+
+Nodes repel each other with force k**2 / d and edges pull their ends
+together with force d**2 / k (Fruchterman-Reingold, with k = 1), plus a
+weak pull towards the centre so separate components stay in view.
+Repulsion is approximated Barnes-Hut style over a quadtree of regular
+grids: nodes in a node's own and neighbouring leaf cells repel it
+exactly, and at every coarser level the cells that are children of its
+parent cell's neighbours, but not neighbours of its own cell, act
+through their total mass at their centre of mass.  Every step is a few
+whole-array NumPy operations per level.
+
+Large graphs are laid out multilevel: nodes are matched along edges
+into a hierarchy of coarser graphs, the coarsest is laid out from
+random positions, and each finer level starts from its parent's
+positions and only needs a few iterations.
+
+Given the positions of a previous version of the graph, force_layout()
+keeps them, places new nodes next to their placed neighbours, and
+iterates only the new nodes and their neighbours for long before a
+short, cool pass over everything, so the layout doesn't jump.
+"""
+import numpy as np
+
+from global_vars import (FORCE_COARSEST, FORCE_GRAVITY, FORCE_ITERATIONS,
+                         FORCE_LEAF_SIZE, FORCE_REFINE_ITERATIONS,
+                         FORCE_WARM_FRACTION, FORCE_WARM_ITERATIONS)
+
+COARSEN_RATIO = 0.9
+MATCH_ROUNDS = 4
+MAX_EXTRA_DEPTH = 3
+MIN_DIST2 = 1e-4
+PLACE_ROUNDS = 5
+
+
+def _grid_depth(pos, origin, span, leaf_size):
+    """
+    Depth of the leaf grid: deep enough for about `leaf_size` nodes a
+    cell, and deeper (up to MAX_EXTRA_DEPTH levels) while crowded cells
+    would make the exact near-field sums too big.
+    """
+    depth = max(2, int(np.ceil(np.log(max(len(pos) / leaf_size, 1)) / np.log(4))))
+    for extra in range(MAX_EXTRA_DEPTH + 1):
+        side = 2 ** (depth + extra)
+        cells = np.clip(((pos - origin) / span * side).astype(np.int64), 0, side - 1)
+        counts = np.bincount(cells[:, 0] * side + cells[:, 1], minlength=side * side)
+        if (counts ** 2).sum() <= 2 * leaf_size * len(pos):
+            break
+    return depth + extra, cells, counts
+
+
+def repulsion(pos, mass, targets=None, leaf_size=FORCE_LEAF_SIZE):
+    """
+    Approximate repulsive force from every node, weighted by its mass, on
+    every other node or only on the nodes indexed by `targets`.
+    """
+    num_nodes = len(pos)
+    if targets is None:
+        targets = np.arange(num_nodes)
+    force = np.zeros((len(targets), 2))
+    if num_nodes < 2:
+        return force
+    origin = pos.min(axis=0)
+    span = max(np.ptp(pos, axis=0).max(), 1e-9) * (1 + 1e-9)
+    depth, cells, counts = _grid_depth(pos, origin, span, leaf_size)
+    pos_x, pos_y = pos[:, 0].copy(), pos[:, 1].copy()
+    at_x, at_y = pos_x[targets], pos_y[targets]
+    force_x, force_y = np.zeros(len(targets)), np.zeros(len(targets))
+
+    # far field: for each level, the 6x6 children of the parent's 3x3
+    # neighbourhood, less the 3x3 neighbourhood of the node's own cell
+    for level in range(2, depth + 1):
+        side = 2 ** level
+        own_x = cells[:, 0] >> (depth - level)
+        own_y = cells[:, 1] >> (depth - level)
+        flat = own_x * side + own_y
+        cell_mass = np.bincount(flat, weights=mass, minlength=side * side)
+        scale = 1 / np.maximum(cell_mass, 1e-12)
+        centre_x = np.bincount(flat, weights=mass * pos_x, minlength=side * side)
+        centre_y = np.bincount(flat, weights=mass * pos_y, minlength=side * side)
+        centre_x *= scale
+        centre_y *= scale
+        own_x, own_y = own_x[targets], own_y[targets]
+        base_x = (own_x >> 1) * 2 - 2
+        base_y = (own_y >> 1) * 2 - 2
+        for i in range(6):
+            cell_x = base_x + i
+            inside_x = (cell_x >= 0) & (cell_x < side)
+            far_x = np.abs(cell_x - own_x) > 1
+            for j in range(6):
+                cell_y = base_y + j
+                valid = inside_x & (cell_y >= 0) & (cell_y < side)
+                valid &= far_x | (np.abs(cell_y - own_y) > 1)
+                target = np.where(valid, cell_x * side + cell_y, 0)
+                delta_x = at_x - centre_x[target]
+                delta_y = at_y - centre_y[target]
+                dist2 = np.maximum(delta_x * delta_x + delta_y * delta_y, MIN_DIST2)
+                weight = np.where(valid, cell_mass[target], 0.0) / dist2
+                force_x += delta_x * weight
+                force_y += delta_y * weight
+
+    # near field: every pair in neighbouring leaf cells, exactly
+    side = 2 ** depth
+    flat = cells[:, 0] * side + cells[:, 1]
+    order = np.argsort(flat, kind="stable")
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    at = np.arange(len(targets))
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            cell_x = cells[targets, 0] + dx
+            cell_y = cells[targets, 1] + dy
+            valid = (cell_x >= 0) & (cell_x < side) & (cell_y >= 0) & (cell_y < side)
+            target = np.where(valid, cell_x * side + cell_y, 0)
+            num = np.where(valid, counts[target], 0)
+            total = num.sum()
+            if total == 0:
+                continue
+            src = np.repeat(at, num)
+            offsets = np.arange(total) - np.repeat(np.cumsum(num) - num, num)
+            dst = order[np.repeat(starts[target], num) + offsets]
+            distinct = targets[src] != dst
+            src, dst = src[distinct], dst[distinct]
+            delta_x = at_x[src] - pos_x[dst]
+            delta_y = at_y[src] - pos_y[dst]
+            dist2 = np.maximum(delta_x * delta_x + delta_y * delta_y, MIN_DIST2)
+            weight = mass[dst] / dist2
+            force_x += np.bincount(src, delta_x * weight, minlength=len(targets))
+            force_y += np.bincount(src, delta_y * weight, minlength=len(targets))
+    force[:, 0] = force_x
+    force[:, 1] = force_y
+    return force
+
+
+def attraction(pos, edges, weights):
+    force = np.zeros_like(pos)
+    if len(edges) == 0:
+        return force
+    delta = pos[edges[:, 0]] - pos[edges[:, 1]]
+    dist = np.sqrt((delta ** 2).sum(axis=1))
+    pull = delta * (weights * dist)[:, None]
+    for axis in (0, 1):
+        force[:, axis] -= np.bincount(edges[:, 0], pull[:, axis], minlength=len(pos))
+        force[:, axis] += np.bincount(edges[:, 1], pull[:, axis], minlength=len(pos))
+    return force
+
+
+def iterate(pos, mass, edges, weights, iterations, temperature, moving=None):
+    """
+    Move the nodes (or only the `moving` ones) by their net force for
+    `iterations` steps, each step capped by a temperature cooling
+    linearly from `temperature`.
+    """
+    pos = pos.copy()
+    targets = None
+    if moving is not None:
+        targets = np.flatnonzero(moving)
+        pulling = moving[edges[:, 0]] | moving[edges[:, 1]]
+        edges, weights = edges[pulling], weights[pulling]
+    for step in range(iterations):
+        limit = temperature * (1 - step / iterations)
+        force = attraction(pos, edges, weights)
+        centre = (pos * mass[:, None]).sum(axis=0) / mass.sum()
+        force += FORCE_GRAVITY * mass[:, None] * (centre - pos)
+        if targets is None:
+            force += repulsion(pos, mass)
+        else:
+            force = force[targets] + repulsion(pos, mass, targets)
+        length = np.maximum(np.sqrt((force ** 2).sum(axis=1)), 1e-12)
+        shift = force * (np.minimum(length, limit) / length)[:, None]
+        if targets is None:
+            pos += shift
+        else:
+            pos[targets] += shift
+    return pos
+
+
+def _pick_neighbours(num_nodes, both, rng):
+    """
+    A random neighbour out of the (node, neighbour) pairs `both` for each
+    node, or the node itself if it has none.
+    """
+    picked = np.arange(num_nodes)
+    if len(both):
+        both = both[np.lexsort((rng.random(len(both)), both[:, 0]))]
+        last = np.flatnonzero(np.append(both[1:, 0] != both[:-1, 0], True))
+        picked[both[last, 0]] = both[last, 1]
+    return picked
+
+
+def _match(num_nodes, edges, rng):
+    """
+    One level of coarsening.  For a few rounds, each unmatched node
+    proposes to a random unmatched neighbour and mutual proposals are
+    merged; nodes still unmatched then join a random neighbour's group.
+    Returns each node's coarse node and the number of coarse nodes.
+    """
+    both = np.concatenate((edges, edges[:, ::-1]))
+    nodes = np.arange(num_nodes)
+    leader = nodes.copy()
+    matched = np.zeros(num_nodes, dtype=bool)
+    for _ in range(MATCH_ROUNDS):
+        free = both[~matched[both[:, 0]] & ~matched[both[:, 1]]]
+        if len(free) == 0:
+            break
+        proposal = _pick_neighbours(num_nodes, free, rng)
+        mutual = (proposal[proposal] == nodes) & (proposal != nodes)
+        leader[mutual] = np.minimum(nodes, proposal)[mutual]
+        matched |= mutual
+    alone = ~matched
+    leader[alone] = leader[_pick_neighbours(num_nodes, both, rng)[alone]]
+    leaders, parent = np.unique(leader, return_inverse=True)
+    return parent, len(leaders)
+
+
+def _coarse_edges(parent, num_coarse, edges, weights):
+    ends = parent[edges]
+    between = ends[:, 0] != ends[:, 1]
+    ends = np.sort(ends[between], axis=1)
+    keys, inverse = np.unique(ends[:, 0] * num_coarse + ends[:, 1], return_inverse=True)
+    coarse = np.stack((keys // num_coarse, keys % num_coarse), axis=1)
+    return coarse, np.bincount(inverse, weights[between], minlength=len(keys))
+
+
+def multilevel(num_nodes, edges, rng, iterations=FORCE_ITERATIONS):
+    """
+    Positions for `num_nodes` nodes and undirected `edges`, from scratch.
+    """
+    weights = np.ones(len(edges))
+    mass = np.ones(num_nodes)
+    levels = []
+    while num_nodes > FORCE_COARSEST:
+        parent, num_coarse = _match(num_nodes, edges, rng)
+        if num_coarse > COARSEN_RATIO * num_nodes:
+            break
+        levels.append((parent, edges, weights, mass))
+        edges, weights = _coarse_edges(parent, num_coarse, edges, weights)
+        mass = np.bincount(parent, mass, minlength=num_coarse)
+        num_nodes = num_coarse
+
+    extent = np.sqrt(mass.sum())
+    pos = rng.random((num_nodes, 2)) * extent
+    pos = iterate(pos, mass, edges, weights, iterations, extent / 4)
+    for parent, edges, weights, mass in reversed(levels):
+        pos = pos[parent] + rng.normal(0, 0.1, (len(parent), 2))
+        pos = iterate(pos, mass, edges, weights, FORCE_REFINE_ITERATIONS, 2.0)
+    return pos
+
+
+def _place_new(pos, placed, edges, rng):
+    """
+    Put unplaced nodes at the mean of their placed neighbours, spreading
+    out from the placed part of the graph; anything left over goes near
+    the centre.
+    """
+    placed = placed.copy()
+    both = np.concatenate((edges, edges[:, ::-1]))
+    for _ in range(PLACE_ROUNDS):
+        reach = placed[both[:, 1]] & ~placed[both[:, 0]]
+        src, dst = both[reach, 0], both[reach, 1]
+        if len(src) == 0:
+            break
+        num = np.bincount(src, minlength=len(pos))
+        newly = num > 0
+        for axis in (0, 1):
+            total = np.bincount(src, pos[dst, axis], minlength=len(pos))
+            pos[newly, axis] = total[newly] / num[newly]
+        pos[newly] += rng.normal(0, 0.5, (newly.sum(), 2))
+        placed |= newly
+    centre = pos[placed].mean(axis=0)
+    spread = max(pos[placed].std(), 1.0)
+    pos[~placed] = centre + rng.normal(0, spread, ((~placed).sum(), 2))
+    return pos
+
+
+def force_layout(graph, previous=None, iterations=FORCE_ITERATIONS, seed=0):
+    """
+    {node: (x, y)} for a networkx graph, like graphviz_layout, so it can
+    be handed to bokeh's from_networkx.  `previous` is an earlier
+    layout, e.g. of the graph's last version, to start from; the result
+    is in its coordinates.
+    """
+    nodes = list(graph)
+    if not nodes:
+        return {}
+    index = {node: i for i, node in enumerate(nodes)}
+    edges = np.array(
+        [(index[u], index[v]) for u, v in graph.edges() if u != v], dtype=np.int64
+    ).reshape(-1, 2)
+    if len(edges):
+        edges = np.unique(np.sort(edges, axis=1), axis=0)
+    rng = np.random.Generator(np.random.PCG64(seed))
+
+    previous = previous or {}
+    known = np.array([node in previous for node in nodes], dtype=bool)
+    if known.mean() < FORCE_WARM_FRACTION:
+        return dict(zip(nodes, map(tuple, multilevel(len(nodes), edges, rng).tolist())))
+
+    pos = np.array([previous.get(node, (0.0, 0.0)) for node in nodes], dtype=float)
+    # rescale to where the forces on the old layout balance, which
+    # minimises sum(d**3) / 3 - sum over pairs of log(d), and back at the end
+    old_edges = edges[known[edges[:, 0]] & known[edges[:, 1]]]
+    scale = 1.0
+    if len(old_edges):
+        lengths = np.sqrt(((pos[old_edges[:, 0]] - pos[old_edges[:, 1]]) ** 2).sum(1))
+        num_known = known.sum()
+        pairs = num_known * (num_known - 1) / 2
+        scale = max((pairs / max((lengths ** 3).sum(), 1e-12)) ** (1 / 3), 1e-9)
+    pos *= scale
+    pos = _place_new(pos, known, edges, rng)
+
+    mass = np.ones(len(nodes))
+    weights = np.ones(len(edges))
+    moving = ~known
+    touched = moving[edges[:, 0]] | moving[edges[:, 1]]
+    moving[edges[touched].ravel()] = True
+    if moving.any():
+        pos = iterate(pos, mass, edges, weights, iterations, 2.0, moving=moving)
+    pos = iterate(pos, mass, edges, weights, FORCE_WARM_ITERATIONS, 0.5)
+    return dict(zip(nodes, map(tuple, (pos / scale).tolist())))
@@ -2,12 +2,112 @@ from itertools import count
 
 NUM_TWEETS_TO_GRAB = 10000
 TWEETS_FNAME = "tweet_dict"
+TWEET_ROLLUP_FNAME = "tweet_rollups"
+TWEET_STORE_FNAME = "tweet_store"
 USER_DICT_FNAME = "users_dict"
 USER_LIST_FNAME = "users"
 USER_GRAPH_FNAME = "user_graph"
+FULL_GRAPH_FNAME = "full_graph"
+CENTRALITY_FNAME = "centrality"
 USER_FRAME_FNAME = "user_frame"
+ADJACENCY_FNAME = "adjacency"
+EXPAND_PROGRESS_FNAME = "expand_progress"
+SNAPSHOTS_FNAME = "follower_snapshots"
 RNG_FNAME = "rng"
 PLOT_FILE_NAME = "plots"
+LAYOUT_FNAME = "layout"
+TOOLTIPS_FNAME = "tooltips"
+
+# stored with columnar.py rather than as one gzipped blob
+COLUMNAR_FNAMES = (USER_DICT_FNAME,)
+COLUMN_CHUNK_ROWS = 65536
+
+# "full" keeps every (normalized) tweet in memory while scraping, "rollup"
+# keeps only per-user rollups and leaves the tweets in the tweet store log
+TWEET_RETENTION = "rollup"
+# with "rollup" retention, the ids of at least this many of the latest
+# logged tweets are read back when the scraper starts, so that tweets
+# redelivered after a restart aren't counted in the rollups again
+TWEET_SEEN_WINDOW = 1000000
+
+LOG_FLUSH_EVERY = 100
+LOG_SEGMENT_BYTES = 64 * 1024 * 1024
+LOG_MAX_SEGMENTS = 16
+# the scraper folds logs this big into their snapshots when it starts
+LOG_FOLD_BYTES = LOG_SEGMENT_BYTES
+# the adjacency store appends new lists to a tail file and rewrites its
+# arrays once the tail is this big, see adjacency.py
+ADJACENCY_TAIL_BYTES = 256 * 1024 * 1024
+
+EXPAND_WORKERS = 8
+# already expanded users whose lists are fetched again on every scrape,
+# those fetched longest ago first, so snapshots see follows and unfollows
+RESCRAPE_USERS = 100
+RATE_LIMIT_WINDOW = 15 * 60
+RATE_LIMITS = {"followers": 15, "friends": 15}
+
+# level-of-detail tiles, see tiles.py; graphs with more than
+# LOD_NODE_THRESHOLD nodes are shown as tiles instead of one plot
+TILE_MAX_ZOOM = 12
+TILE_NODE_LIMIT = 1500
+TILE_EDGE_LIMIT = 2000
+TILE_AGG_BITS = 4
+TILE_CACHE_SIZE = 4096
+LOD_NODE_THRESHOLD = 5000
+# seconds browsers may cache a /tooltip answer, which is per graph version
+TOOLTIP_MAX_AGE = 24 * 60 * 60
+
+# "force" lays graphs out in process (see force_layout.py), warm-started
+# from the last layout when at least FORCE_WARM_FRACTION of the nodes
+# are in it; anything else is a Graphviz program, e.g. "sfdp"
+LAYOUT_PROG = "force"
+FORCE_ITERATIONS = 100
+FORCE_REFINE_ITERATIONS = 30
+FORCE_WARM_ITERATIONS = 10
+FORCE_WARM_FRACTION = 0.5
+FORCE_LEAF_SIZE = 4
+FORCE_COARSEST = 100
+FORCE_GRAVITY = 0.01
+
+# bytes of working memory for "analyze.py --streaming", which builds the
+# adjacency store and full graph out of core (see out_of_core.py)
+GRAPH_MEMORY_BUDGET = 1 << 30
+
+# friends/followers snapshots are diffs against the one before, see
+# snapshots.py; every SNAPSHOT_KEYFRAME_EVERY-th also keeps the full
+# lists (0 for only the first), so at most that many diffs are replayed
+SNAPSHOT_KEYFRAME_EVERY = 10
+
+# PageRank/HITS power iteration over the full graph, see centrality.py
+PAGERANK_ALPHA = 0.85
+CENTRALITY_TOL = 1e-8
+CENTRALITY_MAX_ITER = 100
+
+# ids per statuses/filter follow parameter
+FOLLOW_LIMIT = 5000
+COMMUNITY_ITERATIONS = 10
+
+STREAM_SHARDS = 4
+STREAM_DWELL = 150
+STREAM_GRACE = 10
+
+# "twitter" or "mastodon", see backends.py
+SCRAPE_BACKEND = "twitter"
+# MAST_TOKEN is only sent to MAST_INSTANCE; streams are "instance/stream"
+# under /api/v1/streaming, e.g. "mastodon.social/public/local" or
+# "fosstodon.org/hashtag?tag=python", all multiplexed in one process
+MAST_INSTANCE = "https://mastodon.social"
+MAST_STREAMS = ("mastodon.social/public",)
+MAST_STREAM_SECONDS = 15 * 60
+MAST_POOL_SIZE = 100
+MAST_PAGE_SIZE = 80
+MAST_RATE_LIMIT = 300
+MAST_RATE_WINDOW = 5 * 60
+
+# histogram buckets (seconds) for timings, see instrument.py; functions
+# opted into profiling are profiled on one in every PROFILE_EVERY calls
+TIMING_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800)
+PROFILE_EVERY = 100
 
 _exit_codes = count(start=1, step=1)
 FILE_NOT_FOUND_EXIT_CODE = next(_exit_codes)
@@ -0,0 +1,294 @@
+import hashlib
+import os
+import sys
+
+import networkx as nx
+import numpy as np
+
+from adjacency import COUNT_KEYS
+
+EDGE_DTYPE = np.dtype([("source", np.int64), ("target", np.int64)])
+DEGREE_KINDS = ("in", "out")
+VERSION_CHUNK_EDGES = 1 << 20
+
+
+def edge_records(sources, targets):
+    edges = np.empty(len(sources), dtype=EDGE_DTYPE)
+    edges["source"] = sources
+    edges["target"] = targets
+    return edges
+
+
+def contains_edges(sorted_edges, edges):
+    """
+    Mask of the `edges` that are in the sorted edge array `sorted_edges`.
+    """
+    positions = np.searchsorted(sorted_edges, edges)
+    inside = positions < len(sorted_edges)
+    found = np.zeros(len(edges), dtype=bool)
+    found[inside] = sorted_edges[positions[inside]] == edges[inside]
+    return found
+
+
+def stored_version(fname_base):
+    """
+    The version of the graph saved under `fname_base`, read without
+    loading the graph, or None if there is none.
+    """
+    try:
+        with np.load(fname_base + ".npz") as data:
+            return str(data["version"])
+    except (FileNotFoundError, KeyError):
+        return None
+
+
+class GraphStore:
+    """
+    The full user graph, kept up to date incrementally.
+
+    Edges are a sorted, deduplicated array of (source, target) user ids,
+    so each node's out-edges are one contiguous run.  Every node's in-
+    and out-degree is kept alongside, with running count/sum/sum of
+    squares so that degree statistics never need a pass over the graph.
+
+    The watermark records, for every user whose edges are included, the
+    length and checksum of their friends/followers lists at the time, so
+    users whose lists are unchanged can be skipped.  Lists can shrink or
+    change (a resumed expansion cuts them back, a re-scrape fetches them
+    again), so the edges of users whose lists did are removed before
+    their lists are added again.
+
+    The trim state is the edges sampled for the trimmed graph, and the
+    significant nodes (with their out-degree) they were sampled for, so
+    the trimmed graph only has to be resampled where that changed.
+    """
+
+    def __init__(self, fname_base):
+        self.fname_base = fname_base
+        self.edges = np.zeros(0, dtype=EDGE_DTYPE)
+        self.nodes = np.zeros(0, dtype=np.int64)
+        self.degrees = {kind: np.zeros(0, dtype=np.int64) for kind in DEGREE_KINDS}
+        self.stats = {kind: np.zeros(2, dtype=np.float64) for kind in DEGREE_KINDS}
+        self.watermark = np.zeros(0, dtype=np.int64)
+        self.watermark_degrees = {
+            key: np.zeros(0, dtype=np.int64) for key in COUNT_KEYS
+        }
+        self.watermark_sums = {key: np.zeros(0, dtype=np.uint64) for key in COUNT_KEYS}
+        self.sampled = np.zeros(0, dtype=EDGE_DTYPE)
+        self.significant = np.zeros(0, dtype=np.int64)
+        self.sampled_out = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def version(self):
+        """
+        Content hash of the nodes and edges, matching layout.graph_version
+        for the same graph.
+        """
+        digest = hashlib.sha1()
+        digest.update(self.nodes.tobytes())
+        # in chunks, so a memory-mapped edge array is never copied whole
+        for start in range(0, len(self.edges), VERSION_CHUNK_EDGES):
+            chunk = self.edges[start : start + VERSION_CHUNK_EDGES]
+            edges = np.stack((chunk["source"], chunk["target"]), axis=1)
+            digest.update(edges.tobytes())
+        return digest.hexdigest()
+
+    @classmethod
+    def load(cls, fname_base):
+        store = cls(fname_base)
+        fname = fname_base + ".npz"
+        try:
+            with np.load(fname) as data:
+                store.edges = edge_records(data["sources"], data["targets"])
+                store.nodes = data["nodes"]
+                for kind in DEGREE_KINDS:
+                    store.degrees[kind] = data[f"{kind}_degree"]
+                    store.stats[kind] = data[f"{kind}_stats"]
+                store.watermark = data["watermark"]
+                for key in COUNT_KEYS:
+                    store.watermark_degrees[key] = data[f"watermark_{key}"]
+                    store.watermark_sums[key] = data[f"watermark_{key}_sums"]
+                store.sampled = edge_records(
+                    data["sampled_sources"], data["sampled_targets"]
+                )
+                store.significant = data["significant"]
+                store.sampled_out = data["sampled_out"]
+        except (FileNotFoundError, KeyError):
+            print(f"Existing graph not found at {fname}, reinitializing...")
+            return cls(fname_base)
+        return store
+
+    def save(self):
+        fname = self.fname_base + ".npz"
+        print(f"Saving graph of {len(self.nodes)} nodes to {fname}")
+        arrays = {
+            "sources": self.edges["source"],
+            "targets": self.edges["target"],
+            "nodes": self.nodes,
+            "watermark": self.watermark,
+            "sampled_sources": self.sampled["source"],
+            "sampled_targets": self.sampled["target"],
+            "significant": self.significant,
+            "sampled_out": self.sampled_out,
+            "version": self.version(),
+        }
+        for kind in DEGREE_KINDS:
+            arrays[f"{kind}_degree"] = self.degrees[kind]
+            arrays[f"{kind}_stats"] = self.stats[kind]
+        for key in COUNT_KEYS:
+            arrays[f"watermark_{key}"] = self.watermark_degrees[key]
+            arrays[f"watermark_{key}_sums"] = self.watermark_sums[key]
+        try:
+            with open(fname + ".tmp", "wb") as graph_file:
+                np.savez(graph_file, **arrays)
+            os.replace(fname + ".tmp", fname)
+        except OSError:
+            sys.stderr.write(f"ERROR: {fname} is not writeable!\n")
+            return False
+        return True
+
+    def stale_users(self, user_ids, list_degrees, list_sums):
+        """
+        The users among `user_ids` that are new since the watermark or
+        whose friends/followers lists (their lengths `list_degrees` and
+        checksums `list_sums`, keyed like COUNT_KEYS) have changed since.
+        """
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        idx = np.searchsorted(self.watermark, user_ids)
+        found = np.zeros(len(user_ids), dtype=bool)
+        inside = idx < len(self.watermark)
+        found[inside] = self.watermark[idx[inside]] == user_ids[inside]
+        stale = ~found
+        for key in COUNT_KEYS:
+            marked = np.zeros(len(user_ids), dtype=np.int64)
+            marked[found] = self.watermark_degrees[key][idx[found]]
+            stale |= found & (marked != list_degrees[key])
+            sums = np.zeros(len(user_ids), dtype=np.uint64)
+            sums[found] = self.watermark_sums[key][idx[found]]
+            stale |= found & (sums != list_sums[key])
+        return stale
+
+    def mark(self, user_ids, list_degrees, list_sums):
+        """
+        Move the watermark of `user_ids` to their current list lengths
+        and checksums.
+        """
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        merged, inverse = np.unique(
+            np.concatenate((self.watermark, user_ids)), return_inverse=True
+        )
+        for key in COUNT_KEYS:
+            degrees = np.zeros(len(merged), dtype=np.int64)
+            degrees[inverse[: len(self.watermark)]] = self.watermark_degrees[key]
+            degrees[inverse[len(self.watermark) :]] = list_degrees[key]
+            self.watermark_degrees[key] = degrees
+            sums = np.zeros(len(merged), dtype=np.uint64)
+            sums[inverse[: len(self.watermark)]] = self.watermark_sums[key]
+            sums[inverse[len(self.watermark) :]] = list_sums[key]
+            self.watermark_sums[key] = sums
+        self.watermark = merged
+
+    def _add_nodes(self, node_ids):
+        new_ids = np.setdiff1d(node_ids, self.nodes)
+        if len(new_ids) == 0:
+            return
+        positions = np.searchsorted(self.nodes, new_ids)
+        self.nodes = np.insert(self.nodes, positions, new_ids)
+        for kind in DEGREE_KINDS:
+            self.degrees[kind] = np.insert(self.degrees[kind], positions, 0)
+
+    def _bump_degrees(self, kind, node_ids, sign=1):
+        idx = np.searchsorted(self.nodes, node_ids)
+        changed, counts = np.unique(idx, return_counts=True)
+        counts = sign * counts
+        before = self.degrees[kind][changed]
+        after = before + counts
+        self.stats[kind] += (counts.sum(), (after ** 2 - before ** 2).sum())
+        self.degrees[kind][changed] = after
+
+    def add_edges(self, sources, targets):
+        """
+        Merge edges into the graph, ignoring ones it already has, and
+        update the degrees.  Returns the number of edges added.
+        """
+        new_edges = np.unique(edge_records(sources, targets))
+        positions = np.searchsorted(self.edges, new_edges)
+        exists = contains_edges(self.edges, new_edges)
+        new_edges = new_edges[~exists]
+        if len(new_edges) == 0:
+            return 0
+
+        self.edges = np.insert(self.edges, positions[~exists], new_edges)
+        self._add_nodes(np.concatenate((new_edges["source"], new_edges["target"])))
+        self._bump_degrees("out", new_edges["source"])
+        self._bump_degrees("in", new_edges["target"])
+        return len(new_edges)
+
+    def remove_edges(self, positions):
+        """
+        Drop the edges at `positions`, update the degrees, and drop the
+        nodes left without edges.  Removed edges are dropped from the
+        trimmed graph's sample too, and their sources marked to be
+        resampled.  Returns the removed edges.
+        """
+        positions = np.unique(positions)
+        removed = self.edges[positions]
+        if len(removed) == 0:
+            return removed
+        self.edges = np.delete(self.edges, positions)
+        self._bump_degrees("out", removed["source"], -1)
+        self._bump_degrees("in", removed["target"], -1)
+        connected = (self.degrees["in"] > 0) | (self.degrees["out"] > 0)
+        self.nodes = self.nodes[connected]
+        for kind in DEGREE_KINDS:
+            self.degrees[kind] = self.degrees[kind][connected]
+        sampled = contains_edges(removed, self.sampled)
+        if sampled.any():
+            resample = np.isin(self.significant, self.sampled["source"][sampled])
+            self.sampled_out = np.where(resample, -1, self.sampled_out)
+            self.sampled = self.sampled[~sampled]
+        return removed
+
+    def degree_stats(self, kind):
+        """
+        Mean and sample standard deviation of the `kind` degrees.
+        """
+        count = len(self.nodes)
+        total, squares = self.stats[kind]
+        if count < 2:
+            return total / max(count, 1), 0.0
+        mean = total / count
+        variance = (squares - count * mean ** 2) / (count - 1)
+        return mean, np.sqrt(max(variance, 0.0))
+
+    def out_edges(self, node_ids):
+        """
+        Positions in `edges` of every out-edge of `node_ids`.
+        """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        starts = np.searchsorted(self.edges["source"], node_ids, side="left")
+        stops = np.searchsorted(self.edges["source"], node_ids, side="right")
+        counts = stops - starts
+        offsets = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        return offsets + np.arange(counts.sum(), dtype=np.int64)
+
+    def touching(self, node_ids):
+        """
+        Positions in `edges` of every edge out of or into `node_ids`.
+        """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        into = np.flatnonzero(np.isin(self.edges["target"], node_ids))
+        return np.union1d(self.out_edges(node_ids), into)
+
+    def to_networkx(self, node_ids=None, edge_positions=None):
+        """
+        The whole graph, or the nodes `node_ids` with the edges at
+        `edge_positions`, as a networkx DiGraph.
+        """
+        edges = self.edges if edge_positions is None else self.edges[edge_positions]
+        graph = nx.DiGraph()
+        graph.add_nodes_from((self.nodes if node_ids is None else node_ids).tolist())
+        graph.add_edges_from(zip(edges["source"].tolist(), edges["target"].tolist()))
+        return graph
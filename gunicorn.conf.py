@@ -0,0 +1,19 @@
+"""
+gunicorn settings.  With PRELOAD_SNAPSHOT set (the default), the master
+imports the app, loads its data and renders every payload before forking,
+so workers boot without loading anything and share one read-only
+snapshot copy-on-write.  PRELOAD_SNAPSHOT=0 goes back to each worker
+loading lazily on its first request.
+"""
+import os
+
+preload_app = os.environ.get("PRELOAD_SNAPSHOT", "1") != "0"
+
+
+def when_ready(server):
+    if preload_app:
+        import app
+
+        app.preload()
+        version = app.DATA.graph_data["version"]
+        server.log.info("Preloaded data snapshot for graph %s", version[:8])
@@ -0,0 +1,253 @@
+"""
+Counters, timing histograms and sampled profiles for the scraper,
+analysis and web app, exposed in the Prometheus text format.
+
+Metrics live in process memory, so every gunicorn worker (and every
+scrape) reports its own; an update is a dict lookup and an add under a
+lock, cheap enough to leave on everywhere.  Functions decorated with
+@profiled run under cProfile on one in every PROFILE_EVERY calls
+(starting with the first), and the accumulated stats can be rendered
+with profile_report().  The web app serves /metrics itself; other
+processes can serve it with serve_metrics().
+"""
+import bisect
+import cProfile
+import io
+import pstats
+import threading
+import time
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from global_vars import PROFILE_EVERY, TIMING_BUCKETS
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key):
+    if not key:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in key) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        for key, value in values:
+            yield self.name, key, value
+
+
+class Timer:
+    """
+    Observe the time spent in a `with` block, or in every call of a
+    function it decorates, into a histogram.
+    """
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+    def __call__(self, func):
+        @wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.histogram.observe(time.perf_counter() - start, **self.labels)
+
+        return timed
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=TIMING_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # a count per bucket, then the sum of observations
+                state = self.values[key] = [0] * len(self.buckets) + [0.0]
+            state[bucket] += 1
+            state[-1] += value
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def count(self, **labels):
+        state = self.values.get(tuple(sorted(labels.items())))
+        return 0 if state is None else sum(state[:-1])
+
+    def samples(self):
+        with self.lock:
+            values = [(key, list(state)) for key, state in self.values.items()]
+        for key, state in values:
+            total = 0
+            for bound, count in zip(self.buckets, state):
+                total += count
+                le = (("le", _format_value(bound)),)
+                yield f"{self.name}_bucket", key + le, total
+            yield f"{self.name}_sum", key, state[-1]
+            yield f"{self.name}_count", key, total
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _metric(self, cls, name, help_text, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, help_text, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, help_text):
+        return self._metric(Counter, name, help_text)
+
+    def histogram(self, name, help_text, buckets=TIMING_BUCKETS):
+        return self._metric(Histogram, name, help_text, buckets=buckets)
+
+    def render(self):
+        lines = []
+        for name in sorted(self.metrics):
+            metric = self.metrics[name]
+            lines.append(f"# HELP {name} {_escape(metric.help)}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for sample, key, value in metric.samples():
+                lines.append(f"{sample}{_format_labels(key)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+REGISTRY = Registry()
+counter = REGISTRY.counter
+histogram = REGISTRY.histogram
+
+STAGE_SECONDS = histogram("stage_seconds", "Time spent in each pipeline stage")
+FILE_WRITE_SECONDS = histogram("file_write_seconds", "Time spent writing data files")
+FILE_WRITE_BYTES = counter("file_write_bytes_total", "Bytes written to data files")
+PROFILE_SAMPLES = counter("profile_samples_total", "Calls run under the profiler")
+
+PROFILES = {}
+# cProfile can only profile one call at a time
+_profiler_lock = threading.Lock()
+
+
+def profiled(func=None, every=PROFILE_EVERY):
+    """
+    Profile one in every `every` calls of the decorated function,
+    accumulating the stats in PROFILES under its qualified name.  Calls
+    made while another call is being profiled are just run.
+    """
+    if func is None:
+        return lambda func: profiled(func, every)
+    name = f"{func.__module__}.{func.__qualname__}"
+    # calls since the last sample; a sample that had to be skipped is
+    # taken on the next call instead
+    since = [every]
+
+    @wraps(func)
+    def sampled(*args, **kwargs):
+        if since[0] < every or not _profiler_lock.acquire(blocking=False):
+            since[0] += 1
+            return func(*args, **kwargs)
+        since[0] = 1
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            if name in PROFILES:
+                PROFILES[name].add(profile)
+            else:
+                PROFILES[name] = pstats.Stats(profile)
+            _profiler_lock.release()
+            PROFILE_SAMPLES.inc(function=name)
+
+    return sampled
+
+
+def profile_report(limit=25, sort_by="cumulative"):
+    """
+    The top `limit` entries of every sampled profile, as text.
+    """
+    out = io.StringIO()
+    for name in sorted(PROFILES):
+        samples = PROFILE_SAMPLES.value(function=name)
+        out.write(f"==== {name} ({samples} sampled calls) ====\n")
+        stats = PROFILES[name]
+        stats.stream = out
+        stats.sort_stats(sort_by).print_stats(limit)
+    return out.getvalue()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port):
+    """
+    Serve /metrics on a background thread and return the server; call
+    shutdown() on the result to stop it.
+    """
+    server = HTTPServer(("", port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    print(f"Serving metrics on port {server.server_address[1]}")
+    return server
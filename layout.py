@@ -0,0 +1,90 @@
+import hashlib
+import os
+
+import numpy as np
+from networkx.drawing.nx_agraph import graphviz_layout
+
+from force_layout import force_layout
+from global_vars import LAYOUT_FNAME, LAYOUT_PROG
+
+_LAYOUTS = {}
+
+
+def graph_version(graph):
+    """
+    Content hash of a graph's nodes and edges, independent of the order
+    they were added in.
+    """
+    node_ids = np.sort(np.fromiter(graph, dtype=np.int64, count=len(graph)))
+    edges = np.array(graph.edges(), dtype=np.int64).reshape(-1, 2)
+    edges = edges[np.lexsort((edges[:, 1], edges[:, 0]))]
+    digest = hashlib.sha1()
+    digest.update(node_ids.tobytes())
+    digest.update(edges.tobytes())
+    return digest.hexdigest()
+
+
+def _load_layout(fname):
+    """
+    Return the version and positions saved in `fname`, or (None, None).
+    """
+    try:
+        with np.load(fname) as data:
+            version = str(data["version"])
+            nodes = data["nodes"].tolist()
+            positions = data["positions"].tolist()
+    except (FileNotFoundError, KeyError, ValueError):
+        return None, None
+    return version, {node: tuple(pos) for node, pos in zip(nodes, positions)}
+
+
+def _save_layout(fname, version, positions):
+    nodes = np.fromiter(positions, dtype=np.int64, count=len(positions))
+    coords = np.array([positions[node] for node in positions], dtype=np.float64)
+    print(f"Saving layout {version[:8]} to {fname}")
+    try:
+        with open(fname + ".tmp", "wb") as layout_file:
+            np.savez(layout_file, version=version, nodes=nodes, positions=coords)
+        os.replace(fname + ".tmp", fname)
+    except OSError:
+        return False
+    return True
+
+
+def cached_layout(graph, prog=LAYOUT_PROG):
+    """
+    Drop-in replacement for graphviz_layout that runs the layout once per
+    graph version and layout program.  Positions are kept in memory and
+    in LAYOUT_FNAME.npz, keyed by graph_version(graph) and `prog`.  The
+    "force" layout starts from the last positions saved, so nodes already
+    laid out stay about where they were.
+    """
+    version = f"{graph_version(graph)}-{prog}"
+    if version in _LAYOUTS:
+        return _LAYOUTS[version]
+
+    fname = LAYOUT_FNAME + ".npz"
+    if _LAYOUTS:
+        saved_version, previous = next(iter(_LAYOUTS.items()))
+    else:
+        saved_version, previous = _load_layout(fname)
+    if saved_version == version:
+        positions = previous
+    else:
+        print(f"Running {prog} layout for graph {version[:8]}")
+        if prog == "force":
+            positions = force_layout(graph, previous=previous)
+        else:
+            positions = graphviz_layout(graph, prog=prog)
+        _save_layout(fname, version, positions)
+    _LAYOUTS.clear()
+    _LAYOUTS[version] = positions
+    return positions
+
+
+def invalidate_layout():
+    """
+    Forget the layout in memory.  The saved one is kept for the next
+    layout to start from; it is only reused as is for the same version.
+    """
+    _LAYOUTS.clear()
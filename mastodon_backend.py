@@ -0,0 +1,365 @@
+"""
+Mastodon ingestion over asyncio.
+
+One event loop on a background thread owns a single aiohttp session,
+whose connection pool is shared by every stream and API call, so one
+process can keep dozens of timelines on many instances open.  Statuses
+and accounts are normalized into the tweet and user JSON shapes the
+rest of the scraper stores, so analyze.py and app.py work unchanged.
+
+Mastodon ids are only unique per instance (and an instance gives remote
+accounts ids of its own), so users and statuses are keyed by a 63-bit
+hash of their acct/uri instead.  The instance and local id needed to
+page through a user's followers are kept in their user json.
+
+    python mastodon_backend.py
+
+streams from local stand-in instances (fake_mastodon.py) and expands
+the users seen, as a check that everything fits together.
+"""
+import asyncio
+import hashlib
+import html
+import queue
+import re
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlparse
+
+import aiohttp
+import ujson
+
+from adjacency import COUNT_KEYS
+from expand import RateLimited, TokenBucket, Unavailable
+from global_vars import (LOG_FLUSH_EVERY, MAST_INSTANCE, MAST_PAGE_SIZE,
+                         MAST_POOL_SIZE, MAST_RATE_LIMIT, MAST_RATE_WINDOW,
+                         MAST_STREAM_SECONDS, MAST_STREAMS)
+from instrument import counter
+from secrets import MAST_TOKEN
+
+ENDPOINTS = {"followers": "followers", "friends": "following"}
+TAG_RE = re.compile(r"<[^>]+>")
+BREAK_RE = re.compile(r"<br\s*/?>|</p>\s*<p>")
+NEXT_LINK_RE = re.compile(r'<([^>]+)>;\s*rel="next"')
+MAX_BACKOFF = 60
+
+STREAM_STATUSES = counter("stream_statuses_total", "Statuses received per stream")
+
+
+def global_id(name):
+    digest = hashlib.blake2b(name.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") >> 1
+
+
+def plain_text(content):
+    return html.unescape(TAG_RE.sub("", BREAK_RE.sub("\n", content))).strip()
+
+
+def parse_time(timestamp):
+    """
+    Seconds since the epoch of an ISO 8601 timestamp from the API.
+    """
+    for fmt in ("%Y-%m-%dT%H:%M:%S.%f%z", "%Y-%m-%dT%H:%M:%S%z"):
+        try:
+            return datetime.strptime(timestamp.replace("Z", "+0000"), fmt).timestamp()
+        except (AttributeError, ValueError):
+            continue
+    return time.time()
+
+
+def account_json(account, base_url):
+    """
+    A Mastodon account, seen through the instance at `base_url`, in the
+    shape of a Twitter user.
+    """
+    acct = account["acct"]
+    if "@" not in acct:
+        acct = f"{acct}@{urlparse(base_url).netloc}"
+    user_id = global_id(acct)
+    return {
+        "id": user_id,
+        "id_str": str(user_id),
+        "screen_name": acct,
+        "name": account.get("display_name") or account["username"],
+        "followers_count": account.get("followers_count", 0),
+        "friends_count": account.get("following_count", 0),
+        "statuses_count": account.get("statuses_count", 0),
+        "created_at": account.get("created_at"),
+        "instance": base_url,
+        "local_id": account["id"],
+    }
+
+
+def status_json(status, base_url):
+    """
+    A Mastodon status in the shape of a raw tweet; reblogs become
+    retweets of the reblogged status.
+    """
+    tweet_id = global_id(status["uri"])
+    tweet = {
+        "id": tweet_id,
+        "id_str": str(tweet_id),
+        "created_at": status["created_at"],
+        "timestamp_ms": str(int(parse_time(status["created_at"]) * 1000)),
+        "text": plain_text(status.get("content") or ""),
+        "lang": status.get("language"),
+        "source": "mastodon",
+        "user": account_json(status["account"], base_url),
+    }
+    if status.get("reblog"):
+        original = status_json(status["reblog"], base_url)
+        tweet["retweeted_status"] = original
+        tweet["text"] = f"RT @{original['user']['screen_name']}: {original['text']}"
+    return tweet
+
+
+def stream_url(spec):
+    """
+    Base URL and streaming URL of an "instance/stream" spec; instances
+    without a scheme are https.
+    """
+    if "://" not in spec:
+        spec = "https://" + spec
+    url = urlparse(spec)
+    base_url = f"{url.scheme}://{url.netloc}"
+    return base_url, f"{base_url}/api/v1/streaming{spec[len(base_url):]}"
+
+
+def reset_time(header):
+    return None if header is None else parse_time(header)
+
+
+class Pool:
+    """
+    An event loop on a daemon thread with one pooled aiohttp session.
+    Coroutines can be run on it from any thread.
+    """
+
+    def __init__(self, size=MAST_POOL_SIZE):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.session = self.run(self._open(size))
+
+    async def _open(self, size):
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=size),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=30),
+        )
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def close(self):
+        self.run(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+class MastodonApi:
+    def __init__(self, pool, home=MAST_INSTANCE, token=MAST_TOKEN):
+        self.pool = pool
+        self.home = home.rstrip("/")
+        self.token = token
+
+    def headers(self, url):
+        # the token is only valid on (and only ever sent to) its home instance
+        if self.token and url.startswith(self.home + "/"):
+            return {"Authorization": f"Bearer {self.token}"}
+        return {}
+
+    async def get_page(self, url, params=None):
+        """
+        A page of results and the URL of the next page, if any.
+        """
+        session = self.pool.session
+        async with session.get(url, params=params, headers=self.headers(url)) as resp:
+            if resp.status != 200:
+                # read the error body too, so the connection can be reused
+                # rather than reset
+                await resp.read()
+            if resp.status == 429:
+                raise RateLimited(reset_time(resp.headers.get("X-RateLimit-Reset")))
+            if resp.status != 200:
+                raise Unavailable(f"{resp.status} for {url}")
+            payload = await resp.json(loads=ujson.loads)
+            next_link = NEXT_LINK_RE.search(resp.headers.get("Link", ""))
+        return payload, next_link.group(1) if next_link else None
+
+
+class MastodonFetcher:
+    """
+    Fetch one page of follower/following ids for the expansion engine.
+    Calls come from its worker threads and are all multiplexed over the
+    pool; the cursor is the URL of the next page.
+    """
+
+    def __init__(self, api, user_dict):
+        self.api = api
+        self.user_dict = user_dict
+
+    def fetch(self, count_key, user_id, cursor):
+        user = self.user_dict.get(user_id, {})
+        if "local_id" not in user:
+            raise Unavailable(f"no Mastodon account known for {user_id}")
+        base_url = user["instance"]
+        if cursor == -1:
+            endpoint = ENDPOINTS[count_key]
+            url = f"{base_url}/api/v1/accounts/{user['local_id']}/{endpoint}"
+            params = {"limit": MAST_PAGE_SIZE}
+        else:
+            url, params = cursor, None
+        accounts, next_url = self.api.pool.run(self.api.get_page(url, params))
+        ids = [account_json(account, base_url)["id"] for account in accounts]
+        return ids, next_url or 0
+
+
+class MastodonSource:
+    """
+    Many Mastodon streams at once, read as server-sent events on the
+    pool's loop; the statuses from every stream go to `emit`.
+    """
+
+    def __init__(self, api):
+        self.api = api
+
+    async def _stream(self, spec, emit):
+        base_url, url = stream_url(spec)
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=MAX_BACKOFF * 2)
+        backoff = 1
+        while True:
+            try:
+                async with self.api.pool.session.get(
+                    url, headers=self.api.headers(url), timeout=timeout
+                ) as resp:
+                    if resp.status != 200:
+                        raise Unavailable(f"{resp.status} for {url}")
+                    backoff = 1
+                    event = None
+                    async for line in resp.content:
+                        line = line.decode().rstrip("\r\n")
+                        if line.startswith("event:"):
+                            event = line[len("event:") :].strip()
+                        elif line.startswith("data:") and event == "update":
+                            status = ujson.loads(line[len("data:") :])
+                            STREAM_STATUSES.inc(stream=spec)
+                            emit(status_json(status, base_url))
+                        elif not line:
+                            event = None
+            except (aiohttp.ClientError, asyncio.TimeoutError, Unavailable) as err:
+                print(f"Stream {spec} dropped ({err}), reconnecting in {backoff}s")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+
+    async def _run(self, specs, emit, stop):
+        tasks = [asyncio.ensure_future(self._stream(spec, emit)) for spec in specs]
+        while not stop.is_set():
+            await asyncio.sleep(0.5)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stream(self, specs, emit, stop):
+        """
+        Stream every spec until `stop` (a threading.Event) is set.
+        """
+        self.api.pool.run(self._run(list(specs), emit, stop))
+
+
+class MastodonBackend:
+    def __init__(self, streams=MAST_STREAMS, home=MAST_INSTANCE, token=MAST_TOKEN):
+        self.streams = streams
+        self.pool = Pool()
+        self.api = MastodonApi(self.pool, home, token)
+
+    def fetcher(self, user_dict):
+        return MastodonFetcher(self.api, user_dict)
+
+    def buckets(self, window=MAST_RATE_WINDOW):
+        # one limit per account covers both endpoints
+        limit = MAST_RATE_LIMIT // len(COUNT_KEYS)
+        return {key: TokenBucket(limit, window, name=key) for key in COUNT_KEYS}
+
+    def stream(
+        self, store, checkpoint, checkpoint_every=LOG_FLUSH_EVERY, seconds=None
+    ):
+        """
+        Stream every stream for `seconds` (MAST_STREAM_SECONDS by
+        default).  Statuses are handed from the event loop to a consumer
+        thread that stores them and checkpoints, so slow writes never
+        hold up the streams or the pool.
+        """
+        stats = {"tweets": 0, "streams": len(self.streams)}
+        stop = threading.Event()
+        timer = threading.Timer(seconds or MAST_STREAM_SECONDS, stop.set)
+        statuses = queue.Queue()
+        errors = []
+
+        def consume():
+            try:
+                for tweet_json in iter(statuses.get, None):
+                    store(tweet_json)
+                    stats["tweets"] += 1
+                    if stats["tweets"] % checkpoint_every == 0:
+                        print(f"currently scraped {stats['tweets']} new statuses")
+                        checkpoint()
+            except Exception as err:
+                errors.append(err)
+                stop.set()
+
+        consumer = threading.Thread(target=consume, daemon=True)
+        print(f"Streaming {len(self.streams)} Mastodon streams")
+        consumer.start()
+        timer.start()
+        try:
+            MastodonSource(self.api).stream(self.streams, statuses.put, stop)
+        finally:
+            timer.cancel()
+            statuses.put(None)
+            consumer.join()
+        if errors:
+            raise errors[0]
+        return stats
+
+    def close(self):
+        self.pool.close()
+
+
+def main():
+    import fake_mastodon
+    from expand import ExpansionEngine
+    from segment_log import NullLog
+
+    window = 5
+    servers = [fake_mastodon.serve(port=0, window=window) for _ in range(3)]
+    bases = [f"http://127.0.0.1:{server.server_address[1]}" for server in servers]
+    timelines = ["public", "public/local"] + [f"hashtag?tag=t{i}" for i in range(10)]
+    streams = [f"{base}/{timeline}" for base in bases for timeline in timelines]
+    backend = MastodonBackend(streams, home=bases[0], token="stub")
+
+    statuses = []
+    start = time.monotonic()
+    stats = backend.stream(statuses.append, lambda: None, seconds=5)
+    seconds = time.monotonic() - start
+    print(
+        f"{stats['tweets']} statuses from {stats['streams']} streams in {seconds:.1f}s"
+    )
+
+    users = {}
+    for tweet_json in statuses:
+        user_json = tweet_json["user"]
+        users[user_json["id_str"]] = dict(user_json, followers=[], friends=[])
+
+    to_expand = list(users)[:50]
+    engine = ExpansionEngine(
+        backend.fetcher(users), users, NullLog(), buckets=backend.buckets(window)
+    )
+    print(engine.run(to_expand))
+    backend.close()
+    for server in servers:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
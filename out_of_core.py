@@ -0,0 +1,446 @@
+"""
+Out-of-core construction of the adjacency store and the full graph, for
+user dictionaries too big to load.
+
+The users are read a chunk at a time, from the column store or by
+parsing users_dict.json.gz incrementally, with the log applied on the
+way.  Their (user, id) pairs go to an ExternalSort, which spills sorted
+runs to disk whenever it holds more than its share of the memory budget
+and merges them into one memory-mapped .npy file.  The merged pairs are
+turned into the CSR arrays of the adjacency store, and the graph's
+edges are sorted the same way from the adjacency store, so only per-node
+arrays (ids, degrees, offsets) are ever held in memory whole.
+
+Each list comes out sorted by id rather than in the order it was
+scraped; nothing downstream depends on that order.
+"""
+import gzip
+import json
+import os
+import re
+import shutil
+import sys
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from adjacency import (COUNT_KEYS, AdjacencyStore, csr_dirname, new_generation,
+                       swap_generation)
+from columnar import ColumnStore, has_columns
+from global_vars import (ADJACENCY_FNAME, COLUMN_CHUNK_ROWS, GRAPH_MEMORY_BUDGET,
+                         USER_DICT_FNAME)
+from graph_store import DEGREE_KINDS, EDGE_DTYPE, GraphStore, edge_records
+from segment_log import SegmentLog, replay_ops
+
+JSON_CHUNK_CHARS = 1 << 20
+MERGE_FAN_IN = 64
+_SEPARATOR_RE = re.compile(r"[\s,]*")
+_SPACE_RE = re.compile(r"\s*")
+
+
+def _build_dirname(fname_base):
+    return fname_base + ".build"
+
+
+def _dedupe(records):
+    if len(records) < 2:
+        return records
+    keep = np.ones(len(records), dtype=bool)
+    keep[1:] = records[1:] != records[:-1]
+    return records[keep]
+
+
+class ExternalSort:
+    """
+    Sort more records than fit in memory.  Records are added in batches
+    and spilled to `dirname` as sorted runs; finish() merges the runs,
+    at most MERGE_FAN_IN at a time, into one sorted .npy file, optionally
+    without duplicates, and memory-maps it.  Sorting and merging copy
+    what they hold, so runs and merge blocks are kept to a fraction of
+    `budget` bytes.
+    """
+
+    def __init__(self, dirname, dtype, budget, unique=False):
+        self.dirname = dirname
+        self.dtype = np.dtype(dtype)
+        self.budget = budget
+        self.unique = unique
+        self.buffer = []
+        self.buffered = 0
+        self.runs = []
+        self.num_runs = 0
+        os.makedirs(dirname, exist_ok=True)
+
+    def add(self, records):
+        records = np.asarray(records, dtype=self.dtype)
+        self.buffer.append(records)
+        self.buffered += records.nbytes
+        if self.buffered >= self.budget // 3:
+            self._spill()
+
+    def _run_path(self):
+        self.num_runs += 1
+        return os.path.join(self.dirname, f"run{self.num_runs:06d}.bin")
+
+    def _spill(self):
+        if not self.buffer:
+            return
+        run = np.sort(np.concatenate(self.buffer))
+        if self.unique:
+            run = _dedupe(run)
+        path = self._run_path()
+        run.tofile(path)
+        self.runs.append((path, len(run)))
+        self.buffer = []
+        self.buffered = 0
+
+    def _merged_blocks(self, runs):
+        """
+        Yield the sorted records of `runs` in order, a block at a time.
+        Each round reads the next block of every run and yields what is
+        no greater than the smallest last record of the runs that go on
+        past their block.
+        """
+        runs = [
+            np.memmap(path, dtype=self.dtype, mode="r", shape=(length,))
+            for path, length in runs
+            if length
+        ]
+        block = self.budget // (4 * self.dtype.itemsize * max(len(runs), 1))
+        block = max(block, 1)
+        positions = [0] * len(runs)
+        while True:
+            blocks = [
+                (i, np.asarray(run[positions[i] : positions[i] + block]))
+                for i, run in enumerate(runs)
+                if positions[i] < len(run)
+            ]
+            if not blocks:
+                return
+            bounds = [
+                chunk[-1:]
+                for i, chunk in blocks
+                if positions[i] + len(chunk) < len(runs[i])
+            ]
+            frontier = np.sort(np.concatenate(bounds))[:1] if bounds else None
+            parts = []
+            for i, chunk in blocks:
+                take = len(chunk)
+                if frontier is not None:
+                    take = np.searchsorted(chunk, frontier, side="right")[0]
+                parts.append(chunk[:take])
+                positions[i] += take
+            yield np.sort(np.concatenate(parts))
+
+    def _merge(self, runs, raw_path):
+        """
+        Merge `runs` into the raw file `raw_path`, remove them, and return
+        the number of records written.
+        """
+        written = 0
+        last = None
+        with open(raw_path, "wb") as raw_file:
+            for merged in self._merged_blocks(runs):
+                if self.unique:
+                    merged = _dedupe(merged)
+                    if last is not None and len(merged) and merged[0] == last[0]:
+                        merged = merged[1:]
+                if len(merged):
+                    merged.tofile(raw_file)
+                    written += len(merged)
+                    last = merged[-1:].copy()
+        for run_path, _ in runs:
+            os.remove(run_path)
+        return written
+
+    def finish(self, path):
+        self._spill()
+        while len(self.runs) > MERGE_FAN_IN:
+            runs, self.runs = self.runs[:MERGE_FAN_IN], self.runs[MERGE_FAN_IN:]
+            run_path = self._run_path()
+            self.runs.append((run_path, self._merge(runs, run_path)))
+        raw_path = path + ".raw"
+        written = self._merge(self.runs, raw_path)
+        self.runs = []
+        if written == 0:
+            np.save(path, np.zeros(0, dtype=self.dtype))
+        else:
+            raw = np.memmap(raw_path, dtype=self.dtype, mode="r", shape=(written,))
+            _copy_npy(path, raw, self.budget // 4 // self.dtype.itemsize)
+            del raw
+        os.remove(raw_path)
+        return np.load(path, mmap_mode="r")
+
+
+def _copy_npy(path, source, chunk_rows):
+    """
+    Write an array (e.g. a memory map) to the .npy file `path`, chunk by
+    chunk, via a temporary file and a rename.
+    """
+    out = open_memmap(path + ".tmp", mode="w+", dtype=source.dtype, shape=source.shape)
+    for start in range(0, len(source), max(chunk_rows, 1)):
+        out[start : start + chunk_rows] = source[start : start + chunk_rows]
+    out.flush()
+    del out
+    os.replace(path + ".tmp", path)
+
+
+def iter_json_items(fname, chunk_chars=JSON_CHUNK_CHARS):
+    """
+    Yield the (key, value) pairs of the JSON object in the gzipped file
+    `fname`, whose values are themselves objects or arrays, reading it a
+    chunk at a time.
+    """
+    decoder = json.JSONDecoder()
+    with gzip.open(fname, "rt") as json_file:
+        buf = json_file.read(chunk_chars).lstrip()
+        if not buf.startswith("{"):
+            raise ValueError(f"{fname} does not hold a JSON object")
+        pos = 1
+        while True:
+            try:
+                pos = _SEPARATOR_RE.match(buf, pos).end()
+                if buf[pos] == "}":
+                    return
+                key, end = decoder.raw_decode(buf, pos)
+                end = _SPACE_RE.match(buf, end).end()
+                if buf[end] != ":":
+                    raise ValueError(f"{fname}: expected ':' at {key!r}")
+                end = _SPACE_RE.match(buf, end + 1).end()
+                value, end = decoder.raw_decode(buf, end)
+            except (IndexError, json.JSONDecodeError):
+                # the item runs past the buffer (or the file is corrupt)
+                more = json_file.read(max(chunk_chars, len(buf)))
+                if not more:
+                    raise ValueError(f"{fname} ends part way through an item")
+                buf = buf[pos:] + more
+                pos = 0
+                continue
+            yield key, value
+            pos = end
+            if pos >= chunk_chars:
+                buf = buf[pos:]
+                pos = 0
+
+
+def _id_array(ids):
+    # lists not scraped yet are stored as 0, read back from an int column
+    # if no list in it was scraped
+    if ids is None or isinstance(ids, (int, np.integer)):
+        return np.zeros(0, dtype=np.int64)
+    return np.asarray(ids, dtype=np.int64)
+
+
+def _json_chunks(fname, chunk_rows, chunk_ids):
+    user_ids = []
+    lists = {key: [] for key in COUNT_KEYS}
+    num_ids = 0
+    for user_id, record in iter_json_items(fname):
+        user_ids.append(user_id)
+        for key in COUNT_KEYS:
+            ids = _id_array(record.get(key))
+            lists[key].append(ids)
+            num_ids += len(ids)
+        if len(user_ids) >= chunk_rows or num_ids >= chunk_ids:
+            yield user_ids, lists
+            user_ids = []
+            lists = {key: [] for key in COUNT_KEYS}
+            num_ids = 0
+    if user_ids:
+        yield user_ids, lists
+
+
+def iter_user_lists(fname_base=USER_DICT_FNAME, budget=GRAPH_MEMORY_BUDGET):
+    """
+    Yield (user ids, {key: id arrays}) for consecutive chunks of the user
+    dictionary under `fname_base`, read from its column store or parsed
+    incrementally from its .json.gz, with its log applied.
+    """
+    log = SegmentLog(fname_base)
+    ops = log.ops_by_key() if log.segments() else {}
+    if has_columns(fname_base):
+        store = ColumnStore(fname_base)
+        columns = [key for key in COUNT_KEYS if key in store.columns]
+        chunks = store.iter_chunks(columns)
+    elif os.path.isfile(fname_base + ".json.gz"):
+        chunks = _json_chunks(fname_base + ".json.gz", COLUMN_CHUNK_ROWS, budget // 8)
+    else:
+        sys.stderr.write(
+            f"ERROR: no column store or .json.gz to stream at {fname_base}; "
+            f"convert it with columnar.py\n"
+        )
+        chunks = iter(())
+
+    for user_ids, lists in chunks:
+        for key in COUNT_KEYS:
+            values = lists.get(key, [None] * len(user_ids))
+            lists[key] = [_id_array(ids) for ids in values]
+        for i, user_id in enumerate(user_ids):
+            if user_id in ops:
+                record = {key: _id_array(lists[key][i]).tolist() for key in COUNT_KEYS}
+                record = replay_ops(record, user_id, ops.pop(user_id))
+                for key in COUNT_KEYS:
+                    lists[key][i] = _id_array(record.get(key))
+        yield user_ids, lists
+    # users only in the log
+    user_ids = list(ops)
+    records = [replay_ops({}, user_id, ops[user_id]) for user_id in user_ids]
+    if user_ids:
+        yield user_ids, {
+            key: [_id_array(record.get(key)) for record in records]
+            for key in COUNT_KEYS
+        }
+
+
+def _pair_batches(owners, lists, limit):
+    """
+    (owner, id) records for every id in `lists`, in batches of about
+    `limit` ids (a single longer list is a batch of its own).
+    """
+    lengths = np.fromiter((len(ids) for ids in lists), dtype=np.int64, count=len(lists))
+    start = 0
+    while start < len(lists):
+        ends = np.cumsum(lengths[start:])
+        stop = start + max(1, int(np.searchsorted(ends, limit, side="right")))
+        others = np.concatenate(lists[start:stop])
+        yield edge_records(np.repeat(owners[start:stop], lengths[start:stop]), others)
+        start = stop
+
+
+def build_adjacency(
+    fname_base=USER_DICT_FNAME,
+    adjacency_fname=ADJACENCY_FNAME,
+    budget=GRAPH_MEMORY_BUDGET,
+):
+    """
+    Build the adjacency store for the user dictionary under `fname_base`
+    within about `budget` bytes of memory, and return it memory-mapped.
+    """
+    build_dirname = _build_dirname(adjacency_fname)
+    shutil.rmtree(build_dirname, ignore_errors=True)
+    share = budget // (len(COUNT_KEYS) + 1)
+    pairs = {
+        key: ExternalSort(os.path.join(build_dirname, key), EDGE_DTYPE, share)
+        for key in COUNT_KEYS
+    }
+    ids = ExternalSort(os.path.join(build_dirname, "ids"), np.int64, share, unique=True)
+
+    num_users = 0
+    for user_ids, lists in iter_user_lists(fname_base, budget):
+        owners = np.array([int(user_id) for user_id in user_ids], dtype=np.int64)
+        for key in COUNT_KEYS:
+            for records in _pair_batches(owners, lists[key], share // 4 // 16):
+                pairs[key].add(records)
+                ids.add(np.unique(records["source"]))
+                ids.add(np.unique(records["target"]))
+        num_users += len(user_ids)
+        print(f"Read the lists of {num_users} users")
+
+    nodes = ids.finish(os.path.join(build_dirname, "nodes.npy"))
+    if len(nodes) > np.iinfo(np.int32).max:
+        sys.stderr.write("ERROR: too many users for an int32 node index\n")
+        return None
+    nodes = np.asarray(nodes)
+    chunk_rows = max(budget // 32, 1)
+
+    store_dirname = csr_dirname(adjacency_fname)
+    print(f"Saving adjacency of {len(nodes)} users to {store_dirname}")
+    try:
+        dirname = new_generation(adjacency_fname)
+        _copy_npy(os.path.join(dirname, "nodes.npy"), nodes, chunk_rows)
+        for key in COUNT_KEYS:
+            merged = pairs[key].finish(os.path.join(build_dirname, f"{key}.npy"))
+            path = os.path.join(dirname, f"{key}_neighbors.npy")
+            neighbors = open_memmap(
+                path + ".tmp", mode="w+", dtype=np.int32, shape=(len(merged),)
+            )
+            counts = np.zeros(len(nodes), dtype=np.int64)
+            for start in range(0, len(merged), chunk_rows):
+                chunk = merged[start : start + chunk_rows]
+                neighbors[start : start + len(chunk)] = np.searchsorted(
+                    nodes, chunk["target"]
+                )
+                counts += np.bincount(
+                    np.searchsorted(nodes, chunk["source"]), minlength=len(nodes)
+                )
+            neighbors.flush()
+            del neighbors, merged
+            os.replace(path + ".tmp", path)
+            offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+            _copy_npy(os.path.join(dirname, f"{key}_offsets.npy"), offsets, chunk_rows)
+        swap_generation(adjacency_fname, dirname)
+    except OSError:
+        sys.stderr.write(f"ERROR: {store_dirname} is not writeable!\n")
+        return None
+    shutil.rmtree(build_dirname, ignore_errors=True)
+    return AdjacencyStore.load(adjacency_fname)
+
+
+def build_graph_store(adjacency, fname_base, budget=GRAPH_MEMORY_BUDGET):
+    """
+    The full graph of every user with both lists non-empty, built from
+    scratch within about `budget` bytes of memory.  Its edges stay
+    memory-mapped from `fname_base`.build until the next build; save()
+    writes them out in chunks.
+    """
+    build_dirname = _build_dirname(fname_base)
+    shutil.rmtree(build_dirname, ignore_errors=True)
+    rows = np.flatnonzero(
+        np.logical_and.reduce([adjacency.degrees(key) > 0 for key in COUNT_KEYS])
+    )
+    print(f"Building graph for {len(rows)} users out of core...")
+
+    # edges as (source, target) adjacency indices: ids sort the same way
+    edges = ExternalSort(
+        os.path.join(build_dirname, "edges"), EDGE_DTYPE, budget, unique=True
+    )
+    list_lengths = sum(adjacency.degrees(key)[rows] for key in COUNT_KEYS)
+    ends = np.cumsum(list_lengths)
+    limit = max(budget // 4 // EDGE_DTYPE.itemsize, 1)
+    list_sums = {key: np.zeros(len(rows), dtype=np.uint64) for key in COUNT_KEYS}
+    start = 0
+    while start < len(rows):
+        done = ends[start - 1] if start else 0
+        batch_ends = ends[start:] - done
+        stop = start + max(1, int(np.searchsorted(batch_ends, limit, side="right")))
+        batch = rows[start:stop]
+        followers, users = adjacency.edge_indices("followers", batch)[::-1]
+        edges.add(edge_records(followers, users))
+        edges.add(edge_records(*adjacency.edge_indices("friends", batch)))
+        for key in COUNT_KEYS:
+            list_sums[key][start:stop] = adjacency.checksums(key, batch)
+        start = stop
+
+    merged = edges.finish(os.path.join(build_dirname, "edge_indices.npy"))
+    num_nodes = len(adjacency)
+    chunk_rows = max(budget // 32, 1)
+    degrees = {kind: np.zeros(num_nodes, dtype=np.int64) for kind in DEGREE_KINDS}
+    for begin in range(0, len(merged), chunk_rows):
+        chunk = merged[begin : begin + chunk_rows]
+        degrees["out"] += np.bincount(chunk["source"], minlength=num_nodes)
+        degrees["in"] += np.bincount(chunk["target"], minlength=num_nodes)
+    present = (degrees["out"] > 0) | (degrees["in"] > 0)
+
+    path = os.path.join(build_dirname, "edges.npy")
+    edge_ids = open_memmap(path, mode="w+", dtype=EDGE_DTYPE, shape=(len(merged),))
+    for begin in range(0, len(merged), chunk_rows):
+        chunk = merged[begin : begin + chunk_rows]
+        stop = begin + len(chunk)
+        edge_ids["source"][begin:stop] = adjacency.nodes[chunk["source"]]
+        edge_ids["target"][begin:stop] = adjacency.nodes[chunk["target"]]
+    edge_ids.flush()
+    del edge_ids, merged
+    os.remove(os.path.join(build_dirname, "edge_indices.npy"))
+
+    store = GraphStore(fname_base)
+    store.edges = np.load(path, mmap_mode="r")
+    store.nodes = np.asarray(adjacency.nodes[present])
+    for kind in DEGREE_KINDS:
+        kind_degrees = degrees[kind][present]
+        store.degrees[kind] = kind_degrees
+        squares = (kind_degrees.astype(np.float64) ** 2).sum()
+        store.stats[kind] = np.array([kind_degrees.sum(), squares], dtype=np.float64)
+    list_degrees = {key: adjacency.degrees(key)[rows] for key in COUNT_KEYS}
+    store.mark(adjacency.nodes[rows], list_degrees, list_sums)
+    print(f"{len(store.edges)} edges in the full graph")
+    return store
@@ -0,0 +1,126 @@
+import gzip
+import hashlib
+import os
+from collections import OrderedDict, namedtuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+Payload = namedtuple("Payload", ["etag", "bodies"])
+SUFFIXES = {"identity": "", "gzip": ".gz", "br": ".br"}
+
+
+def make_payload(body):
+    """
+    Wrap a serialized response body with its strong ETag and every
+    content encoding we can serve it in.
+    """
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    bodies = {"identity": body, "gzip": gzip.compress(body, compresslevel=9)}
+    if brotli is not None:
+        bodies["br"] = brotli.compress(body)
+    return Payload(hashlib.sha1(body).hexdigest(), bodies)
+
+
+def _encodings():
+    return ["identity", "gzip"] + (["br"] if brotli is not None else [])
+
+
+class PayloadCache:
+    """
+    In-process cache of pre-rendered payloads, with an optional on-disk
+    copy (every encoded body under `dirname`) so that other workers and
+    restarts can skip rendering and compressing.  Keys are (version, name)
+    pairs, where the version changes whenever the underlying data does.
+    With `max_entries`, the least recently used payloads are dropped from
+    memory once there are more than that.
+    """
+
+    def __init__(self, dirname=None, max_entries=None):
+        self.dirname = dirname
+        self.max_entries = max_entries
+        self.payloads = OrderedDict()
+
+    def _path(self, version, name, encoding="gzip"):
+        suffix = SUFFIXES[encoding]
+        return os.path.join(self.dirname, f"{version}-{name}.json{suffix}")
+
+    def _read(self, version, name):
+        bodies = {}
+        for encoding in _encodings():
+            try:
+                with open(self._path(version, name, encoding), "rb") as body_file:
+                    bodies[encoding] = body_file.read()
+            except FileNotFoundError:
+                pass
+        if len(bodies) == len(_encodings()):
+            return Payload(hashlib.sha1(bodies["identity"]).hexdigest(), bodies)
+        # written without brotli, or cut short; the gzip body is written
+        # last, so it is complete if it is there at all
+        if "gzip" in bodies:
+            return make_payload(gzip.decompress(bodies["gzip"]))
+        return None
+
+    def get(self, version, name):
+        key = (version, name)
+        if key in self.payloads:
+            self.payloads.move_to_end(key)
+            return self.payloads[key]
+        if self.dirname is None:
+            return None
+        payload = self._read(version, name)
+        if payload is not None:
+            self._remember(key, payload)
+        return payload
+
+    def _remember(self, key, payload):
+        self.payloads[key] = payload
+        self.payloads.move_to_end(key)
+        while self.max_entries is not None and len(self.payloads) > self.max_entries:
+            self.payloads.popitem(last=False)
+
+    def put(self, version, name, body):
+        payload = make_payload(body)
+        self._remember((version, name), payload)
+        if self.dirname is not None:
+            try:
+                os.makedirs(self.dirname, exist_ok=True)
+                encodings = sorted(payload.bodies, key=lambda enc: enc == "gzip")
+                for encoding in encodings:
+                    path = self._path(version, name, encoding)
+                    with open(path + ".tmp", "wb") as payload_file:
+                        payload_file.write(payload.bodies[encoding])
+                    os.replace(path + ".tmp", path)
+            except OSError:
+                print(f"Could not write payload cache to {self.dirname}")
+        return payload
+
+    def clear(self, keep_version=None):
+        """
+        Forget every payload not belonging to `keep_version`, in memory
+        and on disk.
+        """
+        self.payloads = OrderedDict(
+            (key, value)
+            for key, value in self.payloads.items()
+            if key[0] == keep_version
+        )
+        if self.dirname is None:
+            return
+        try:
+            fnames = os.listdir(self.dirname)
+        except OSError:
+            return
+        for fname in fnames:
+            if fname.startswith(f"{keep_version}-"):
+                continue
+            # another process may be clearing the same directory
+            try:
+                os.remove(os.path.join(self.dirname, fname))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                print(f"Could not remove {fname} from the payload cache")
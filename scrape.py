@@ -1,8 +1,8 @@
-import datetime as dt
+import heapq
+import os
 import random
 
 # import signal
-import multiprocessing
 import sys
 from secrets import KEYWORDS
 
@@ -10,24 +10,146 @@ import tweepy
 from OpenSSL.SSL import WantReadError
 from urllib3.exceptions import ProtocolError
 
+from adjacency import COUNT_KEYS
+from backends import TwitterBackend, make_backend
+from context import DataContext, lazy
+from expand import ExpansionEngine, progress_key
 from global_vars import (
+    EXPAND_PROGRESS_FNAME,
+    EXPAND_WORKERS,
     FILE_NOT_FOUND_EXIT_CODE,
+    LOG_FLUSH_EVERY,
+    LOG_FOLD_BYTES,
     NUM_TWEETS_TO_GRAB,
-    TWEETS_FNAME,
+    RESCRAPE_USERS,
+    SCRAPE_BACKEND,
+    TWEET_RETENTION,
+    TWEET_ROLLUP_FNAME,
+    TWEET_STORE_FNAME,
     USER_DICT_FNAME,
 )
+from instrument import STAGE_SECONDS, counter, serve_metrics
+from segment_log import SegmentLog
+from snapshots import snapshot_adjacency
+from tweet_store import TweetStore
 from utils import (
     authenticate_twitter,
-    compile_users_n_others,
+    fold_log,
+    load_adjacency,
+    load_tweet_rollups,
+    load_tweet_store,
+    new_user,
+    recent_tweet_ids,
     reload_object,
-    json_it,
     reload_json,
+    reload_users,
+    rollup_tweet,
 )
 
 GRAB_NEW = False
+RESUME_EXPANSION = True
+TWEETS_SEEN = counter("scraped_tweets_total", "Tweets received, new or duplicate")
 
-TWEET_DICT = reload_object(TWEETS_FNAME, dict)
-USER_DICT = reload_object(USER_DICT_FNAME, dict)
+
+class ScrapeData(DataContext):
+    @lazy
+    def tweets(self):
+        if TWEET_RETENTION == "full":
+            return load_tweet_store()
+        return TweetStore(keep=False, seen=recent_tweet_ids())
+
+    @lazy
+    def tweet_rollups(self):
+        return load_tweet_rollups()
+
+    @lazy
+    def user_dict(self):
+        # the friends/followers lists are read from the adjacency store
+        return reload_users()
+
+    @lazy
+    def tweet_log(self):
+        # every tweet is set once, so compacting would only cost memory
+        return SegmentLog(TWEET_STORE_FNAME, max_segments=None)
+
+    @lazy
+    def rollup_log(self):
+        return SegmentLog(TWEET_ROLLUP_FNAME)
+
+    @lazy
+    def user_log(self):
+        return SegmentLog(USER_DICT_FNAME)
+
+    @lazy
+    def expand_progress(self):
+        return reload_object(EXPAND_PROGRESS_FNAME, dict)
+
+    @lazy
+    def progress_log(self):
+        return SegmentLog(EXPAND_PROGRESS_FNAME)
+
+    @lazy
+    def adjacency(self):
+        return load_adjacency()
+
+
+DATA = ScrapeData()
+
+
+@STAGE_SECONDS.time(stage="checkpoint")
+def checkpoint():
+    """
+    Write out everything appended to the tweet, user and expansion
+    progress logs since the last checkpoint, and merge any newly expanded
+    users into the adjacency store.
+    """
+    for name in ("tweet_log", "rollup_log", "user_log", "progress_log"):
+        if DATA.loaded(name) and not getattr(DATA, name).flush():
+            return False
+    if not DATA.loaded("adjacency") or not DATA.adjacency.has_pending():
+        return True
+    return DATA.adjacency.save()
+
+
+def fold_logs():
+    """
+    Fold the user, rollup and expansion progress logs into their
+    snapshots once they pass LOG_FOLD_BYTES, before anything is loaded
+    from them.  The tweet store's log is left alone: with rollup
+    retention it is the tweet store.
+    """
+    for fname_base in (USER_DICT_FNAME, TWEET_ROLLUP_FNAME, EXPAND_PROGRESS_FNAME):
+        if not fold_log(fname_base, LOG_FOLD_BYTES):
+            return False
+    return True
+
+
+def store_tweet(tweet_json):
+    """
+    Add a raw tweet, everything it embeds, and any new users among their
+    authors to the tweet store, the user dictionary and their logs.
+    Returns whether the tweet was new.
+
+    Only the normalized tweets go to the tweet log; they are also kept in
+    memory when TWEET_RETENTION is "full".  The author's rollup is
+    updated for every new tweet.
+    """
+    user_id = tweet_json["user"]["id_str"]
+    user_dict = DATA.user_dict
+
+    added = DATA.tweets.add(tweet_json)
+    for tweet_id, tweet, user_json in added:
+        DATA.tweet_log.set(tweet_id, tweet)
+        if user_json["id_str"] not in user_dict:
+            user_dict[user_json["id_str"]] = new_user(user_json)
+            DATA.user_log.set(user_json["id_str"], user_dict[user_json["id_str"]])
+
+    if not added or added[-1][0] != tweet_json["id_str"]:
+        TWEETS_SEEN.inc(result="duplicate")
+        return False
+    TWEETS_SEEN.inc(result="new")
+    DATA.rollup_log.set(user_id, rollup_tweet(DATA.tweet_rollups, user_id, tweet_json))
+    return True
 
 
 class StreamListener(tweepy.StreamListener):
@@ -44,38 +166,22 @@ class StreamListener(tweepy.StreamListener):
 
     def on_status(self, tweet):
         user_id = tweet.user.id_str
-        tweet_json = tweet._json
-
-        if user_id not in TWEET_DICT:
+        if user_id not in DATA.tweet_rollups:
             self.new_users += 1
 
-        init_len = 0
-        try:
-            init_len = len(TWEET_DICT[user_id])
-            TWEET_DICT[user_id].append(tweet_json)
-        except KeyError:
-            TWEET_DICT[user_id] = [tweet_json]
-
-        if user_id not in USER_DICT:
-            USER_DICT[user_id] = tweet.user._json
-            USER_DICT[user_id]["followers"] = []
-            USER_DICT[user_id]["friends"] = []
-
-        # update tweet num
-        after_len = len(TWEET_DICT[user_id])
-        if init_len < after_len:
+        if store_tweet(tweet._json):
             self.new_tweets += 1
 
         if self.num_to_grab > 0 and self.new_tweets >= self.num_to_grab:
-            if self.pickle and not json_it(TWEET_DICT, TWEETS_FNAME):
-                sys.stderr.write(f"ERROR: Failed final pickling, abort!\n")
-                sys.exit(FILE_NOT_FOUND_EXIT_CODE)
-            if self.pickle and not json_it(USER_DICT, USER_DICT_FNAME):
+            if self.pickle and not checkpoint():
                 sys.stderr.write(f"ERROR: Failed final pickling, abort!\n")
                 sys.exit(FILE_NOT_FOUND_EXIT_CODE)
             self.reset_state()
             return False
 
+        if self.pickle and self.new_tweets % LOG_FLUSH_EVERY == 0:
+            checkpoint()
+
         if self.new_tweets % 100 == 0:
             print(f"currently scraped {self.new_tweets} new tweets")
 
@@ -108,55 +214,47 @@ class StreamListener(tweepy.StreamListener):
         self.new_users = 0
 
 
-def expand_user_list(user_id, api_obj, count_key):
+def expand_neighbors(
+    fetcher,
+    workers=EXPAND_WORKERS,
+    buckets=None,
+    resume=True,
+    rescrape=RESCRAPE_USERS,
+):
     """
-    Given a user, a Twitter api object, and a dictionary key:
-    Scrape twitter for that users friends/followers (depending on the key)
-    and add this information back into the user dictionary.
+    Iterate through the user dict, find the users whose friends and
+    followers haven't been scraped yet, and hand them to the concurrent
+    expansion engine, which adds each page to the adjacency store as it
+    arrives.  The `rescrape` users expanded longest ago have their lists
+    fetched again too, so that follower snapshots record churn.
+
+    The engine saves each list's cursor after every page.  With `resume`,
+    lists an earlier run stopped part way through carry on from their
+    saved cursor; without it, they are fetched again from the start.
     """
-    now = dt.datetime.now()
-    print(
-        "(%s) (id=%s) Expanding %s"
-        % (now.strftime("%a, %b %d %I:%M %p"), user_id, count_key)
-    )
-    user_cursor = tweepy.Cursor(api_obj, user_id=user_id)
-    pages = []
-    try:
-        pages = list(user_cursor.pages())
-    except tweepy.error.TweepError:
-        print("This user has protected tweets, skipping")
-    return
-    for user_id_page in pages:
-        users_on_page = []
-        for other_user_id in user_id_page:
-            users_on_page.append(other_user_id)
-        USER_DICT[user_id][count_key] += users_on_page
-    if not json_it(USER_DICT, USER_DICT_FNAME):
-        sys.stderr.write(f"failed to pickle after processing user {user_id}")
-
-
-def expand_neighbors(api):
-    """
-    Iterate through the user dict, scrape twitter for their friends
-    and followers, and add this information back into the dictionary
-    (pickling at the end).
-    """
-    for i, user_id in enumerate(USER_DICT):
-        print(f"expanding {user_id}'s friends")
-        if USER_DICT[user_id]["followers"] == 0:
-            USER_DICT[user_id]["followers"] = []
-        if USER_DICT[user_id]["friends"] == 0:
-            USER_DICT[user_id]["friends"] = []
-        num_actual_followers = len(USER_DICT[user_id]["followers"])
-        num_actual_friends = len(USER_DICT[user_id]["friends"])
-
-        num_expected_followers = USER_DICT[user_id]["followers_count"]
-
-        num_expected_friends = USER_DICT[user_id]["friends_count"]
-        if num_actual_followers == 0:
-            expand_user_list(user_id, api.followers_ids, "followers")
-            expand_user_list(user_id, api.friends_ids, "friends")
-        elif num_actual_followers != num_expected_followers:
+    user_dict = DATA.user_dict
+    progress = DATA.expand_progress if resume else {}
+    user_ids = list(user_dict)
+    int_ids = [int(user_id) for user_id in user_ids]
+    degrees = {key: DATA.adjacency.degrees_of(int_ids, key) for key in COUNT_KEYS}
+    to_expand = []
+    expanded = []
+    for i, user_id in enumerate(user_ids):
+        num_actual_followers = degrees["followers"][i]
+        num_actual_friends = degrees["friends"][i]
+
+        num_expected_followers = user_dict[user_id]["followers_count"]
+
+        num_expected_friends = user_dict[user_id]["friends_count"]
+        unfinished = any(
+            progress.get(progress_key(user_id, key), {}).get("cursor", 0) != 0
+            for key in ("followers", "friends")
+        )
+        if num_actual_followers == 0 or unfinished:
+            to_expand.append(user_id)
+            continue
+        expanded.append(user_id)
+        if num_actual_followers != num_expected_followers:
             print(
                 f"mismatched follower count: {num_actual_followers}, but expected {num_expected_followers}"
             )
@@ -166,60 +264,78 @@ def expand_neighbors(api):
                 f"mismatched follower count: {num_actual_friends}, but expected {num_expected_friends}"
             )
             print(f"Check userid {user_id}")
-        print(f"finished {user_id}'s friends\n")
-        if (i + 1) % 100 == 0:
-            print("=====================")
-            print("Processed %06d users" % (i + 1))
-            print("=====================")
-            print()
-
-
-def stream_user_tweets():
-
-    users = compile_users_n_others()
-
-    api = authenticate_twitter()
-    stream_listener = StreamListener(num_to_grab=-1, pickle=False)
-    stream = tweepy.Stream(auth=api.auth, listener=stream_listener)
-    for i, representative in enumerate(users):
-        print(f"Streaming from user group {i} (representative user {representative})")
-        user_set = users[representative]
-        user_set.add(representative)
-
-        def get_tweets():
-            stream.filter(follow=user_set, stall_warnings=True)
-
-        p = multiprocessing.Process(target=get_tweets)
-        p.start()
-        p.join(150)
-        p.terminate()
-        p.join()
-        if (i + 1) % 50 == 0:
-            if not json_it(TWEET_DICT, TWEETS_FNAME):
-                sys.stderr.write(f"ERROR: Failed final pickling, abort!\n")
-                sys.exit(FILE_NOT_FOUND_EXIT_CODE)
-            if not json_it(USER_DICT, USER_DICT_FNAME):
-                sys.stderr.write(f"ERROR: Failed final pickling, abort!\n")
-                sys.exit(FILE_NOT_FOUND_EXIT_CODE)
+
+    engine = ExpansionEngine(
+        fetcher,
+        user_dict,
+        DATA.user_log,
+        workers=workers,
+        buckets=buckets,
+        adjacency=DATA.adjacency,
+        progress=progress,
+        progress_log=DATA.progress_log,
+    )
+    refetch = heapq.nsmallest(rescrape, expanded, key=engine.last_fetched)
+    engine.restart(refetch)
+    print(
+        f"Expanding {len(to_expand)} users, and {len(refetch)} again, "
+        f"with {workers} workers"
+    )
+    stats = engine.run(to_expand + refetch)
+    print("=====================")
+    print("Processed %06d users" % stats["users"])
+    print(f"{engine.users_per_window():.1f} users per rate-limit window")
+    print("=====================")
+    print()
+
+
+def stream_user_tweets(backend=None, **kwargs):
+    """
+    Stream statuses from `backend` (Twitter by default) into the store,
+    checkpointing the logs as they come in.  The Twitter backend streams
+    every follow-filter batch from compile_users_n_others, with shard
+    processes forwarding tweets to this process to store.
+    """
+    backend = backend or TwitterBackend()
+    stats = backend.stream(
+        store_tweet, checkpoint, checkpoint_every=LOG_FLUSH_EVERY, **kwargs
+    )
+    print(f"Streamed {stats['tweets']} tweets")
+    if not checkpoint():
+        sys.stderr.write(f"ERROR: Failed final pickling, abort!\n")
+        sys.exit(FILE_NOT_FOUND_EXIT_CODE)
 
 
 def main():
     global GRAB_NEW
-    api = authenticate_twitter()
+    if os.environ.get("METRICS_PORT"):
+        serve_metrics(int(os.environ["METRICS_PORT"]))
+    fold_logs()
+    backend = make_backend(SCRAPE_BACKEND)
 
-    if GRAB_NEW:
+    if GRAB_NEW and SCRAPE_BACKEND == "twitter":
+        api = authenticate_twitter()
         stream_listener = StreamListener()
         stream = tweepy.Stream(auth=api.auth, listener=stream_listener)
         stream.filter(track=KEYWORDS, stall_warnings=True)
-    expand_neighbors(api)
-    stream_user_tweets()
+    if SCRAPE_BACKEND == "mastodon":
+        # Mastodon users can only be expanded once a status of theirs is seen
+        stream_user_tweets(backend)
+    expand_neighbors(
+        backend.fetcher(DATA.user_dict),
+        buckets=backend.buckets(),
+        resume=RESUME_EXPANSION,
+    )
+    snapshot_adjacency(DATA.adjacency)
+    if SCRAPE_BACKEND == "twitter":
+        stream_user_tweets(backend)
+    backend.close()
 
 
 if __name__ == "__main__":
     try:
         main()
     except KeyboardInterrupt:
-        print("Recieved siginterrupt, jsoning objects and exiting")
-        json_it(TWEET_DICT, TWEETS_FNAME)
-        json_it(USER_DICT, USER_DICT_FNAME)
+        print("Recieved siginterrupt, flushing logs and exiting")
+        checkpoint()
         sys.exit(1)
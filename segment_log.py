@@ -0,0 +1,386 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+
+import ujson
+
+from global_vars import LOG_MAX_SEGMENTS, LOG_SEGMENT_BYTES
+from instrument import FILE_WRITE_BYTES, FILE_WRITE_SECONDS
+
+_SEGMENT_RE = re.compile(r"^(\d{8})(c?)\.jsonl\.gz$")
+FOLD_MARKER = "folded.json"
+
+
+def log_dirname(fname_base):
+    return fname_base + ".log"
+
+
+def snapshot_digest(path):
+    """
+    SHA-1 of a snapshot file, or of the schema of a column store
+    directory; None if there is none.
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, "schema.json")
+    digest = hashlib.sha1()
+    try:
+        with open(path, "rb") as snapshot_file:
+            for block in iter(lambda: snapshot_file.read(1 << 20), b""):
+                digest.update(block)
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()
+
+
+def _apply(obj, op, key, field, value):
+    if field is None:
+        container, slot = obj, key
+    else:
+        container, slot = obj.setdefault(key, {}), field
+
+    if op == "set":
+        container[slot] = value
+    elif op == "append":
+        container.setdefault(slot, []).append(value)
+    elif op == "extend":
+        container.setdefault(slot, []).extend(value)
+    elif op == "update":
+        container.setdefault(slot, {}).update(value)
+    else:
+        raise ValueError(f"Unknown log operation {op}")
+
+
+def _merge(ops, entry):
+    """
+    Fold a single log entry into the list of pending operations for a key,
+    collapsing it into the previous operation when that doesn't change the
+    result of replaying the log.
+    """
+    op, key, field, value = entry
+    if op == "set" and field is None:
+        ops[:] = [entry]
+        return
+    if not ops or ops[-1][2] != field:
+        if ops and ops[-1][0] == "set" and ops[-1][2] is None and field is not None:
+            _apply({key: ops[-1][3]}, op, key, field, value)
+            return
+        ops.append(entry)
+        return
+
+    last_op, _, _, last_value = ops[-1]
+    if op == "set":
+        ops[-1] = entry
+    elif last_op == "set" and isinstance(last_value, list) and op == "append":
+        last_value.append(value)
+    elif last_op == "set" and isinstance(last_value, list) and op == "extend":
+        last_value.extend(value)
+    elif last_op == "set" and isinstance(last_value, dict) and op == "update":
+        last_value.update(value)
+    elif last_op in ("append", "extend") and op in ("append", "extend"):
+        items = [last_value] if last_op == "append" else last_value
+        items = items + ([value] if op == "append" else value)
+        ops[-1] = ["extend", key, field, items]
+    elif last_op == "update" and op == "update":
+        last_value.update(value)
+    else:
+        ops.append(entry)
+
+
+class SegmentLog:
+    """
+    Append-only log of updates to a dictionary, stored as a directory of
+    gzipped JSON-lines segments next to the object's snapshot.  Appends are
+    buffered in memory and written out by flush(), so a checkpoint only
+    costs as much as the entries added since the last one.
+
+    Every log object starts a segment of its own rather than appending to
+    one a previous process may have been killed in the middle of writing;
+    a torn write can then only be at the end of a segment, where replay
+    stops.
+
+    fold() writes the log into the snapshot and removes it.  Until the
+    folded segments are gone, a marker names the last of them and the
+    digest of the snapshot holding them; while the snapshot on disk
+    matches it, those segments are skipped, so a crash at any point
+    never replays them over a snapshot that has them already.
+
+    Once there are more than `max_segments` segments, flush() compacts
+    them, which holds the whole log's state in memory.  Logs that only
+    ever set new keys gain nothing from that, and should pass
+    max_segments=None to keep their segments as they are.
+    """
+
+    def __init__(
+        self,
+        fname_base,
+        segment_bytes=LOG_SEGMENT_BYTES,
+        max_segments=LOG_MAX_SEGMENTS,
+    ):
+        self.fname_base = fname_base
+        self.dirname = log_dirname(fname_base)
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.pending = []
+        self.segment = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    def set(self, key, value, field=None):
+        self.pending.append(["set", key, field, value])
+
+    def append(self, key, value, field=None):
+        self.pending.append(["append", key, field, value])
+
+    def extend(self, key, values, field=None):
+        self.pending.append(["extend", key, field, list(values)])
+
+    def update(self, key, value, field=None):
+        self.pending.append(["update", key, field, value])
+
+    def _all_segments(self):
+        if not os.path.isdir(self.dirname):
+            return []
+        found = []
+        for name in os.listdir(self.dirname):
+            match = _SEGMENT_RE.match(name)
+            if match:
+                seq, compacted = int(match.group(1)), bool(match.group(2))
+                found.append((seq, compacted, os.path.join(self.dirname, name)))
+        return sorted(found)
+
+    def _marker_path(self):
+        return os.path.join(self.dirname, FOLD_MARKER)
+
+    def folded_through(self):
+        """
+        The last segment already in the snapshot, going by the fold
+        marker, or 0.
+        """
+        try:
+            with open(self._marker_path()) as marker_file:
+                marker = json.load(marker_file)
+        except (FileNotFoundError, ValueError):
+            return 0
+        if snapshot_digest(marker["path"]) != marker["sha1"]:
+            return 0
+        return marker["through"]
+
+    def segments(self):
+        """
+        Return (sequence number, path) for each live segment, oldest first.
+        Segments older than the latest compacted one, or already folded
+        into the snapshot, are left out.
+        """
+        found = self._all_segments()
+        through = self.folded_through() if found else 0
+        found = [segment for segment in found if segment[0] > through]
+        start = 0
+        for i, (_, compacted, _) in enumerate(found):
+            if compacted:
+                start = i
+        return [(seq, path) for seq, _, path in found[start:]]
+
+    def _segment_path(self, seq, compacted=False):
+        marker = "c" if compacted else ""
+        return os.path.join(self.dirname, f"{seq:08d}{marker}.jsonl.gz")
+
+    def _writable_segment(self):
+        if (
+            self.segment is not None
+            and os.path.exists(self.segment)
+            and os.path.getsize(self.segment) < self.segment_bytes
+        ):
+            return self.segment
+        # numbered after every segment on disk, folded or not
+        segments = self._all_segments()
+        seq = segments[-1][0] if segments else 0
+        self.segment = self._segment_path(seq + 1)
+        return self.segment
+
+    def flush(self):
+        if not self.pending:
+            return True
+        try:
+            with FILE_WRITE_SECONDS.time(file=self.dirname):
+                os.makedirs(self.dirname, exist_ok=True)
+                path = self._writable_segment()
+                size = os.path.getsize(path) if os.path.exists(path) else 0
+                with gzip.open(path, "at") as segment:
+                    for entry in self.pending:
+                        segment.write(ujson.dumps(entry))
+                        segment.write("\n")
+            FILE_WRITE_BYTES.inc(os.path.getsize(path) - size, file=self.dirname)
+        except OSError:
+            sys.stderr.write(f"ERROR: {self.dirname} is not writeable!\n")
+            return False
+        print(f"Appended {len(self.pending)} entries to {self.dirname}")
+        self.pending = []
+        if (
+            self.max_segments is not None
+            and len(self.segments()) > self.max_segments
+        ):
+            self.compact()
+        return True
+
+    def _segment_entries(self, path):
+        try:
+            with gzip.open(path, "rt") as segment:
+                for line in segment:
+                    if line.strip():
+                        yield ujson.loads(line)
+        except (EOFError, OSError, ValueError):
+            sys.stderr.write(f"WARNING: {path} ends in a torn write\n")
+
+    def entries(self):
+        for _, path in self.segments():
+            yield from self._segment_entries(path)
+
+    def recent_keys(self, limit):
+        """
+        The keys of the newest segments, read newest first until there
+        are at least `limit` of them (or the log runs out).
+        """
+        keys = set()
+        for _, path in reversed(self.segments()):
+            if len(keys) >= limit:
+                break
+            keys.update(entry[1] for entry in self._segment_entries(path))
+        return keys
+
+    def replay(self, obj):
+        for op, key, field, value in self.entries():
+            _apply(obj, op, key, field, value)
+        return obj
+
+    def ops_by_key(self):
+        """
+        The log's entries grouped, and collapsed where possible, by key,
+        for replaying onto records one at a time with replay_ops().
+        """
+        by_key = {}
+        for entry in self.entries():
+            _merge(by_key.setdefault(entry[1], []), entry)
+        return by_key
+
+    def fold(self, write):
+        """
+        Replace the snapshot with one that has the log applied, and drop
+        the log.  write(mark) must write the snapshot to a temporary path
+        and call mark(tmp_path, path) before moving it into place, and
+        return whether it succeeded.  Appends from other processes while
+        this runs would be lost, so only one process may write the log.
+        """
+        # finish any earlier fold first, so its marker isn't overwritten
+        # while the snapshot still relies on it
+        if not self._drop_folded(self.folded_through()):
+            return False
+        segments = self.segments()
+        if not segments:
+            return write(None)
+        through = segments[-1][0]
+
+        def mark(tmp_path, path):
+            marker = {
+                "through": through,
+                "path": path,
+                "sha1": snapshot_digest(tmp_path),
+            }
+            with open(self._marker_path() + ".tmp", "w") as marker_file:
+                json.dump(marker, marker_file)
+            os.replace(self._marker_path() + ".tmp", self._marker_path())
+
+        if not write(mark) or not self._drop_folded(through):
+            return False
+        print(f"Folded {len(segments)} segments of {self.dirname} into the snapshot")
+        return True
+
+    def _drop_folded(self, through):
+        """
+        Remove the segments up to `through`, then the fold marker.
+        """
+        try:
+            for seq, _, path in self._all_segments():
+                if seq <= through:
+                    os.remove(path)
+            if os.path.exists(self._marker_path()):
+                os.remove(self._marker_path())
+        except OSError:
+            sys.stderr.write(f"ERROR: {self.dirname} is not writeable!\n")
+            return False
+        return True
+
+    def compact(self):
+        """
+        Collapse every live segment into a single compacted segment.  The
+        compacted file is renamed into place before the old segments are
+        removed, and replay() ignores anything older than it, so a crash
+        part way through never duplicates entries.
+        """
+        segments = self.segments()
+        if len(segments) < 2:
+            return True
+        print(f"Compacting {len(segments)} segments in {self.dirname}")
+        by_key = self.ops_by_key()
+
+        last_seq = segments[-1][0]
+        final_path = self._segment_path(last_seq, compacted=True)
+        tmp_path = final_path + ".tmp"
+        with gzip.open(tmp_path, "wt") as segment:
+            for ops in by_key.values():
+                for entry in ops:
+                    segment.write(ujson.dumps(entry))
+                    segment.write("\n")
+        os.replace(tmp_path, final_path)
+        for _, path in segments:
+            if path != final_path:
+                os.remove(path)
+        return True
+
+
+class NullLog:
+    """
+    Stands in for a SegmentLog where nothing needs to be persisted, e.g.
+    in demos against the fake API servers.
+    """
+
+    def __len__(self):
+        return 0
+
+    def set(self, key, value, field=None):
+        pass
+
+    def append(self, key, value, field=None):
+        pass
+
+    def extend(self, key, values, field=None):
+        pass
+
+    def update(self, key, value, field=None):
+        pass
+
+    def flush(self):
+        return True
+
+
+def has_log(fname_base):
+    return bool(SegmentLog(fname_base).segments())
+
+
+def replay_ops(record, key, ops):
+    """
+    `key`'s record with its entries from SegmentLog.ops_by_key() applied.
+    """
+    obj = {key: record}
+    for op, _, field, value in ops:
+        _apply(obj, op, key, field, value)
+    return obj[key]
+
+
+def replay_log(obj, fname_base):
+    if isinstance(obj, dict) and os.path.isdir(log_dirname(fname_base)):
+        SegmentLog(fname_base).replay(obj)
+    return obj
@@ -0,0 +1,272 @@
+import itertools
+import multiprocessing
+import threading
+import time
+from collections import deque
+from queue import Empty
+
+import requests
+import tweepy
+import ujson
+
+from global_vars import STREAM_DWELL, STREAM_GRACE, STREAM_SHARDS
+from utils import authenticate_twitter
+
+
+class ForwardingListener(tweepy.StreamListener):
+    def __init__(self, emit, stop):
+        super().__init__()
+        self.emit = emit
+        self.stop = stop
+
+    def on_status(self, tweet):
+        self.emit(tweet._json)
+        return not self.stop.is_set()
+
+    def keep_alive(self):
+        return not self.stop.is_set()
+
+    def on_error(self, status_code):
+        if status_code == 420:
+            # Rate Limited
+            return False
+
+    def on_exception(self, exception):
+        print(f"Stream error {exception}, abandoning shard")
+        return False
+
+
+class TwitterSource:
+    """
+    Follow-filter streams from the Twitter streaming API.
+    """
+
+    def stream(self, follow, emit, stop):
+        api = authenticate_twitter()
+        stream = tweepy.Stream(auth=api.auth, listener=ForwardingListener(emit, stop))
+
+        def disconnect():
+            stop.wait()
+            stream.disconnect()
+
+        threading.Thread(target=disconnect, daemon=True).start()
+        stream.filter(follow=list(follow), stall_warnings=True)
+
+
+class HttpSource:
+    """
+    Follow-filter streams from any endpoint speaking the statuses/filter
+    protocol (newline-delimited JSON), e.g. the local stand-in in
+    fake_api.py.
+    """
+
+    def __init__(self, url):
+        self.url = url
+
+    def stream(self, follow, emit, stop):
+        response = requests.post(
+            self.url, data={"follow": ",".join(follow)}, stream=True, timeout=90
+        )
+        try:
+            for line in response.iter_lines(chunk_size=None):
+                if stop.is_set():
+                    break
+                if line:
+                    emit(ujson.loads(line))
+        finally:
+            response.close()
+
+
+def _shard_worker(source, run_id, follow, queue, stop):
+    def emit(tweet_json):
+        queue.put((run_id, tweet_json))
+
+    try:
+        source.stream(follow, emit, stop)
+    except Exception as err:
+        print(f"Shard {run_id} failed: {err}")
+    finally:
+        queue.put((run_id, None))
+
+
+class RoundRobin:
+    """
+    Visit every group in order, `sweeps` times, streaming each one for
+    `dwell` seconds.
+    """
+
+    def __init__(self, groups, dwell=STREAM_DWELL, sweeps=1):
+        self.groups = list(groups)
+        self.dwell = dwell
+        self.sweeps_left = sweeps
+        self.rates = {}
+        self.order = deque()
+
+    def refill(self):
+        return self.groups
+
+    def next_group(self, active):
+        if not self.order and self.sweeps_left > 0:
+            self.sweeps_left -= 1
+            self.order.extend(self.refill())
+        for _ in range(len(self.order)):
+            key = self.order.popleft()
+            if key not in active:
+                return key
+            self.order.append(key)
+        return None
+
+    def record(self, key, tweets, seconds):
+        self.rates[key] = tweets / max(seconds, 1e-9)
+
+
+class YieldRotation(RoundRobin):
+    """
+    Round robin on the first sweep; every later sweep visits the groups
+    that produced the most tweets per second first.
+    """
+
+    def refill(self):
+        if not self.rates:
+            return self.groups
+        return sorted(self.groups, key=lambda key: -self.rates.get(key, 0.0))
+
+
+class ShardedStreamer:
+    """
+    Run up to `num_shards` follow-filter streams at once, one process per
+    shard.  Workers only forward raw tweet JSON over a queue; this
+    process is the single owner of the store and hands every tweet to
+    `store`.  The rotation `policy` decides which group each free shard
+    streams next.
+    """
+
+    def __init__(
+        self,
+        source,
+        groups,
+        store,
+        num_shards=STREAM_SHARDS,
+        policy=None,
+        checkpoint=None,
+        checkpoint_every=100,
+        grace=STREAM_GRACE,
+    ):
+        self.source = source
+        self.groups = groups
+        self.store = store
+        self.num_shards = num_shards
+        self.policy = policy or RoundRobin(groups)
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.grace = grace
+        self.run_ids = itertools.count()
+        self.run_keys = {}
+        self.stats = {"tweets": 0, "runs": 0, "terminated": 0, "per_group": {}}
+
+    def _start(self, key, queue):
+        run_id = next(self.run_ids)
+        stop = multiprocessing.Event()
+        proc = multiprocessing.Process(
+            target=_shard_worker,
+            args=(self.source, run_id, list(self.groups[key]), queue, stop),
+            daemon=True,
+        )
+        proc.start()
+        print(f"Streaming from user group {key} on shard run {run_id}")
+        self.stats["runs"] += 1
+        self.run_keys[run_id] = key
+        shard = {
+            "key": key,
+            "proc": proc,
+            "stop": stop,
+            "started": time.monotonic(),
+            "tweets": 0,
+            "done": False,
+            "stopping": None,
+        }
+        return run_id, shard
+
+    def _retire(self, active, now):
+        """
+        Ask shards past their dwell time to stop, and reap the ones that
+        have exited; the queue keeps being drained in the meantime so
+        that their last tweets can still be flushed.  Shards never get
+        terminated here: a process killed while writing to the queue can
+        corrupt it, so shards that haven't exited `grace` seconds after
+        being asked are left to run() to terminate once it has closed
+        the queue.
+        """
+        for run_id, shard in list(active.items()):
+            if shard["stopping"] is None:
+                if shard["done"] or now - shard["started"] >= self.policy.dwell:
+                    shard["stop"].set()
+                    shard["stopping"] = now
+                    seconds = now - shard["started"]
+                    self.policy.record(shard["key"], shard["tweets"], seconds)
+                continue
+            if not shard["proc"].is_alive():
+                shard["proc"].join()
+                del active[run_id]
+
+    def _stuck(self, shard, now):
+        return shard["stopping"] is not None and now - shard["stopping"] >= self.grace
+
+    def _handle(self, active, run_id, tweet_json):
+        if tweet_json is None:
+            if run_id in active:
+                active[run_id]["done"] = True
+            return
+        self.store(tweet_json)
+        self.stats["tweets"] += 1
+        if run_id in active:
+            active[run_id]["tweets"] += 1
+        key = self.run_keys[run_id]
+        self.stats["per_group"][key] = self.stats["per_group"].get(key, 0) + 1
+        if self.stats["tweets"] % self.checkpoint_every == 0:
+            print(f"currently scraped {self.stats['tweets']} new tweets")
+            if self.checkpoint is not None:
+                self.checkpoint()
+
+    def run(self):
+        queue = multiprocessing.Queue()
+        active = {}
+        while True:
+            busy = {shard["key"] for shard in active.values()}
+            running = sum(1 for shard in active.values() if shard["stopping"] is None)
+            while running < self.num_shards:
+                key = self.policy.next_group(busy)
+                if key is None:
+                    break
+                run_id, shard = self._start(key, queue)
+                active[run_id] = shard
+                busy.add(key)
+                running += 1
+            if not active:
+                break
+            now = time.monotonic()
+            if all(self._stuck(shard, now) for shard in active.values()):
+                # nothing left to stream, only shards that won't stop
+                break
+
+            try:
+                self._handle(active, *queue.get(timeout=0.5))
+            except Empty:
+                pass
+            self._retire(active, time.monotonic())
+
+        while True:
+            try:
+                self._handle(active, *queue.get(timeout=self.grace))
+            except Empty:
+                break
+        queue.close()
+        queue.join_thread()
+        for shard in active.values():
+            print(f"Shard for user group {shard['key']} didn't stop, terminating it")
+            shard["proc"].terminate()
+            shard["proc"].join()
+            self.stats["terminated"] += 1
+        if self.checkpoint is not None:
+            self.checkpoint()
+        return self.stats
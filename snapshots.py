@@ -0,0 +1,286 @@
+"""
+Time-versioned snapshots of the friends/followers lists.
+
+Every list is kept sorted and stored as the gaps between consecutive
+ids, each gap a little-endian base-128 varint, so dense runs of ids
+cost a byte or two each.  The first snapshot holds every list; each
+later one only the ids added to and removed from each list since the
+snapshot before it, so the store grows with churn rather than with the
+size of the network.  With SNAPSHOT_KEYFRAME_EVERY set, every so many
+snapshots also hold the full lists, bounding how many diffs have to be
+replayed to rebuild one.
+
+A snapshot's lists are (owners, others) pairs of id arrays per key in
+COUNT_KEYS, sorted by owner and then by the other id.
+"""
+import os
+import re
+import sys
+import time
+
+import numpy as np
+
+from adjacency import COUNT_KEYS
+from global_vars import SNAPSHOT_KEYFRAME_EVERY, SNAPSHOTS_FNAME
+
+_SNAPSHOT_RE = re.compile(r"^(\d{8})(f?)\.npz$")
+_LOW_BITS = np.uint64(0x7F)
+_MORE = np.uint8(0x80)
+
+
+def varint_encode(values):
+    """
+    Unsigned 64-bit `values` as one byte array of LEB128 varints.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    num_bytes = np.ones(len(values), dtype=np.int64)
+    for shift in range(7, 64, 7):
+        num_bytes += values >= np.uint64(1) << np.uint64(shift)
+    ends = np.cumsum(num_bytes)
+    owner = np.repeat(np.arange(len(values)), num_bytes)
+    position = np.arange(ends[-1]) - np.repeat(ends - num_bytes, num_bytes)
+    shifts = (7 * position).astype(np.uint64)
+    data = ((values[owner] >> shifts) & _LOW_BITS).astype(np.uint8)
+    data[position < num_bytes[owner] - 1] |= _MORE
+    return data
+
+
+def varint_decode(data):
+    data = np.asarray(data, dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    ends = np.flatnonzero(data < _MORE) + 1
+    starts = np.concatenate(([0], ends[:-1]))
+    position = np.arange(len(data)) - np.repeat(starts, ends - starts)
+    parts = (data & np.uint8(0x7F)).astype(np.uint64)
+    parts <<= (7 * position).astype(np.uint64)
+    return np.bitwise_or.reduceat(parts, starts)
+
+
+def encode_lists(owners, others):
+    """
+    Sorted (owner, other) pairs as the owners, the length of each of
+    their lists, and the varint gaps within each list.
+    """
+    users, starts, counts = np.unique(owners, return_index=True, return_counts=True)
+    gaps = np.diff(others, prepend=0)
+    gaps[starts] = others[starts]
+    return users, counts, varint_encode(gaps)
+
+
+def decode_lists(users, counts, data):
+    gaps = varint_decode(data)
+    # sums wrap around in uint64, but each list's own sum doesn't
+    totals = np.cumsum(gaps)
+    starts = np.cumsum(counts) - counts
+    before = totals[starts] - gaps[starts]
+    others = (totals - np.repeat(before, counts)).astype(np.int64)
+    return np.repeat(users.astype(np.int64), counts), others
+
+
+def _pair_keys(nodes, owners, others):
+    return np.searchsorted(nodes, owners) * len(nodes) + np.searchsorted(nodes, others)
+
+
+def _key_pairs(nodes, keys):
+    return nodes[keys // len(nodes)], nodes[keys % len(nodes)]
+
+
+def diff_pairs(before, after):
+    """
+    The (added, removed) pairs going from the pairs `before` to `after`.
+    """
+    nodes = np.unique(np.concatenate(before + after))
+    old_keys = _pair_keys(nodes, *before)
+    new_keys = _pair_keys(nodes, *after)
+    added = np.setdiff1d(new_keys, old_keys, assume_unique=True)
+    removed = np.setdiff1d(old_keys, new_keys, assume_unique=True)
+    return _key_pairs(nodes, added), _key_pairs(nodes, removed)
+
+
+def apply_diff(pairs, added, removed):
+    nodes = np.unique(np.concatenate(pairs + added))
+    keys = np.setdiff1d(
+        _pair_keys(nodes, *pairs), _pair_keys(nodes, *removed), assume_unique=True
+    )
+    return _key_pairs(nodes, np.union1d(keys, _pair_keys(nodes, *added)))
+
+
+def adjacency_lists(adjacency):
+    """
+    The lists in an AdjacencyStore as sorted, deduplicated pairs.
+    """
+    num_nodes = len(adjacency)
+    lists = {}
+    for key in COUNT_KEYS:
+        owners, others = adjacency.edge_indices(key)
+        keys = np.unique(owners.astype(np.int64) * num_nodes + others)
+        lists[key] = _key_pairs(adjacency.nodes, keys)
+    return lists
+
+
+def _list_arrays(prefix, key, pairs):
+    users, counts, data = encode_lists(*pairs)
+    return {
+        f"{prefix}_{key}_users": users,
+        f"{prefix}_{key}_counts": counts,
+        f"{prefix}_{key}_data": data,
+    }
+
+
+def _read_lists(data, prefix, key):
+    return decode_lists(
+        data[f"{prefix}_{key}_users"],
+        data[f"{prefix}_{key}_counts"],
+        data[f"{prefix}_{key}_data"],
+    )
+
+
+class SnapshotStore:
+    """
+    Numbered snapshots, one .npz file each in the `fname_base`.snap
+    directory.  Full snapshots are marked with an "f" after their number.
+    """
+
+    def __init__(
+        self, fname_base=SNAPSHOTS_FNAME, keyframe_every=SNAPSHOT_KEYFRAME_EVERY
+    ):
+        self.dirname = fname_base + ".snap"
+        self.keyframe_every = keyframe_every
+        self.cached = None
+
+    def __len__(self):
+        return len(self.snapshots())
+
+    def snapshots(self):
+        """
+        Return (sequence number, whether it is full, path) for every
+        snapshot, oldest first.
+        """
+        if not os.path.isdir(self.dirname):
+            return []
+        found = []
+        for name in os.listdir(self.dirname):
+            match = _SNAPSHOT_RE.match(name)
+            if match:
+                path = os.path.join(self.dirname, name)
+                found.append((int(match.group(1)), bool(match.group(2)), path))
+        return sorted(found)
+
+    def history(self):
+        """
+        Return (sequence number, time taken) for every snapshot.
+        """
+        history = []
+        for seq, _, path in self.snapshots():
+            with np.load(path) as data:
+                history.append((seq, float(data["taken"])))
+        return history
+
+    def seq_at(self, when):
+        """
+        The last snapshot taken at or before the epoch time `when`.
+        """
+        taken = [seq for seq, at in self.history() if at <= when]
+        return taken[-1] if taken else None
+
+    def _find(self, seq):
+        snapshots = self.snapshots()
+        if not snapshots:
+            raise ValueError(f"no snapshots in {self.dirname}")
+        if seq is None:
+            seq = snapshots[-1][0]
+        by_seq = {found[0]: found for found in snapshots}
+        if seq not in by_seq:
+            raise ValueError(f"no snapshot {seq} in {self.dirname}")
+        return seq, by_seq
+
+    def lists(self, seq=None):
+        """
+        Every list as of snapshot `seq` (by default the latest), replayed
+        from the closest full snapshot, or from the last one rebuilt if
+        that is closer.
+        """
+        seq, by_seq = self._find(seq)
+        start = max(s for s, (_, full, _) in by_seq.items() if full and s <= seq)
+        if self.cached is not None and start <= self.cached[0] <= seq:
+            current, lists = self.cached[0], dict(self.cached[1])
+        else:
+            with np.load(by_seq[start][2]) as data:
+                lists = {key: _read_lists(data, "lists", key) for key in COUNT_KEYS}
+            current = start
+        for step in range(current + 1, seq + 1):
+            with np.load(by_seq[step][2]) as data:
+                for key in COUNT_KEYS:
+                    added = _read_lists(data, "added", key)
+                    removed = _read_lists(data, "removed", key)
+                    lists[key] = apply_diff(lists[key], added, removed)
+        self.cached = (seq, dict(lists))
+        return lists
+
+    def diff(self, start, end):
+        """
+        The (added, removed) pairs per key going from snapshot `start` to
+        snapshot `end`; read straight from the store for consecutive
+        snapshots.
+        """
+        end, by_seq = self._find(end)
+        if end == start + 1 and start in by_seq:
+            with np.load(by_seq[end][2]) as data:
+                return {
+                    key: (
+                        _read_lists(data, "added", key),
+                        _read_lists(data, "removed", key),
+                    )
+                    for key in COUNT_KEYS
+                }
+        before = self.lists(start)
+        after = self.lists(end)
+        return {key: diff_pairs(before[key], after[key]) for key in COUNT_KEYS}
+
+    def take(self, lists, taken=None):
+        """
+        Store `lists` (e.g. from adjacency_lists) as a new snapshot and
+        return its number; if nothing changed since the latest snapshot,
+        return that one's instead.
+        """
+        snapshots = self.snapshots()
+        seq = snapshots[-1][0] + 1 if snapshots else 1
+        arrays = {"taken": time.time() if taken is None else taken}
+        if snapshots:
+            previous = self.lists(seq - 1)
+            changes = 0
+            for key in COUNT_KEYS:
+                added, removed = diff_pairs(previous[key], lists[key])
+                changes += len(added[0]) + len(removed[0])
+                arrays.update(_list_arrays("added", key, added))
+                arrays.update(_list_arrays("removed", key, removed))
+            if not changes:
+                print(f"Lists unchanged since snapshot {seq - 1}")
+                return seq - 1
+        full = not snapshots or (
+            self.keyframe_every and (seq - 1) % self.keyframe_every == 0
+        )
+        if full:
+            for key in COUNT_KEYS:
+                arrays.update(_list_arrays("lists", key, lists[key]))
+
+        marker = "f" if full else ""
+        fname = os.path.join(self.dirname, f"{seq:08d}{marker}.npz")
+        try:
+            os.makedirs(self.dirname, exist_ok=True)
+            with open(fname + ".tmp", "wb") as snapshot_file:
+                np.savez(snapshot_file, **arrays)
+            os.replace(fname + ".tmp", fname)
+        except OSError:
+            sys.stderr.write(f"ERROR: {fname} is not writeable!\n")
+            return None
+        print(f"Saved snapshot {seq} ({os.path.getsize(fname)} bytes) to {fname}")
+        self.cached = (seq, dict(lists))
+        return seq
+
+
+def snapshot_adjacency(adjacency, fname_base=SNAPSHOTS_FNAME):
+    return SnapshotStore(fname_base).take(adjacency_lists(adjacency))
@@ -0,0 +1,92 @@
+"""
+Seeded synthetic data for benchmarks: a power-law follower network and a
+tweet corpus, written in the formats reload_json/reload_object expect.
+"""
+import numpy as np
+
+from global_vars import TWEETS_FNAME, USER_DICT_FNAME
+from utils import json_it, pickle_it
+
+ID_OFFSET = 10 ** 6
+SEED_FRACTION = 0.1
+DEGREE_ALPHA = 1.5
+POPULARITY_SKEW = 3.0
+
+
+def power_law_sizes(rng, count, total):
+    """
+    `count` Pareto-distributed list sizes summing to roughly `total`.
+    """
+    weights = rng.pareto(DEGREE_ALPHA, count) + 1
+    return np.maximum(1, (weights / weights.sum() * total).astype(np.int64))
+
+
+def popular_ids(rng, count, population):
+    """
+    `count` user ids drawn from `population` users, skewed so that a few
+    users are very popular, as follower counts are.
+    """
+    ranks = (population * rng.random(count) ** POPULARITY_SKEW).astype(np.int64)
+    return ranks + ID_OFFSET
+
+
+def make_users(num_edges, seed=0):
+    rng = np.random.default_rng(seed)
+    population = max(10, num_edges // 10)
+    num_seeds = max(2, int(population * SEED_FRACTION))
+    seed_ids = rng.choice(population, size=num_seeds, replace=False) + ID_OFFSET
+
+    users = {}
+    sizes = {
+        key: power_law_sizes(rng, num_seeds, num_edges // 2)
+        for key in ("followers", "friends")
+    }
+    for i, user_id in enumerate(seed_ids.tolist()):
+        info = {
+            "id": user_id,
+            "id_str": str(user_id),
+            "screen_name": f"user{user_id}",
+        }
+        for key in ("followers", "friends"):
+            others = np.unique(popular_ids(rng, int(sizes[key][i]), population))
+            info[key] = others.tolist()
+            info[f"{key}_count"] = len(others)
+        users[str(user_id)] = info
+    return users
+
+
+def make_tweets(users, tweets_per_user=3, seed=0):
+    rng = np.random.default_rng(seed + 1)
+    tweet_dict = {}
+    tweet_id = 1
+    for user_id, info in users.items():
+        num = int(rng.poisson(tweets_per_user))
+        if num == 0:
+            continue
+        tweets = []
+        for _ in range(num):
+            tweets.append(
+                {
+                    "id": tweet_id,
+                    "id_str": str(tweet_id),
+                    "text": f"synthetic tweet {tweet_id} from {info['screen_name']}",
+                    "timestamp_ms": str(1500000000000 + tweet_id),
+                    "user": {
+                        key: info[key] for key in ("id", "id_str", "screen_name")
+                    },
+                }
+            )
+            tweet_id += 1
+        tweet_dict[user_id] = tweets
+    return tweet_dict
+
+
+def write_dataset(num_edges, seed=0):
+    """
+    Generate and write users_dict/tweet_dict to the working directory.
+    """
+    users = make_users(num_edges, seed)
+    tweets = make_tweets(users, seed=seed)
+    json_it(users, USER_DICT_FNAME)
+    pickle_it(tweets, TWEETS_FNAME)
+    return users, tweets
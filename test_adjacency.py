@@ -0,0 +1,121 @@
+import os
+
+import adjacency
+from adjacency import COUNT_KEYS, TAIL_FNAME, AdjacencyStore, generation_dirname
+
+USERS = {
+    "10": {"followers": [3, 20, 7], "friends": [20]},
+    "20": {"followers": [10], "friends": [5, 3, 10, 99]},
+    "30": {"followers": [], "friends": [10]},
+}
+
+
+def lists(store, user_ids):
+    return {
+        user_id: {key: store.neighbors_of(user_id, key).tolist() for key in COUNT_KEYS}
+        for user_id in user_ids
+    }
+
+
+def saved(tmp_path, users=USERS):
+    fname_base = str(tmp_path / "adjacency")
+    store = AdjacencyStore.from_user_dict(users, fname_base)
+    assert store.save()
+    return fname_base
+
+
+def test_lists_round_trip_through_disk(tmp_path):
+    fname_base = saved(tmp_path)
+    store = AdjacencyStore.load(fname_base)
+    assert lists(store, USERS) == USERS
+    assert store.nodes.tolist() == sorted(store.nodes.tolist())
+    assert store.index_of([10, 11]).tolist()[1] == -1
+    assert store.degrees_of(["20", "4"], "friends").tolist() == [4, 0]
+    assert sorted(store.seed_ids().tolist()) == [10, 20, 30]
+
+
+def test_tail_is_appended_and_merged_on_read(tmp_path):
+    fname_base = saved(tmp_path)
+    store = AdjacencyStore.load(fname_base, mmap=False)
+    store.add("10", "followers", [8, 9])
+    store.add("40", "friends", [10])
+    assert store.save()
+    # appended to the tail, not written as a new generation
+    assert os.path.getsize(os.path.join(store.dirname, TAIL_FNAME)) > 0
+
+    store = AdjacencyStore.load(fname_base)
+    assert store.unmerged
+    expected = dict(USERS, **{"40": {"followers": [], "friends": [10]}})
+    expected["10"] = dict(USERS["10"], followers=[3, 20, 7, 8, 9])
+    assert lists(store, expected) == expected
+
+
+def test_truncate_applies_in_order_with_adds(tmp_path):
+    fname_base = saved(tmp_path)
+    store = AdjacencyStore.load(fname_base, mmap=False)
+    # a list cut back and fetched again, partly in the tail already
+    store.add("20", "friends", [6])
+    store.save()
+    store.truncate("20", "friends", 2)
+    store.add("20", "friends", [11, 12])
+    store.truncate("10", "followers", 0)
+    store.save()
+
+    store = AdjacencyStore.load(fname_base)
+    assert store.neighbors_of("20", "friends").tolist() == [5, 3, 11, 12]
+    assert store.neighbors_of("10", "followers").tolist() == []
+    assert store.neighbors_of("10", "friends").tolist() == [20]
+    assert store.compact()
+    store = AdjacencyStore.load(fname_base)
+    assert not store.unmerged
+    assert store.neighbors_of("20", "friends").tolist() == [5, 3, 11, 12]
+
+
+def test_torn_tail_record_is_dropped(tmp_path):
+    fname_base = saved(tmp_path)
+    store = AdjacencyStore.load(fname_base, mmap=False)
+    store.add("30", "followers", [1])
+    store.save()
+    good_bytes = store.tail_bytes
+    store.add("30", "followers", [2])
+    store.save()
+    path = os.path.join(store.dirname, TAIL_FNAME)
+    with open(path, "r+b") as tail_file:
+        tail_file.truncate(os.path.getsize(path) - 4)
+
+    store = AdjacencyStore.load(fname_base, mmap=False)
+    assert store.tail_bytes == good_bytes
+    assert store.neighbors_of("30", "followers").tolist() == [1]
+    # the next append overwrites the torn record
+    store.add("30", "followers", [3])
+    store.save()
+    store = AdjacencyStore.load(fname_base)
+    assert store.neighbors_of("30", "followers").tolist() == [1, 3]
+
+
+def test_large_tail_is_compacted_into_a_new_generation(tmp_path, monkeypatch):
+    monkeypatch.setattr(adjacency, "ADJACENCY_TAIL_BYTES", 256)
+    fname_base = saved(tmp_path)
+    first = generation_dirname(fname_base)
+    store = AdjacencyStore.load(fname_base, mmap=False)
+    store.add("30", "followers", range(100, 120))
+    assert store.save()
+
+    assert generation_dirname(fname_base) != first
+    assert not os.path.exists(first)
+    store = AdjacencyStore.load(fname_base)
+    assert not store.unmerged
+    assert store.neighbors_of("30", "followers").tolist() == list(range(100, 120))
+
+
+def test_checksums_follow_the_set_of_ids(tmp_path):
+    users = {
+        "1": {"friends": [5, 6, 7]},
+        "2": {"friends": [7, 5, 6]},
+        "3": {"friends": [5, 6, 8]},
+        "4": {"followers": [1]},
+    }
+    store = AdjacencyStore.load(saved(tmp_path, users))
+    sums = store.checksums("friends", store.index_of([1, 2, 3, 4])).tolist()
+    assert sums[0] == sums[1] != sums[2]
+    assert sums[3] == 0
@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+from adjacency import AdjacencyStore
+from analyze import (DATA, OTHERS_MOD, STDEV_MOD, build_edge_array,
+                     sample_edges, sample_neighbors, significant_nodes)
+
+USERS = {
+    "1": {"followers": [2, 3], "friends": [2, 4]},
+    "2": {"followers": [1], "friends": [1, 3, 5]},
+    "3": {"followers": [6], "friends": [1]},
+    "7": {"followers": [8], "friends": [9]},
+}
+
+
+@pytest.fixture
+def data(tmp_path):
+    adjacency = AdjacencyStore.from_user_dict(USERS, str(tmp_path / "adjacency"))
+    adjacency.save()
+    DATA.set("adjacency", adjacency)
+    DATA.set("user_list", np.array(["1", "2", "3"]))
+    yield adjacency
+    DATA.reset()
+
+
+def edge_ids(adjacency, edges):
+    return {tuple(pair) for pair in adjacency.nodes[edges].tolist()}
+
+
+def naive_edges(user_ids):
+    edges = set()
+    for user_id in user_ids:
+        for other in USERS[user_id]["followers"]:
+            edges.add((other, int(user_id)))
+        for other in USERS[user_id]["friends"]:
+            edges.add((int(user_id), other))
+    return edges
+
+
+def test_edge_array_matches_the_lists_deduplicated(data):
+    edges = build_edge_array()
+    assert edges.shape[1] == 2
+    assert len(edges) == len(np.unique(edges, axis=0))
+    assert edge_ids(data, edges) == naive_edges(["1", "2", "3"])
+
+
+def test_edge_array_for_chosen_users_skips_unknown_ids(data):
+    edges = build_edge_array(np.array([7, 42], dtype=np.int64))
+    assert edge_ids(data, edges) == naive_edges(["7"])
+
+
+def random_edges(num_nodes, num_edges, seed=0):
+    rng = np.random.default_rng(seed)
+    edges = rng.integers(0, num_nodes, size=(num_edges, 2))
+    # a few hubs, so that some degrees stand out
+    edges[: num_edges // 4, 0] = rng.integers(0, 3, size=num_edges // 4)
+    return np.unique(edges, axis=0)
+
+
+def test_significant_nodes_stand_out_by_degree():
+    edges = random_edges(200, 3000)
+    significant = significant_nodes(edges, 200)
+    expected = np.zeros(200, dtype=bool)
+    for column in (0, 1):
+        degrees = np.bincount(edges[:, column], minlength=200)
+        expected |= np.abs(degrees - degrees.mean()) > STDEV_MOD * degrees.std(ddof=1)
+    assert (significant == expected).all()
+    assert significant[:3].all()
+
+
+@pytest.mark.parametrize("reduce_sample", [True, False])
+def test_sample_edges_takes_each_quota_without_replacement(reduce_sample):
+    # hubs with enough out-edges for a reduced sample of some
+    edges = random_edges(5000, 20000)
+    significant = significant_nodes(edges, 5000)
+    rng = np.random.Generator(np.random.PCG64(1))
+    chosen = sample_edges(edges, 5000, significant, rng, reduce_sample)
+
+    assert len(chosen) == len(np.unique(chosen)) > 0
+    quota = np.bincount(edges[:, 0], minlength=5000)
+    if reduce_sample:
+        quota = (quota * OTHERS_MOD).astype(np.int64)
+    quota[~significant] = 0
+    assert (np.bincount(edges[chosen, 0], minlength=5000) == quota).all()
+
+
+def test_sample_neighbors_keeps_the_ends_of_sampled_edges():
+    edges = random_edges(200, 3000)
+    significant = significant_nodes(edges, 200)
+    chosen = sample_edges(
+        edges, 200, significant, np.random.Generator(np.random.PCG64(2)), False
+    )
+    keep = sample_neighbors(
+        edges, 200, significant, np.random.Generator(np.random.PCG64(2)), False
+    )
+    assert set(np.flatnonzero(keep)) == set(edges[chosen].ravel())
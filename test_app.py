@@ -0,0 +1,82 @@
+import networkx as nx
+import numpy as np
+import pytest
+
+import app
+from adjacency import AdjacencyStore
+from app import (DATA, METRICS, PALETTE, DataSource, make_plottable, run_data,
+                 style_indices)
+from columnar import ColumnStore, write_columns
+
+USERS = {
+    "1": {"followers": [2, 3], "friends": [2]},
+    "2": {"followers": [1], "friends": [1, 3, 4]},
+}
+
+
+@pytest.fixture
+def data(tmp_path):
+    adjacency = AdjacencyStore.from_user_dict(USERS, str(tmp_path / "adjacency"))
+    adjacency.save()
+    network = nx.DiGraph()
+    network.add_edges_from([(1, 2), (2, 1), (3, 1), (2, 4)])
+    DATA.set("adjacency", adjacency)
+    DATA.set("network", network)
+    rollups = {"4": {"count": 9}, "1": {"count": 3}, "99": {"count": 1}}
+    DATA.set("tweet_rollups", rollups)
+    yield network
+    DATA.reset()
+
+
+def test_style_indices_bin_over_the_range_of_values():
+    # the bin edges are at 1, 2, ..., 6
+    values = np.array([0, 1.5, 2.5, 3.5, 4.5, 5.5, 6.5, 7])
+    assert style_indices(values).tolist() == list(range(len(PALETTE)))
+    assert style_indices(np.array([5, 5, 5])).tolist() == [0, 0, 0]
+    assert style_indices(np.zeros(0)).dtype == np.uint8
+
+
+def test_metrics_are_computed_for_every_node_at_once(data):
+    node_ids = np.array([1, 2, 3, 4], dtype=np.int64)
+    assert METRICS[DataSource.NONE](node_ids).tolist() == [1, 1, 1, 1]
+    assert METRICS[DataSource.FRIENDS](node_ids).tolist() == [1, 3, 0, 0]
+    assert METRICS[DataSource.FOLLOWERS](node_ids).tolist() == [2, 1, 0, 0]
+    assert METRICS[DataSource.TWEETS](node_ids).tolist() == [3, 0, 0, 9]
+
+
+def test_run_data_styles_nodes_in_network_order(data):
+    indices = run_data(DataSource.TWEETS)
+    assert indices.dtype == np.uint8
+    tweets = {1: 3, 2: 0, 3: 0, 4: 9}
+    values = np.array([tweets[node] for node in data])
+    assert indices.tolist() == style_indices(values).tolist()
+
+
+def test_plot_columns_are_typed_arrays(data, monkeypatch):
+    positions = {node: (node * 1.23456789, -node) for node in data}
+    monkeypatch.setattr(app, "cached_layout", lambda network: positions)
+    graph = make_plottable(np.arange(len(data)) % len(PALETTE))
+    nodes = graph.node_renderer.data_source.data
+    edges = graph.edge_renderer.data_source.data
+    assert nodes["index"].dtype == np.uint16
+    assert nodes["color"].dtype == np.uint8
+    assert edges["start"].dtype == edges["end"].dtype == np.uint16
+    order = list(data)
+    pairs = zip(edges["start"].tolist(), edges["end"].tolist())
+    assert sorted((order[u], order[v]) for u, v in pairs) == sorted(data.edges())
+    layout = graph.layout_provider.graph_layout
+    assert layout[order.index(2)] == pytest.approx(positions[2], abs=1e-3)
+
+
+def test_tooltips_are_served_by_row(data, tmp_path):
+    records = {str(node): {"desc": f"tweet {node}"} for node in data}
+    write_columns(records, str(tmp_path / "tooltips"))
+    DATA.set("tooltips", ColumnStore(str(tmp_path / "tooltips")))
+    DATA.set("graph_data", {"version": "v1"})
+    client = app.app.test_client()
+
+    response = client.get("/tooltip/1?v=v1")
+    assert response.get_json() == {"desc": f"tweet {list(data)[1]}"}
+    assert response.cache_control.max_age > 0
+    assert client.get("/tooltip/1?v=v0").status_code == 404
+    assert client.get(f"/tooltip/{len(data)}").status_code == 404
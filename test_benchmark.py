@@ -0,0 +1,57 @@
+import json
+
+from benchmark import StageTimer, merge_memory
+from synthetic import ID_OFFSET, make_tweets, make_users
+
+
+def test_synthetic_users_are_seeded_and_sized():
+    users = make_users(2000, seed=3)
+    assert users == make_users(2000, seed=3)
+    assert users != make_users(2000, seed=4)
+    num_edges = 0
+    for user_id, info in users.items():
+        for key in ("followers", "friends"):
+            assert info[key] == sorted(set(info[key]))
+            assert min(info[key]) >= ID_OFFSET
+            assert info[f"{key}_count"] == len(info[key])
+            num_edges += len(info[key])
+    assert 0 < num_edges <= 2000 + 2 * len(users)
+
+
+def test_synthetic_tweets_belong_to_their_users():
+    users = make_users(500)
+    tweet_dict = make_tweets(users)
+    tweet_ids = [tweet["id"] for tweets in tweet_dict.values() for tweet in tweets]
+    assert len(tweet_ids) == len(set(tweet_ids)) > 0
+    for user_id, tweets in tweet_dict.items():
+        assert all(tweet["user"]["id_str"] == user_id for tweet in tweets)
+
+
+def test_stage_timer_records_failures_and_keeps_going():
+    timer = StageTimer()
+    assert timer.run("ok", lambda x: x + 1, 1) == 2
+    assert timer.run("fails", lambda: 1 / 0) is None
+    assert "error" not in timer.stages["ok"]
+    assert timer.stages["fails"]["error"].startswith("ZeroDivisionError")
+
+    timer = StageTimer(memory=True)
+    timer.run("allocates", lambda: bytearray(1 << 20))
+    assert timer.stages["allocates"]["peak_mb"] >= 1
+
+
+def test_memory_run_is_merged_into_the_timings(tmp_path):
+    out_path = str(tmp_path / "result.json")
+    memory_path = out_path + ".memory"
+    with open(out_path, "w") as out_file:
+        json.dump({"stages": {"a": {"seconds": 1.0}, "b": {"seconds": 2.0}}}, out_file)
+    with open(memory_path, "w") as memory_file:
+        json.dump({"stages": {"a": {"peak_mb": 5.0}}}, memory_file)
+
+    merge_memory(out_path, memory_path)
+    with open(out_path) as out_file:
+        stages = json.load(out_file)["stages"]
+    assert stages == {
+        "a": {"seconds": 1.0, "peak_mb": 5.0},
+        "b": {"seconds": 2.0, "peak_mb": 0.0},
+    }
+    assert not (tmp_path / "result.json.memory").exists()
@@ -0,0 +1,66 @@
+import networkx as nx
+import numpy as np
+import pytest
+
+from centrality import Centrality, adjacency_matrix, load_centrality
+from graph_store import GraphStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    rng = np.random.default_rng(0)
+    store = GraphStore(str(tmp_path / "full_graph"))
+    edges = rng.integers(0, 300, size=(1500, 2)) * 7 + 1
+    # a dense corner, some dangling nodes and a few self-loops
+    edges[:100] = rng.integers(0, 15, size=(100, 2)) * 7 + 1
+    edges[100:110, 0] = edges[100:110, 1]
+    store.add_edges(edges[:, 0], edges[:, 1])
+    store.add_edges(np.arange(5) + 5000, np.full(5, 6000))
+    return store
+
+
+def by_node(store, values):
+    return dict(zip(store.nodes.tolist(), values.tolist()))
+
+
+def test_scores_match_networkx(store):
+    graph = store.to_networkx()
+    centrality = Centrality.compute(store)
+
+    expected = nx.pagerank(graph, tol=1e-10)
+    ranks = by_node(store, centrality.values["pagerank"])
+    assert ranks == pytest.approx(expected, abs=1e-6)
+
+    hubs, authorities = nx.hits(graph, tol=1e-10, max_iter=1000)
+    assert by_node(store, centrality.values["hubs"]) == pytest.approx(hubs, abs=1e-5)
+    found = by_node(store, centrality.values["authorities"])
+    assert found == pytest.approx(authorities, abs=1e-5)
+
+
+def test_core_numbers_match_networkx(store):
+    graph = store.to_networkx().to_undirected()
+    graph.remove_edges_from(list(nx.selfloop_edges(graph)))
+    cores = Centrality.compute(store).values["kcore"]
+    assert cores.dtype == np.int64
+    assert by_node(store, cores) == nx.core_number(graph)
+
+
+def test_matrix_rows_follow_the_node_order(store):
+    matrix = adjacency_matrix(store)
+    assert matrix.shape == (len(store), len(store))
+    assert matrix.nnz == len(store.edges)
+    row = np.searchsorted(store.nodes, 5000)
+    assert matrix[row].indices.tolist() == [np.searchsorted(store.nodes, 6000)]
+
+
+def test_centrality_is_cached_by_graph_version(store, tmp_path):
+    fname_base = str(tmp_path / "centrality")
+    computed = load_centrality(store, fname_base)
+    cached = Centrality.load(fname_base, store.version())
+    assert cached is not None
+    ranks = computed.lookup("pagerank", [5000, 6000, 12345])
+    assert ranks[2] == 0
+    assert cached.lookup("pagerank", [5000, 6000, 12345]).tolist() == ranks.tolist()
+
+    store.add_edges([6000], [5000])
+    assert Centrality.load(fname_base, store.version()) is None
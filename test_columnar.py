@@ -0,0 +1,84 @@
+import os
+
+import numpy as np
+
+from columnar import ColumnStore, columns_dirname, has_columns, write_columns
+
+RECORDS = {
+    "1": {
+        "screen_name": "one",
+        "followers_count": 2,
+        "verified": True,
+        "score": 0.5,
+        "followers": [2, 3],
+        "friends": [],
+        "entities": {"urls": []},
+    },
+    "2": {
+        "screen_name": "twö",
+        "followers_count": 1,
+        "verified": False,
+        "score": 1,
+        "followers": [1],
+        "friends": [1, 3, 2 ** 40],
+        "big": 2 ** 70,
+    },
+    "3": {"screen_name": "three", "score": 2.25, "description": None},
+}
+
+
+def stored(tmp_path, records=RECORDS):
+    fname_base = str(tmp_path / "users")
+    assert write_columns(records, fname_base)
+    return fname_base
+
+
+def test_records_round_trip(tmp_path):
+    store = ColumnStore(stored(tmp_path))
+    assert len(store) == 3
+    assert store.to_dict() == RECORDS
+    assert store.kind("followers_count") == "int"
+    assert store.kind("score") == "float"
+    assert store.kind("friends") == "idlist"
+    assert store.kind("big") == "json"
+
+
+def test_columns_are_projected_and_read_in_chunks(tmp_path):
+    store = ColumnStore(stored(tmp_path))
+    assert store.to_dict(["screen_name"]) == {
+        user_id: {"screen_name": record["screen_name"]}
+        for user_id, record in RECORDS.items()
+    }
+    chunks = list(store.iter_chunks(["followers_count", "friends"], chunk_rows=2))
+    assert [ids for ids, _ in chunks] == [["1", "2"], ["3"]]
+    assert chunks[0][1]["followers_count"].tolist() == [2, 1]
+    assert [ids.tolist() for ids in chunks[0][1]["friends"]] == [[], [1, 3, 2 ** 40]]
+    assert store.present("followers_count").tolist() == [True, True, False]
+    assert store.read("screen_name", 1, 2) == ["twö"]
+
+
+def test_frame_has_missing_values_as_nan(tmp_path):
+    frame = ColumnStore(stored(tmp_path)).to_frame(["followers_count", "screen_name"])
+    assert frame.index.tolist() == ["1", "2", "3"]
+    assert frame["followers_count"].tolist()[:2] == [2, 1]
+    assert np.isnan(frame["followers_count"].tolist()[2])
+
+
+def test_rewrite_replaces_the_store(tmp_path):
+    fname_base = stored(tmp_path)
+    assert write_columns({"9": {"screen_name": "nine"}}, fname_base)
+    assert ColumnStore(fname_base).to_dict() == {"9": {"screen_name": "nine"}}
+    assert sorted(os.listdir(str(tmp_path))) == ["users.cols"]
+
+
+def test_store_moved_aside_by_a_crash_is_restored(tmp_path):
+    fname_base = stored(tmp_path)
+    dirname = columns_dirname(fname_base)
+    # stopped between the two renames of write_columns()
+    os.rename(dirname, dirname + ".old")
+    os.makedirs(dirname + ".tmp")
+
+    assert has_columns(fname_base)
+    assert ColumnStore(fname_base).to_dict() == RECORDS
+    assert write_columns({"9": {"screen_name": "nine"}}, fname_base)
+    assert sorted(os.listdir(str(tmp_path))) == ["users.cols"]
@@ -0,0 +1,50 @@
+import gc
+
+from context import DataContext, lazy
+
+
+class CountingData(DataContext):
+    def __init__(self):
+        self.loads = []
+
+    @lazy
+    def numbers(self):
+        self.loads.append("numbers")
+        return [1, 2, 3]
+
+    @lazy
+    def total(self):
+        self.loads.append("total")
+        return sum(self.numbers)
+
+
+def test_values_load_once_on_first_read():
+    data = CountingData()
+    assert data.loads == []
+    assert not data.loaded("total")
+    assert data.total == 6
+    assert data.total == 6
+    assert data.loads == ["total", "numbers"]
+    assert data.loaded("numbers")
+
+
+def test_reset_and_set_replace_loaded_values():
+    data = CountingData()
+    data.set("numbers", [10])
+    assert data.total == 10
+    data.reset("total")
+    assert data.total == 10
+    data.reset()
+    assert data.total == 6
+    assert data.loads == ["total", "total", "total", "numbers"]
+
+
+def test_snapshot_loads_everything_up_front():
+    data = CountingData()
+    try:
+        data.snapshot()
+        assert sorted(data.loads) == ["numbers", "total"]
+        assert gc.get_freeze_count() > 0
+    finally:
+        gc.unfreeze()
+    assert sorted(CountingData().loaders()) == ["numbers", "total"]
@@ -0,0 +1,165 @@
+import time
+
+import pytest
+
+import fake_api
+from adjacency import COUNT_KEYS, AdjacencyStore
+from expand import ExpansionEngine, HttpFetcher, TokenBucket
+from segment_log import NullLog
+
+
+@pytest.fixture
+def small_pages(monkeypatch):
+    # a few pages per list rather than one
+    monkeypatch.setattr(fake_api, "PAGE_SIZE", 10)
+
+
+def serve(limit):
+    limits = {key: limit for key in COUNT_KEYS}
+    server = fake_api.serve(port=0, window=1, limits=limits)
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def buckets(capacity):
+    return {key: TokenBucket(capacity, 1, name=key) for key in COUNT_KEYS}
+
+
+def small_users(num, max_neighbors=60):
+    user_ids = []
+    for user_id in range(1, 1000):
+        if user_id % fake_api.PROTECTED_EVERY == 0:
+            continue
+        sizes = [len(fake_api.neighbor_ids(user_id, key)) for key in COUNT_KEYS]
+        if max(sizes) <= max_neighbors:
+            user_ids.append(str(user_id))
+        if len(user_ids) == num:
+            return user_ids
+
+
+def empty_lists(user_ids):
+    return {user_id: {key: [] for key in COUNT_KEYS} for user_id in user_ids}
+
+
+def test_pages_follow_cursors_and_protected_users_are_skipped(small_pages):
+    server, base_url = serve(1000)
+    protected = str(fake_api.PROTECTED_EVERY)
+    user_ids = small_users(4) + [protected]
+    users = empty_lists(user_ids)
+    engine = ExpansionEngine(
+        HttpFetcher(base_url), users, NullLog(), buckets=buckets(1000)
+    )
+    try:
+        stats = engine.run(user_ids)
+    finally:
+        server.shutdown()
+
+    pages = 0
+    for user_id in user_ids[:-1]:
+        for key in COUNT_KEYS:
+            expected = fake_api.neighbor_ids(user_id, key)
+            assert users[user_id][key] == expected
+            pages += max(1, -(-len(expected) // fake_api.PAGE_SIZE))
+    assert stats["pages"] == pages > 2 * len(user_ids)
+    assert users[protected] == {key: [] for key in COUNT_KEYS}
+    assert stats["unavailable"] == len(COUNT_KEYS)
+    assert stats["users"] == len(user_ids)
+
+
+def test_rate_limited_requests_pause_the_bucket_and_retry(small_pages):
+    # the buckets allow far more than the server does
+    server, base_url = serve(8)
+    user_ids = small_users(2)
+    users = empty_lists(user_ids)
+    engine = ExpansionEngine(
+        HttpFetcher(base_url), users, NullLog(), workers=2, buckets=buckets(1000)
+    )
+    try:
+        stats = engine.run(user_ids)
+    finally:
+        server.shutdown()
+
+    assert stats["rate_limited"] == server.counts["rate_limited"] > 0
+    assert sum(engine.buckets[key].slept for key in COUNT_KEYS) > 0
+    for user_id in user_ids:
+        for key in COUNT_KEYS:
+            assert users[user_id][key] == fake_api.neighbor_ids(user_id, key)
+
+
+class InterruptAfter:
+    def __init__(self, fetcher, pages):
+        self.fetcher = fetcher
+        self.pages = pages
+
+    def fetch(self, count_key, user_id, cursor):
+        if self.pages == 0:
+            raise KeyboardInterrupt
+        self.pages -= 1
+        return self.fetcher.fetch(count_key, user_id, cursor)
+
+
+def test_interrupted_run_resumes_from_saved_cursors(small_pages, tmp_path):
+    server, base_url = serve(1000)
+    fname_base = str(tmp_path / "adjacency")
+    user_ids = small_users(3)
+    users = empty_lists(user_ids)
+    progress = {}
+    fetcher = InterruptAfter(HttpFetcher(base_url), 7)
+    engine = ExpansionEngine(
+        fetcher,
+        users,
+        NullLog(),
+        workers=1,
+        buckets=buckets(1000),
+        adjacency=AdjacencyStore(fname_base),
+        progress=progress,
+        progress_log=NullLog(),
+    )
+    try:
+        with pytest.raises(KeyboardInterrupt):
+            engine.run(user_ids)
+        assert server.counts["requests"] == 7
+        # as a new process would see it
+        adjacency = AdjacencyStore.load(fname_base, mmap=False)
+        engine = ExpansionEngine(
+            HttpFetcher(base_url),
+            users,
+            NullLog(),
+            buckets=buckets(1000),
+            adjacency=adjacency,
+            progress=progress,
+            progress_log=NullLog(),
+        )
+        engine.run(user_ids)
+    finally:
+        server.shutdown()
+
+    pages = 0
+    for user_id in user_ids:
+        for key in COUNT_KEYS:
+            expected = fake_api.neighbor_ids(user_id, key)
+            assert adjacency.neighbors_of(user_id, key).tolist() == expected
+            pages += max(1, -(-len(expected) // fake_api.PAGE_SIZE))
+    # no page was fetched twice
+    assert server.counts["requests"] == pages
+
+
+def test_interrupt_does_not_wait_for_the_buckets(small_pages):
+    server, base_url = serve(1000)
+    user_ids = small_users(10)
+    # two tokens per endpoint, then one an hour
+    slow = {key: TokenBucket(2, 3600, name=key) for key in COUNT_KEYS}
+    engine = ExpansionEngine(
+        InterruptAfter(HttpFetcher(base_url), 3),
+        empty_lists(user_ids),
+        NullLog(),
+        workers=4,
+        buckets=slow,
+    )
+    start = time.monotonic()
+    try:
+        with pytest.raises(KeyboardInterrupt):
+            engine.run(user_ids)
+    finally:
+        server.shutdown()
+    assert time.monotonic() - start < 10
+    assert server.counts["requests"] == 3
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from adjacency import AdjacencyStore
+from follow_batches import (follow_batches, label_communities, pack_batches,
+                            seed_order)
+
+# two groups of seeds whose lists overlap within the group only
+USERS = {
+    "1": {"followers": [11, 12, 13], "friends": [2, 12]},
+    "2": {"followers": [1, 13, 14], "friends": [11]},
+    "3": {"followers": [31, 32], "friends": [4, 33, 34]},
+    "4": {"followers": [3, 31], "friends": [32, 35]},
+}
+
+
+@pytest.fixture
+def adjacency(tmp_path):
+    store = AdjacencyStore.from_user_dict(USERS, str(tmp_path / "adjacency"))
+    store.save()
+    return store
+
+
+def everyone(user_ids):
+    ids = set(map(int, user_ids))
+    for user_id in user_ids:
+        ids.update(USERS[user_id]["followers"] + USERS[user_id]["friends"])
+    return ids
+
+
+def test_seed_order_lists_each_user_once(adjacency):
+    members = adjacency.nodes[seed_order(adjacency, [1, 3, 99])].tolist()
+    assert len(members) == len(set(members))
+    assert set(members) == everyone(["1", "3"])
+    assert members[0] == 1
+
+
+@pytest.mark.parametrize("limit", [1, 3, 5, 100])
+def test_batches_respect_the_limit_and_cover_everyone(adjacency, limit):
+    seeds = adjacency.seed_ids()
+    for by_community in (False, True):
+        batches = follow_batches(adjacency, seeds, by_community, limit=limit)
+        ids = [user_id for batch in batches.values() for user_id in batch]
+        assert all(len(batch) <= limit for batch in batches.values())
+        assert len(ids) == len(set(ids))
+        assert set(map(int, ids)) == everyone(list(USERS))
+        if not by_community:
+            # plain chunking is as few batches as there can be
+            assert len(batches) == -(-len(ids) // limit)
+
+
+def test_communities_follow_the_seed_groups(adjacency):
+    labels = label_communities(adjacency)
+    label_of = dict(zip(adjacency.nodes.tolist(), labels.tolist()))
+    assert label_of[1] == label_of[2] == label_of[13]
+    assert label_of[3] == label_of[4] == label_of[31]
+    assert label_of[1] != label_of[3]
+
+
+def test_pieces_are_packed_first_fit_decreasing():
+    members = np.arange(10)
+    communities = np.array([0, 0, 0, 0, 1, 1, 1, 2, 2, 3])
+    batches = pack_batches(members, communities, limit=5)
+    assert [batch.tolist() for batch in batches] == [[0, 1, 2, 3, 9], [4, 5, 6, 7, 8]]
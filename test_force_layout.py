@@ -0,0 +1,76 @@
+import networkx as nx
+import numpy as np
+
+from force_layout import _match, force_layout, repulsion
+
+
+def exact_repulsion(pos, mass):
+    delta = pos[:, None, :] - pos[None, :, :]
+    dist2 = np.maximum((delta ** 2).sum(axis=2), 1e-4)
+    np.fill_diagonal(dist2, np.inf)
+    return (delta * (mass[None, :] / dist2)[:, :, None]).sum(axis=1)
+
+
+def test_repulsion_approximates_the_exact_sum():
+    rng = np.random.default_rng(0)
+    pos = np.concatenate((rng.random((600, 2)) * 10, rng.normal(3, 0.3, (200, 2))))
+    mass = rng.integers(1, 4, len(pos)).astype(float)
+    exact = exact_repulsion(pos, mass)
+    approx = repulsion(pos, mass, leaf_size=4)
+    error = np.linalg.norm(approx - exact, axis=1) / np.linalg.norm(exact, axis=1)
+    assert np.median(error) < 0.05
+
+    targets = np.array([3, 650, 799])
+    subset = repulsion(pos, mass, targets=targets, leaf_size=4)
+    assert np.allclose(subset, approx[targets])
+
+
+def test_matching_merges_neighbours():
+    graph = nx.grid_2d_graph(20, 20)
+    graph = nx.convert_node_labels_to_integers(graph)
+    edges = np.array(graph.edges(), dtype=np.int64)
+    parent, num_coarse = _match(len(graph), edges, np.random.default_rng(1))
+    assert num_coarse < 0.7 * len(graph)
+    assert sorted(set(parent.tolist())) == list(range(num_coarse))
+    # every group is held together by edges
+    for group in range(num_coarse):
+        members = np.flatnonzero(parent == group).tolist()
+        assert nx.is_connected(graph.subgraph(members))
+
+
+def two_communities(size=150, seed=2):
+    graph = nx.DiGraph()
+    graph.add_edges_from(nx.gnm_random_graph(size, size * 4, seed=seed).edges())
+    other = nx.gnm_random_graph(size, size * 4, seed=seed + 1)
+    graph.add_edges_from((u + size, v + size) for u, v in other.edges())
+    graph.add_edge(0, size)
+    return graph
+
+
+def test_layout_separates_communities():
+    graph = two_communities()
+    positions = force_layout(graph)
+    assert positions == force_layout(graph)
+    xy = np.array([positions[node] for node in range(len(graph))])
+    assert np.isfinite(xy).all()
+    first, second = xy[:150].mean(axis=0), xy[150:].mean(axis=0)
+    spread = max(xy[:150].std(axis=0).max(), xy[150:].std(axis=0).max())
+    assert np.linalg.norm(first - second) > 3 * spread
+
+
+def test_new_nodes_leave_the_old_layout_in_place():
+    graph = two_communities()
+    before = force_layout(graph)
+    grown = graph.copy()
+    grown.add_edges_from((1000 + i, i) for i in range(10))
+    after = force_layout(grown, previous=before)
+
+    assert set(after) == set(grown)
+    old = np.array([before[node] for node in graph])
+    moved = np.array([after[node] for node in graph]) - old
+    extent = np.ptp(old, axis=0).max()
+    assert np.median(np.linalg.norm(moved, axis=1)) < 0.05 * extent
+    # new nodes end up next to the node they're attached to
+    new = np.array([after[1000 + i] for i in range(10)])
+    anchors = np.array([after[i] for i in range(10)])
+    assert np.median(np.linalg.norm(new - anchors, axis=1)) < 0.25 * extent
@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import analyze
+from adjacency import COUNT_KEYS, AdjacencyStore
+from graph_store import DEGREE_KINDS, GraphStore, contains_edges, edge_records
+from layout import graph_version
+
+
+def check_degrees(store):
+    ends = {"out": store.edges["source"], "in": store.edges["target"]}
+    for kind in DEGREE_KINDS:
+        degrees = np.array([np.sum(ends[kind] == node) for node in store.nodes])
+        assert store.degrees[kind].tolist() == degrees.tolist()
+        mean, stdev = store.degree_stats(kind)
+        assert mean == pytest.approx(degrees.mean())
+        assert stdev == pytest.approx(degrees.std(ddof=1))
+
+
+def test_edges_are_merged_sorted_and_deduplicated(tmp_path):
+    store = GraphStore(str(tmp_path / "graph"))
+    assert store.add_edges([1, 2, 1], [2, 3, 2]) == 2
+    assert store.add_edges([2, 3, 5], [3, 1, 1]) == 2
+    assert store.edges.tolist() == [(1, 2), (2, 3), (3, 1), (5, 1)]
+    assert store.nodes.tolist() == [1, 2, 3, 5]
+    check_degrees(store)
+    assert store.edges[store.out_edges([2, 5])].tolist() == [(2, 3), (5, 1)]
+    assert store.edges[store.touching([1])].tolist() == [(1, 2), (3, 1), (5, 1)]
+    found = contains_edges(store.edges, edge_records([3, 1], [1, 3]))
+    assert found.tolist() == [True, False]
+
+
+def test_removed_edges_take_their_nodes_and_samples_along(tmp_path):
+    store = GraphStore(str(tmp_path / "graph"))
+    store.add_edges([1, 1, 2, 3, 5], [2, 3, 3, 1, 1])
+    store.sampled = edge_records([1, 3], [2, 1])
+    store.significant = np.array([1, 3])
+    store.sampled_out = np.array([2, 1])
+
+    removed = store.remove_edges(store.touching([5, 2]))
+    assert removed.tolist() == [(1, 2), (2, 3), (5, 1)]
+    assert store.edges.tolist() == [(1, 3), (3, 1)]
+    assert store.nodes.tolist() == [1, 3]
+    check_degrees(store)
+    assert store.sampled.tolist() == [(3, 1)]
+    # node 1 lost a sampled edge, so it has to be resampled
+    assert store.sampled_out.tolist() == [-1, 1]
+
+
+def test_watermark_finds_new_and_changed_users(tmp_path):
+    store = GraphStore(str(tmp_path / "graph"))
+    degrees = {key: np.array([3, 4]) for key in COUNT_KEYS}
+    sums = {key: np.array([7, 8], dtype=np.uint64) for key in COUNT_KEYS}
+    store.mark([20, 10], degrees, sums)
+
+    user_ids = [10, 20, 30, 40]
+    degrees = {"followers": np.array([4, 3, 0, 1]), "friends": np.array([4, 3, 0, 1])}
+    sums = {key: np.array([8, 7, 0, 0], dtype=np.uint64) for key in COUNT_KEYS}
+    stale = store.stale_users(user_ids, degrees, sums)
+    assert stale.tolist() == [False, False, True, True]
+    # same lengths, different ids
+    sums["friends"][0] = 9
+    degrees["followers"][1] = 2
+    assert store.stale_users(user_ids, degrees, sums)[:2].tolist() == [True, True]
+
+
+def test_store_round_trips_with_its_version(tmp_path):
+    store = GraphStore(str(tmp_path / "graph"))
+    store.add_edges([1, 2, 4], [2, 3, 1])
+    degrees = {key: np.array([1]) for key in COUNT_KEYS}
+    sums = {key: np.array([5], dtype=np.uint64) for key in COUNT_KEYS}
+    store.mark([1], degrees, sums)
+    assert store.save()
+    loaded = GraphStore.load(str(tmp_path / "graph"))
+    assert loaded.edges.tolist() == store.edges.tolist()
+    assert loaded.watermark.tolist() == [1]
+    assert loaded.watermark_sums["friends"].tolist() == [5]
+    assert loaded.version() == store.version()
+    assert store.version() == graph_version(store.to_networkx())
+
+
+USERS = {
+    "1": {"followers": [2, 3], "friends": [2, 4]},
+    "2": {"followers": [1, 5], "friends": [1, 3]},
+    "3": {"followers": [1, 2], "friends": [6]},
+}
+
+
+@pytest.fixture
+def full_graph(tmp_path, monkeypatch):
+    monkeypatch.setattr(analyze, "FULL_GRAPH_FNAME", str(tmp_path / "full_graph"))
+    analyze.DATA.set("user_list", np.array(list(USERS)))
+    analyze.DATA.set("valid_user_frame", pd.DataFrame(index=list(USERS), data={"a": 1}))
+    yield str(tmp_path / "adjacency")
+    analyze.DATA.reset()
+
+
+def test_incremental_update_matches_a_rebuild(full_graph):
+    adjacency = AdjacencyStore.from_user_dict(USERS, full_graph)
+    adjacency.save()
+    analyze.DATA.set("adjacency", adjacency)
+    analyze.update_graph(from_scratch=True).save()
+
+    # 2's friends list cut back and fetched again with other ids, and 3
+    # dropped 1 from its followers, which 1's friends list doesn't imply
+    adjacency.truncate("2", "friends", 0)
+    adjacency.add("2", "friends", [1, 7])
+    adjacency.truncate("3", "followers", 0)
+    adjacency.add("3", "followers", [2, 8])
+    adjacency.save()
+
+    updated = analyze.update_graph()
+    rebuilt = analyze.update_graph(from_scratch=True)
+    assert updated.edges.tolist() == rebuilt.edges.tolist()
+    assert (2, 3) in updated.edges.tolist()
+    assert (1, 3) not in updated.edges.tolist()
+    assert updated.nodes.tolist() == rebuilt.nodes.tolist()
+    check_degrees(updated)
+    rows = adjacency.index_of([1, 2, 3])
+    degrees = {key: adjacency.degrees(key)[rows] for key in COUNT_KEYS}
+    sums = {key: adjacency.checksums(key, rows) for key in COUNT_KEYS}
+    assert not updated.stale_users([1, 2, 3], degrees, sums).any()
@@ -0,0 +1,62 @@
+import urllib.request
+
+import instrument
+from instrument import (CONTENT_TYPE, PROFILES, Registry, profile_report,
+                        profiled, serve_metrics)
+
+
+def test_counters_render_by_label():
+    registry = Registry()
+    requests = registry.counter("requests_total", "Requests served")
+    requests.inc(path="/plot")
+    requests.inc(2, path="/plot")
+    requests.inc(path='/a"b')
+    assert registry.counter("requests_total", "ignored") is requests
+    assert requests.value(path="/plot") == 3
+    assert registry.render().splitlines() == [
+        "# HELP requests_total Requests served",
+        "# TYPE requests_total counter",
+        'requests_total{path="/plot"} 3',
+        'requests_total{path="/a\\"b"} 1',
+    ]
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    seconds = registry.histogram("stage_seconds", "Stage time", buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.5, 3):
+        seconds.observe(value, stage="x")
+    with seconds.time(stage="y"):
+        pass
+    assert seconds.count(stage="x") == 4
+    assert seconds.count(stage="y") == 1
+    lines = registry.render().splitlines()
+    assert 'stage_seconds_bucket{stage="x",le="0.1"} 1' in lines
+    assert 'stage_seconds_bucket{stage="x",le="1"} 3' in lines
+    assert 'stage_seconds_bucket{stage="x",le="+Inf"} 4' in lines
+    assert 'stage_seconds_sum{stage="x"} 4.05' in lines
+    assert 'stage_seconds_count{stage="x"} 4' in lines
+
+
+def test_one_in_every_n_calls_is_profiled():
+    @profiled(every=3)
+    def work(x):
+        return x * 2
+
+    assert [work(x) for x in range(7)] == [0, 2, 4, 6, 8, 10, 12]
+    name = f"{__name__}.test_one_in_every_n_calls_is_profiled.<locals>.work"
+    assert instrument.PROFILE_SAMPLES.value(function=name) == 3
+    assert name in PROFILES
+    assert f"{name} (3 sampled calls)" in profile_report()
+
+
+def test_metrics_are_served_over_http():
+    server = serve_metrics(0)
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        with urllib.request.urlopen(url) as response:
+            assert response.headers["Content-Type"] == CONTENT_TYPE
+            body = response.read().decode()
+    finally:
+        server.shutdown()
+    assert "# TYPE stage_seconds histogram" in body
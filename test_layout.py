@@ -0,0 +1,53 @@
+import networkx as nx
+import pytest
+
+import layout
+from layout import cached_layout, graph_version, invalidate_layout
+
+
+@pytest.fixture
+def runs(tmp_path, monkeypatch):
+    monkeypatch.setattr(layout, "LAYOUT_FNAME", str(tmp_path / "layout"))
+    calls = []
+
+    def counting_layout(graph, previous=None):
+        calls.append(previous)
+        return {node: (float(node), 0.0) for node in graph}
+
+    monkeypatch.setattr(layout, "force_layout", counting_layout)
+    invalidate_layout()
+    yield calls
+    invalidate_layout()
+
+
+def graph(edges):
+    user_graph = nx.DiGraph()
+    user_graph.add_edges_from(edges)
+    return user_graph
+
+
+def test_graph_version_ignores_insertion_order():
+    first = graph([(1, 2), (2, 3), (3, 1)])
+    second = graph([(3, 1), (1, 2), (2, 3)])
+    assert graph_version(first) == graph_version(second)
+    second.add_edge(1, 3)
+    assert graph_version(first) != graph_version(second)
+
+
+def test_layout_runs_once_per_graph_version(runs):
+    edges = [(1, 2), (2, 3)]
+    positions = cached_layout(graph(edges), prog="force")
+    assert cached_layout(graph(reversed(edges)), prog="force") is positions
+    assert len(runs) == 1
+
+    # as a new process would see it
+    invalidate_layout()
+    assert cached_layout(graph(edges), prog="force") == positions
+    assert len(runs) == 1
+
+
+def test_changed_graph_starts_from_the_last_layout(runs):
+    positions = cached_layout(graph([(1, 2)]), prog="force")
+    invalidate_layout()
+    cached_layout(graph([(1, 2), (2, 3)]), prog="force")
+    assert runs == [None, positions]
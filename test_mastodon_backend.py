@@ -0,0 +1,114 @@
+import threading
+
+import fake_mastodon
+from expand import ExpansionEngine
+from mastodon_backend import MastodonBackend
+
+USER_KEYS = {
+    "id",
+    "id_str",
+    "screen_name",
+    "name",
+    "followers_count",
+    "friends_count",
+    "statuses_count",
+    "created_at",
+    "instance",
+    "local_id",
+}
+TWEET_KEYS = {
+    "id",
+    "id_str",
+    "created_at",
+    "timestamp_ms",
+    "text",
+    "lang",
+    "source",
+    "user",
+}
+
+
+class MemoryLog:
+    def __init__(self):
+        self.entries = []
+
+    def set(self, key, value, field=None):
+        self.entries.append(("set", key, field, value))
+
+    def extend(self, key, values, field=None):
+        self.entries.append(("extend", key, field, list(values)))
+
+    def flush(self):
+        return True
+
+
+def check_user(user_json, base_url):
+    assert set(user_json) == USER_KEYS
+    assert isinstance(user_json["id"], int) and 0 <= user_json["id"] < 2 ** 63
+    assert user_json["id_str"] == str(user_json["id"])
+    assert user_json["screen_name"].endswith("@" + base_url.split("://")[1])
+    assert user_json["instance"] == base_url
+
+
+def check_tweet(tweet_json, base_url):
+    assert set(tweet_json) - {"retweeted_status"} == TWEET_KEYS
+    assert tweet_json["id_str"] == str(tweet_json["id"])
+    assert tweet_json["timestamp_ms"].isdigit()
+    assert tweet_json["source"] == "mastodon"
+    assert "<" not in tweet_json["text"]
+    check_user(tweet_json["user"], base_url)
+    if "retweeted_status" in tweet_json:
+        original = tweet_json["retweeted_status"]
+        assert "retweeted_status" not in original
+        assert tweet_json["text"].startswith(f"RT @{original['user']['screen_name']}")
+        check_tweet(original, base_url)
+
+
+def test_stream_and_expand_against_fake_mastodon(capsys):
+    server = fake_mastodon.serve(port=0, window=5)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    streams = [f"{base_url}/public", f"{base_url}/public/local"]
+    backend = MastodonBackend(streams, home=base_url, token="stub")
+    try:
+        statuses = []
+        store_threads = set()
+        checkpoints = []
+
+        def store(tweet_json):
+            store_threads.add(threading.get_ident())
+            statuses.append(tweet_json)
+
+        def checkpoint():
+            checkpoints.append(len(statuses))
+
+        stats = backend.stream(store, checkpoint, checkpoint_every=5, seconds=2)
+        assert stats["tweets"] == len(statuses) > 0
+        assert checkpoints and checkpoints == sorted(checkpoints)
+        # statuses are stored off the event loop
+        assert backend.pool.thread.ident not in store_threads
+        for tweet_json in statuses:
+            check_tweet(tweet_json, base_url)
+        assert any("retweeted_status" in tweet_json for tweet_json in statuses)
+
+        users = {}
+        for tweet_json in statuses:
+            user_json = tweet_json["user"]
+            users[user_json["id_str"]] = dict(user_json, followers=[], friends=[])
+        to_expand = list(users)[:5]
+        engine = ExpansionEngine(
+            backend.fetcher(users), users, MemoryLog(), buckets=backend.buckets(5)
+        )
+        engine.run(to_expand)
+    finally:
+        backend.close()
+        server.shutdown()
+
+    for user_id in to_expand:
+        user_json = users[user_id]
+        if int(user_json["local_id"]) % fake_mastodon.PROTECTED_EVERY == 0:
+            continue
+        assert len(user_json["followers"]) == user_json["followers_count"]
+        assert len(user_json["friends"]) == user_json["friends_count"]
+        others = user_json["followers"] + user_json["friends"]
+        assert all(isinstance(other, int) and other < 2 ** 63 for other in others)
+    assert "Traceback" not in capsys.readouterr().err
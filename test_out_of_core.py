@@ -0,0 +1,130 @@
+import gzip
+import json
+
+import numpy as np
+import pytest
+
+import out_of_core
+from adjacency import COUNT_KEYS, AdjacencyStore
+from columnar import write_columns
+from graph_store import DEGREE_KINDS, EDGE_DTYPE, GraphStore, edge_records
+from out_of_core import (ExternalSort, build_adjacency, build_graph_store,
+                         iter_json_items)
+from segment_log import SegmentLog
+
+
+@pytest.fixture
+def fan_in(monkeypatch):
+    # enough runs for more than one merge pass
+    monkeypatch.setattr(out_of_core, "MERGE_FAN_IN", 3)
+
+
+@pytest.mark.parametrize("unique", [False, True])
+def test_external_sort_matches_sorted(tmp_path, fan_in, unique):
+    rng = np.random.default_rng(0)
+    batches = [rng.integers(0, 500, size=int(size)) for size in rng.integers(0, 90, 40)]
+    records = np.concatenate(batches)
+    sort = ExternalSort(str(tmp_path / "sort"), np.int64, budget=600, unique=unique)
+    for batch in batches:
+        sort.add(batch)
+    assert sort.num_runs > 3
+    result = sort.finish(str(tmp_path / "sorted.npy"))
+
+    expected = sorted(set(records.tolist())) if unique else sorted(records.tolist())
+    assert result.tolist() == expected
+    assert list((tmp_path / "sort").iterdir()) == []
+
+
+def test_external_sort_orders_edges_by_source_then_target(tmp_path, fan_in):
+    rng = np.random.default_rng(1)
+    sort = ExternalSort(str(tmp_path / "sort"), EDGE_DTYPE, budget=2000, unique=True)
+    pairs = []
+    for _ in range(20):
+        batch = rng.integers(0, 30, size=(50, 2))
+        pairs.extend(map(tuple, batch.tolist()))
+        sort.add(edge_records(batch[:, 0], batch[:, 1]))
+    result = sort.finish(str(tmp_path / "edges.npy"))
+    assert result.tolist() == sorted(set(pairs))
+
+    empty = ExternalSort(str(tmp_path / "empty"), EDGE_DTYPE, budget=2000)
+    assert len(empty.finish(str(tmp_path / "empty.npy"))) == 0
+
+
+def random_users(num_users=60, seed=2):
+    rng = np.random.default_rng(seed)
+    users = {}
+    for user_id in rng.choice(10 ** 6, size=num_users, replace=False).tolist():
+        users[str(user_id)] = {
+            key: np.unique(rng.integers(0, 10 ** 6, size=rng.integers(0, 40))).tolist()
+            for key in COUNT_KEYS
+        }
+        users[str(user_id)]["screen_name"] = f"user{user_id}"
+    return users
+
+
+def write_json(users, fname):
+    with gzip.open(fname, "wt") as json_file:
+        json.dump(users, json_file, indent=1)
+
+
+def test_json_items_are_read_a_chunk_at_a_time(tmp_path):
+    users = random_users()
+    fname = str(tmp_path / "users.json.gz")
+    write_json(users, fname)
+    assert dict(iter_json_items(fname, chunk_chars=64)) == users
+
+
+def check_lists(adjacency, users):
+    for user_id, info in users.items():
+        for key in COUNT_KEYS:
+            found = adjacency.neighbors_of(user_id, key).tolist()
+            assert found == sorted(info.get(key, []))
+
+
+@pytest.mark.parametrize("columns", [False, True])
+def test_adjacency_is_built_with_the_log_applied(tmp_path, fan_in, columns):
+    users = random_users()
+    fname_base = str(tmp_path / "users")
+    if columns:
+        write_columns(users, fname_base)
+    else:
+        write_json(users, fname_base + ".json.gz")
+    # a list changed and a user added since the snapshot
+    changed = next(iter(users))
+    log = SegmentLog(fname_base)
+    log.set(changed, [5, 3], field="friends")
+    log.set("77", {"followers": [1, 2], "friends": []})
+    log.flush()
+    users[changed]["friends"] = [5, 3]
+    users["77"] = {"followers": [1, 2], "friends": []}
+
+    adjacency = build_adjacency(fname_base, str(tmp_path / "adjacency"), budget=4096)
+    check_lists(adjacency, users)
+    expected = AdjacencyStore.from_user_dict(users, str(tmp_path / "expected"))
+    expected.save()
+    assert adjacency.nodes.tolist() == expected.nodes.tolist()
+
+
+def test_graph_store_matches_one_built_in_memory(tmp_path, fan_in):
+    users = random_users()
+    adjacency = AdjacencyStore.from_user_dict(users, str(tmp_path / "adjacency"))
+    adjacency.save()
+    store = build_graph_store(adjacency, str(tmp_path / "graph"), budget=4096)
+
+    expected = GraphStore(str(tmp_path / "expected"))
+    seeds = [
+        user_id for user_id, info in users.items() if all(info[k] for k in COUNT_KEYS)
+    ]
+    for user_id in seeds:
+        user = int(user_id)
+        followers, friends = (users[user_id][key] for key in COUNT_KEYS)
+        expected.add_edges(followers, [user] * len(followers))
+        expected.add_edges([user] * len(friends), friends)
+    assert np.asarray(store.edges).tolist() == expected.edges.tolist()
+    assert store.nodes.tolist() == expected.nodes.tolist()
+    for kind in DEGREE_KINDS:
+        assert store.degrees[kind].tolist() == expected.degrees[kind].tolist()
+        assert store.stats[kind].tolist() == expected.stats[kind].tolist()
+    assert store.watermark.tolist() == sorted(map(int, seeds))
+    assert store.save()
+    assert GraphStore.load(str(tmp_path / "graph")).version() == expected.version()
@@ -0,0 +1,47 @@
+import gzip
+import os
+
+from payload_cache import PayloadCache
+
+
+def test_least_recently_used_payloads_are_dropped():
+    cache = PayloadCache(max_entries=2)
+    cache.put("v1", "a", "{}")
+    cache.put("v1", "b", "[]")
+    assert cache.get("v1", "a") is not None
+    cache.put("v1", "c", "1")
+    assert cache.get("v1", "b") is None
+    assert cache.get("v1", "a") is not None
+    assert cache.get("v1", "c") is not None
+
+
+def test_payloads_round_trip_through_disk(tmp_path):
+    dirname = str(tmp_path / "plots")
+    payload = PayloadCache(dirname).put("v1", "plot", '{"a": 1}')
+    assert payload.bodies["identity"] == b'{"a": 1}'
+    assert gzip.decompress(payload.bodies["gzip"]) == b'{"a": 1}'
+
+    # as another worker would see it
+    read = PayloadCache(dirname).get("v1", "plot")
+    assert read == payload
+    assert PayloadCache(dirname).get("v2", "plot") is None
+
+
+def test_missing_encodings_are_rebuilt_from_gzip(tmp_path):
+    dirname = str(tmp_path / "plots")
+    payload = PayloadCache(dirname).put("v1", "plot", "[1, 2]")
+    os.remove(os.path.join(dirname, "v1-plot.json"))
+    read = PayloadCache(dirname).get("v1", "plot")
+    assert read.etag == payload.etag
+    assert read.bodies["identity"] == b"[1, 2]"
+
+
+def test_clear_keeps_only_the_current_version(tmp_path):
+    dirname = str(tmp_path / "plots")
+    cache = PayloadCache(dirname)
+    cache.put("v1", "plot", "1")
+    cache.put("v2", "plot", "2")
+    cache.clear(keep_version="v2")
+    assert cache.get("v1", "plot") is None
+    assert cache.get("v2", "plot") is not None
+    assert all(fname.startswith("v2-") for fname in os.listdir(dirname))
@@ -0,0 +1,141 @@
+import gzip
+import json
+import os
+
+import pytest
+
+from segment_log import SegmentLog, replay_log
+
+
+def write_snapshot(obj, fname):
+    def write(mark):
+        with open(fname + ".tmp", "w") as snapshot_file:
+            json.dump(obj, snapshot_file)
+        if mark is not None:
+            mark(fname + ".tmp", fname)
+        os.replace(fname + ".tmp", fname)
+        return True
+
+    return write
+
+
+def read_snapshot(fname):
+    with open(fname) as snapshot_file:
+        return json.load(snapshot_file)
+
+
+def fill(fname_base, flushes, **kwargs):
+    # a log object per flush, as a new process would start a new segment
+    for i in range(flushes):
+        log = SegmentLog(fname_base, **kwargs)
+        log.set(str(i), {"n": i})
+        log.append("seq", i, field="items")
+        log.extend("seq", [i, i], field="pairs")
+        log.update("seq", {str(i): i}, field="seen")
+        assert log.flush()
+
+
+def expected(flushes):
+    obj = {str(i): {"n": i} for i in range(flushes)}
+    obj["seq"] = {
+        "items": list(range(flushes)),
+        "pairs": [i for i in range(flushes) for _ in range(2)],
+        "seen": {str(i): i for i in range(flushes)},
+    }
+    return obj
+
+
+def test_replay_applies_every_flush(tmp_path):
+    fname_base = str(tmp_path / "obj")
+    fill(fname_base, 3, max_segments=None)
+    assert len(SegmentLog(fname_base).segments()) == 3
+    assert replay_log({}, fname_base) == expected(3)
+
+
+def test_compaction_keeps_the_replayed_state(tmp_path):
+    fname_base = str(tmp_path / "obj")
+    fill(fname_base, 7, max_segments=2)
+    assert len(SegmentLog(fname_base).segments()) <= 2
+    assert replay_log({}, fname_base) == expected(7)
+
+
+def test_logs_without_max_segments_are_never_compacted(tmp_path):
+    fname_base = str(tmp_path / "obj")
+    fill(fname_base, 7, max_segments=None)
+    names = os.listdir(SegmentLog(fname_base).dirname)
+    assert len(names) == 7
+    assert not any("c." in name for name in names)
+
+
+def test_fold_writes_the_log_into_the_snapshot(tmp_path):
+    fname_base = str(tmp_path / "obj")
+    fname = fname_base + ".json"
+    write_snapshot({"base": 1}, fname)(None)
+    fill(fname_base, 3, max_segments=None)
+
+    log = SegmentLog(fname_base)
+    assert log.fold(write_snapshot(replay_log(read_snapshot(fname), fname_base), fname))
+    assert not SegmentLog(fname_base).segments()
+    assert replay_log(read_snapshot(fname), fname_base) == dict(expected(3), base=1)
+
+
+def test_crash_after_fold_never_replays_folded_segments(tmp_path):
+    fname_base = str(tmp_path / "obj")
+    fname = fname_base + ".json"
+    write_snapshot({}, fname)(None)
+    fill(fname_base, 2, max_segments=None)
+
+    def crash(mark):
+        write_snapshot(replay_log(read_snapshot(fname), fname_base), fname)(mark)
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        SegmentLog(fname_base).fold(crash)
+    # the folded segments are still on disk, but skipped
+    assert os.listdir(SegmentLog(fname_base).dirname)
+    assert replay_log(read_snapshot(fname), fname_base) == expected(2)
+
+    # later appends still replay, and the next fold cleans up
+    log = SegmentLog(fname_base)
+    log.set("after", 1)
+    log.flush()
+    assert replay_log(read_snapshot(fname), fname_base) == dict(expected(2), after=1)
+    assert log.fold(write_snapshot(replay_log(read_snapshot(fname), fname_base), fname))
+    assert not SegmentLog(fname_base).segments()
+    assert read_snapshot(fname) == dict(expected(2), after=1)
+
+
+def test_replay_stops_at_a_torn_write(tmp_path):
+    fname_base = str(tmp_path / "obj")
+    fill(fname_base, 2, max_segments=None)
+    _, path = SegmentLog(fname_base).segments()[-1]
+    with open(path, "rb") as segment:
+        data = segment.read()
+    with open(path, "wb") as segment:
+        segment.write(data[: len(data) // 2])
+
+    obj = replay_log({}, fname_base)
+    assert obj["0"] == {"n": 0}
+    assert obj["seq"]["items"][0] == 0
+
+
+def test_recent_keys_reads_the_newest_segments_first(tmp_path):
+    fname_base = str(tmp_path / "obj")
+    for i in range(4):
+        log = SegmentLog(fname_base, max_segments=None)
+        log.set(f"a{i}", 1)
+        log.set(f"b{i}", 1)
+        log.flush()
+    assert SegmentLog(fname_base).recent_keys(2) == {"a3", "b3"}
+    assert SegmentLog(fname_base).recent_keys(3) == {"a3", "b3", "a2", "b2"}
+    assert len(SegmentLog(fname_base).recent_keys(100)) == 8
+
+
+def test_segments_are_gzipped_json_lines(tmp_path):
+    fname_base = str(tmp_path / "obj")
+    log = SegmentLog(fname_base)
+    log.set("key", [1, 2])
+    log.flush()
+    _, path = log.segments()[0]
+    with gzip.open(path, "rt") as segment:
+        assert [json.loads(line) for line in segment] == [["set", "key", None, [1, 2]]]
@@ -0,0 +1,35 @@
+import fake_api
+from shard_stream import HttpSource, RoundRobin, ShardedStreamer
+
+
+def test_sharded_streamer_against_fake_api():
+    server = fake_api.serve(port=0)
+    url = f"http://127.0.0.1:{server.server_address[1]}/1.1/statuses/filter.json"
+    groups = {f"group{i}": [str(10 * i + j) for j in range(1, 4)] for i in range(4)}
+    tweets = []
+    checkpoints = []
+    streamer = ShardedStreamer(
+        HttpSource(url),
+        groups,
+        tweets.append,
+        num_shards=2,
+        policy=RoundRobin(groups, dwell=1),
+        checkpoint=lambda: checkpoints.append(len(tweets)),
+        checkpoint_every=10,
+        grace=5,
+    )
+    try:
+        stats = streamer.run()
+    finally:
+        server.shutdown()
+
+    assert server.counts["streams"] == len(groups)
+    assert stats["runs"] == len(groups)
+    # every shard stopped when asked to
+    assert stats["terminated"] == 0
+    assert stats["tweets"] == len(tweets) > 0
+    assert sum(stats["per_group"].values()) == len(tweets)
+    assert set(stats["per_group"]) <= set(groups)
+    followed = {user_id for group in groups.values() for user_id in group}
+    assert {tweet["user"]["id_str"] for tweet in tweets} <= followed
+    assert checkpoints[-1] == len(tweets)
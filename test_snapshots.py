@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+
+from adjacency import COUNT_KEYS, AdjacencyStore
+from snapshots import (SnapshotStore, adjacency_lists, decode_lists, diff_pairs,
+                       encode_lists, varint_decode, varint_encode)
+
+
+def test_varints_round_trip():
+    values = np.array([0, 1, 127, 128, 300, 2 ** 35, 2 ** 63, 2 ** 64 - 1], np.uint64)
+    data = varint_encode(values)
+    assert data.dtype == np.uint8
+    assert len(data) == 1 + 1 + 1 + 2 + 2 + 6 + 10 + 10
+    assert varint_decode(data).tolist() == values.tolist()
+    assert varint_decode(varint_encode([])).tolist() == []
+
+
+def random_lists(rng, num_users=40, num_pairs=400):
+    lists = {}
+    for key in COUNT_KEYS:
+        pairs = rng.integers(1, 10 ** 12, size=(num_pairs, 2))
+        pairs[:, 0] = rng.integers(0, num_users, size=num_pairs) * 10 ** 9
+        pairs = np.unique(pairs, axis=0)
+        lists[key] = (pairs[:, 0], pairs[:, 1])
+    return lists
+
+
+def churn(rng, lists, fraction=0.1):
+    changed = {}
+    for key, (owners, others) in lists.items():
+        keep = rng.random(len(owners)) > fraction
+        new = random_lists(rng, num_pairs=int(len(owners) * fraction))[key]
+        kept = np.stack((owners[keep], others[keep]), axis=1)
+        pairs = np.unique(np.concatenate((kept, np.stack(new, axis=1))), axis=0)
+        changed[key] = (pairs[:, 0], pairs[:, 1])
+    return changed
+
+
+def assert_same(found, expected):
+    for key in COUNT_KEYS:
+        assert found[key][0].tolist() == expected[key][0].tolist()
+        assert found[key][1].tolist() == expected[key][1].tolist()
+
+
+def test_lists_round_trip_as_gaps():
+    owners, others = random_lists(np.random.default_rng(0))["friends"]
+    users, counts, data = encode_lists(owners, others)
+    assert counts.sum() == len(owners)
+    assert len(data) < 8 * len(owners)
+    decoded = decode_lists(users, counts, data)
+    assert decoded[0].tolist() == owners.tolist()
+    assert decoded[1].tolist() == others.tolist()
+
+
+@pytest.mark.parametrize("keyframe_every", [0, 3])
+def test_every_snapshot_is_rebuilt_from_its_diffs(tmp_path, keyframe_every):
+    rng = np.random.default_rng(1)
+    fname_base = str(tmp_path / "snapshots")
+    store = SnapshotStore(fname_base, keyframe_every=keyframe_every)
+    versions = [random_lists(rng)]
+    for _ in range(6):
+        versions.append(churn(rng, versions[-1]))
+    for i, lists in enumerate(versions):
+        assert store.take(lists, taken=1000 + i) == i + 1
+
+    fulls = [seq for seq, full, _ in store.snapshots() if full]
+    assert fulls == ([1, 4, 7] if keyframe_every else [1])
+    # fresh stores, so nothing comes from the cache of the last one
+    for seq in (7, 1, 5, 2):
+        assert_same(SnapshotStore(fname_base).lists(seq), versions[seq - 1])
+    assert SnapshotStore(fname_base).seq_at(1003.5) == 4
+    assert SnapshotStore(fname_base).seq_at(999) is None
+
+
+def test_diffs_between_snapshots(tmp_path):
+    rng = np.random.default_rng(2)
+    store = SnapshotStore(str(tmp_path / "snapshots"))
+    versions = [random_lists(rng)]
+    versions.append(churn(rng, versions[0]))
+    versions.append(churn(rng, versions[1]))
+    for lists in versions:
+        store.take(lists)
+    # unchanged lists take no new snapshot
+    assert store.take(versions[-1]) == 3
+
+    for start, end in ((1, 2), (1, 3)):
+        diff = SnapshotStore(str(tmp_path / "snapshots")).diff(start, end)
+        for key in COUNT_KEYS:
+            expected = diff_pairs(versions[start - 1][key], versions[end - 1][key])
+            for found, pairs in zip(diff[key], expected):
+                assert found[0].tolist() == pairs[0].tolist()
+                assert found[1].tolist() == pairs[1].tolist()
+
+
+def test_adjacency_lists_are_sorted_and_deduplicated(tmp_path):
+    users = {"5": {"friends": [9, 2, 9]}, "1": {"followers": [5], "friends": [3]}}
+    adjacency = AdjacencyStore.from_user_dict(users, str(tmp_path / "adjacency"))
+    adjacency.save()
+    lists = adjacency_lists(adjacency)
+    owners, others = lists["friends"]
+    assert list(zip(owners.tolist(), others.tolist())) == [(1, 3), (5, 2), (5, 9)]
+    assert [ids.tolist() for ids in lists["followers"]] == [[1], [5]]
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+import tiles
+from tiles import TileIndex, morton_codes
+
+BOUNDS = ((0.0, 1.0), (0.0, 1.0))
+
+
+def random_index(num_nodes=500, num_edges=2000, max_zoom=6, seed=0):
+    rng = np.random.default_rng(seed)
+    positions = rng.random((num_nodes, 2))
+    edges = rng.integers(0, num_nodes, size=(num_edges, 2))
+    return positions, edges, TileIndex(positions, edges, BOUNDS, max_zoom=max_zoom)
+
+
+def test_morton_codes_interleave_x_and_y():
+    codes = morton_codes(np.array([0, 1, 0, 1, 3, 4]), np.array([0, 0, 1, 1, 3, 0]))
+    assert codes.tolist() == [0, 1, 2, 3, 15, 16]
+
+
+@pytest.mark.parametrize("zoom", [0, 1, 3, 6])
+def test_tiles_partition_the_nodes(zoom):
+    positions, _, index = random_index()
+    side = 2 ** zoom
+    seen = []
+    for tile_x in range(side):
+        for tile_y in range(side):
+            start, stop = index.tile_range(zoom, tile_x, tile_y)
+            xy = positions[index.order[start:stop]]
+            assert (np.floor(xy * side) == [tile_x, tile_y]).all()
+            seen.extend(index.order[start:stop].tolist())
+    assert sorted(seen) == list(range(len(positions)))
+
+
+def test_detailed_tile_has_its_nodes_and_out_edges(monkeypatch):
+    monkeypatch.setattr(tiles, "TILE_NODE_LIMIT", 1000)
+    positions, edges, index = random_index()
+    tile = index.tile(1, 1, 0)
+    inside = (positions[:, 0] >= 0.5) & (positions[:, 1] < 0.5)
+    assert tile["detail"]
+    assert sorted(tile["rows"].tolist()) == np.flatnonzero(inside).tolist()
+    assert len(tile["x0"]) == inside[edges[:, 0]].sum()
+    assert set(tile["x0"].tolist()) <= set(positions[inside, 0].tolist())
+
+
+def test_crowded_tile_is_aggregated_and_bounded(monkeypatch):
+    monkeypatch.setattr(tiles, "TILE_NODE_LIMIT", 10)
+    monkeypatch.setattr(tiles, "TILE_EDGE_LIMIT", 50)
+    positions, edges, index = random_index()
+    tile = index.tile(0, 0, 0)
+    assert not tile["detail"]
+    assert tile["counts"].sum() == len(positions)
+    assert len(tile["x"]) <= 4 ** tiles.TILE_AGG_BITS
+    assert len(tile["weights"]) == 50
+    # the heaviest bundles are the ones kept
+    assert (np.diff(tile["weights"]) <= 0).all()
+
+    monkeypatch.setattr(tiles, "TILE_NODE_LIMIT", 1000)
+    tile = index.tile(0, 0, 0)
+    assert tile["detail"] and len(tile["weights"]) == 50
@@ -0,0 +1,62 @@
+from tweet_store import TweetStore, normalize
+
+ALICE = {"id_str": "1", "screen_name": "alice", "followers": [2]}
+BOB = {"id_str": "2", "screen_name": "bob"}
+USER_DICT = {"1": ALICE, "2": BOB}
+
+ORIGINAL = {"id_str": "100", "text": "hello", "user": ALICE, "lang": "en"}
+RETWEET = {
+    "id_str": "101",
+    "text": "RT @alice: hello",
+    "entities": {"urls": []},
+    "user": BOB,
+    "retweeted_status": ORIGINAL,
+}
+QUOTE = {"id_str": "102", "text": "look", "user": BOB, "quoted_status": ORIGINAL}
+
+
+def test_embedded_statuses_are_stored_once():
+    records = normalize(RETWEET)
+    assert [tweet_id for tweet_id, _, _ in records] == ["100", "101"]
+    retweet = records[-1][1]
+    assert retweet == {"id_str": "101", "user_id": "2", "retweeted_ref": "100"}
+    assert records[-1][2] is BOB
+
+    store = TweetStore()
+    assert [tweet_id for tweet_id, _, _ in store.add(RETWEET)] == ["100", "101"]
+    assert [tweet_id for tweet_id, _, _ in store.add(QUOTE)] == ["102"]
+    assert store.add(ORIGINAL) == []
+    assert len(store) == 3
+    assert store.by_user == {"1": ["100"], "2": ["101", "102"]}
+
+
+def test_raw_rebuilds_the_statuses():
+    store = TweetStore()
+    store.add(RETWEET)
+    store.add(QUOTE)
+    alice = {"id_str": "1", "screen_name": "alice"}
+    original = dict(ORIGINAL, user=alice)
+    assert store.raw("100", USER_DICT) == original
+    assert store.raw("101", USER_DICT) == {
+        "id_str": "101",
+        "text": "RT @alice: hello",
+        "user": BOB,
+        "retweeted_status": original,
+    }
+    assert store.raw("102", USER_DICT) == dict(QUOTE, quoted_status=original)
+    tweets = store.user_tweets("2", USER_DICT)
+    assert [tweet["id_str"] for tweet in tweets] == ["101", "102"]
+
+
+def test_stores_without_tweets_still_skip_seen_ones():
+    store = TweetStore(keep=False, seen=["100"])
+    assert "100" in store
+    assert [tweet_id for tweet_id, _, _ in store.add(RETWEET)] == ["101"]
+    assert store.tweets == {}
+    assert len(store) == 2
+
+    # reloaded from the normalized tweets
+    kept = TweetStore()
+    kept.add(RETWEET)
+    reloaded = TweetStore(kept.tweets)
+    assert reloaded.raw("101", USER_DICT) == kept.raw("101", USER_DICT)
@@ -0,0 +1,158 @@
+"""
+Level-of-detail tiles over the cached graph layout.
+
+Positions are snapped to a 2**TILE_MAX_ZOOM square grid over the plot
+bounds and nodes are sorted by the Morton (z-order) code of their cell,
+which makes the index a linear quadtree: the nodes of tile (zoom, x, y)
+are one contiguous run of the sorted order, as are the nodes of every
+cell at every coarser level.  Edges are sorted the same way by source,
+so a tile's out-edges are contiguous too.
+
+A tile with at most TILE_NODE_LIMIT nodes (or at TILE_MAX_ZOOM) comes
+back in full detail.  Otherwise its nodes are aggregated into the
+cells TILE_AGG_BITS levels further down, drawn at their centroid, and
+edges are bundled into weighted cell-to-cell edges.  Past
+TILE_EDGE_LIMIT edges, a detailed tile keeps an even spread of them and
+an aggregated one the heaviest bundles, so a tile has a bounded size
+however large the graph is.
+"""
+import numpy as np
+
+from global_vars import (TILE_AGG_BITS, TILE_EDGE_LIMIT, TILE_MAX_ZOOM,
+                         TILE_NODE_LIMIT)
+
+
+def _spread_bits(values):
+    """
+    Put the low 16 bits of each value in the even bit positions.
+    """
+    values = values.astype(np.uint64) & np.uint64(0xFFFF)
+    masks = ((8, 0x00FF00FF), (4, 0x0F0F0F0F), (2, 0x33333333), (1, 0x55555555))
+    for shift, mask in masks:
+        values = (values | (values << np.uint64(shift))) & np.uint64(mask)
+    return values
+
+
+def morton_codes(cell_x, cell_y):
+    return _spread_bits(cell_x) | (_spread_bits(cell_y) << np.uint64(1))
+
+
+class TileIndex:
+    """
+    Spatial index over `positions` (an (n, 2) array, one row per node)
+    with `edges` given as an (m, 2) array of row positions.  `bounds` is
+    the (min_x, max_x), (min_y, max_y) square the tiles divide up.
+    """
+
+    def __init__(self, positions, edges, bounds, max_zoom=TILE_MAX_ZOOM):
+        (min_x, max_x), (min_y, max_y) = bounds
+        self.bounds = bounds
+        self.max_zoom = max_zoom
+        side = 2 ** max_zoom
+        span = max(max_x - min_x, max_y - min_y, 1e-9)
+        origin = np.array([min_x, min_y])
+        cells = np.floor((positions - origin) / span * side).astype(np.int64)
+        cells = np.clip(cells, 0, side - 1)
+        codes = morton_codes(cells[:, 0], cells[:, 1])
+
+        self.order = np.argsort(codes, kind="stable")
+        self.codes = codes[self.order]
+        self.positions = positions[self.order]
+        rank = np.empty(len(self.order), dtype=np.int64)
+        rank[self.order] = np.arange(len(self.order))
+
+        edges = rank[np.asarray(edges, dtype=np.int64).reshape(-1, 2)]
+        self.edges = edges[np.argsort(edges[:, 0], kind="stable")]
+        self.edge_offsets = np.searchsorted(
+            self.edges[:, 0], np.arange(len(self.order) + 1)
+        )
+        self.levels = {}
+
+    def __len__(self):
+        return len(self.order)
+
+    def level(self, level):
+        """
+        Every sorted node's cell at `level`, and each cell's centroid and
+        node count, computed on first use.
+        """
+        if level not in self.levels:
+            shift = np.uint64(2 * (self.max_zoom - level))
+            _, cell_of, counts = np.unique(
+                self.codes >> shift, return_inverse=True, return_counts=True
+            )
+            centroids = np.stack(
+                [np.bincount(cell_of, self.positions[:, i]) / counts for i in (0, 1)],
+                axis=1,
+            )
+            self.levels[level] = (cell_of.astype(np.int32), centroids, counts)
+        return self.levels[level]
+
+    def tile_range(self, zoom, tile_x, tile_y):
+        """
+        The run [start, stop) of sorted nodes inside tile (zoom, x, y).
+        """
+        shift = np.uint64(2 * (self.max_zoom - zoom))
+        prefix = morton_codes(np.array([tile_x]), np.array([tile_y]))[0]
+        low = prefix << shift
+        high = (prefix + np.uint64(1)) << shift
+        start, stop = np.searchsorted(self.codes, [low, high])
+        return int(start), int(stop)
+
+    def tile(self, zoom, tile_x, tile_y):
+        """
+        The nodes and out-edges of a tile.  Nodes are (node rows, x, y,
+        counts) and edges (x0, y0, x1, y1, weights); in full detail the
+        node rows index the original positions and every count and
+        weight is 1, otherwise node rows are None and each node is an
+        aggregated cell.
+        """
+        zoom = min(max(zoom, 0), self.max_zoom)
+        start, stop = self.tile_range(zoom, tile_x, tile_y)
+        edges = self.edges[self.edge_offsets[start] : self.edge_offsets[stop]]
+        detail = stop - start <= TILE_NODE_LIMIT or zoom == self.max_zoom
+
+        if detail:
+            if len(edges) > TILE_EDGE_LIMIT:
+                step = len(edges) / TILE_EDGE_LIMIT
+                edges = edges[(np.arange(TILE_EDGE_LIMIT) * step).astype(np.int64)]
+            xy = self.positions[start:stop]
+            ends = self.positions[edges]
+            return {
+                "detail": True,
+                "rows": self.order[start:stop],
+                "x": xy[:, 0],
+                "y": xy[:, 1],
+                "counts": np.ones(stop - start, dtype=np.int64),
+                "x0": ends[:, 0, 0],
+                "y0": ends[:, 0, 1],
+                "x1": ends[:, 1, 0],
+                "y1": ends[:, 1, 1],
+                "weights": np.ones(len(edges), dtype=np.int64),
+            }
+
+        level = min(zoom + TILE_AGG_BITS, self.max_zoom)
+        cell_of, centroids, counts = self.level(level)
+        cells = np.arange(cell_of[start], cell_of[stop - 1] + 1)
+        pairs = cell_of[edges].astype(np.int64)
+        pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+        num_cells = len(counts)
+        keys, weights = np.unique(
+            pairs[:, 0] * num_cells + pairs[:, 1], return_counts=True
+        )
+        if len(keys) > TILE_EDGE_LIMIT:
+            heaviest = np.argsort(-weights, kind="stable")[:TILE_EDGE_LIMIT]
+            keys, weights = keys[heaviest], weights[heaviest]
+        bundles = np.stack((keys // num_cells, keys % num_cells), axis=1)
+        return {
+            "detail": False,
+            "rows": None,
+            "x": centroids[cells, 0],
+            "y": centroids[cells, 1],
+            "counts": counts[cells],
+            "x0": centroids[bundles[:, 0], 0],
+            "y0": centroids[bundles[:, 0], 1],
+            "x1": centroids[bundles[:, 1], 0],
+            "y1": centroids[bundles[:, 1], 1],
+            "weights": weights,
+        }
@@ -0,0 +1,120 @@
+"""
+Normalized tweet storage.
+
+Raw statuses embed their author's full user object and, for retweets
+and quotes, the whole original status with a second user object.  Here
+every status is stored once, keyed by id: authors are replaced by their
+id (their snapshots belong in the user dictionary), retweeted and quoted
+statuses by a reference to their own entry, and retweets drop the text
+and entities they copy from the original.  Strings that repeat across
+tweets are interned.  raw() rebuilds raw-like JSON on demand.
+"""
+import sys
+
+from adjacency import COUNT_KEYS
+
+REFERENCES = {"retweeted_status": "retweeted_ref", "quoted_status": "quoted_ref"}
+INTERN_KEYS = ("user_id", "lang", "source", "filter_level", "in_reply_to_user_id_str")
+RETWEET_COPIED = ("text", "full_text", "entities", "extended_entities", "truncated")
+
+
+def _retweet_text(original_text, screen_name):
+    return f"RT @{screen_name}: {original_text}"
+
+
+def _intern(tweet):
+    for key in INTERN_KEYS:
+        if isinstance(tweet.get(key), str):
+            tweet[key] = sys.intern(tweet[key])
+    return tweet
+
+
+def normalize(tweet_json):
+    """
+    Split a raw status into (tweet id, normalized tweet, user json)
+    triples: one for every status it embeds, then one for itself.
+    """
+    tweet = dict(tweet_json)
+    user_json = tweet.pop("user")
+    tweet["user_id"] = user_json["id_str"]
+    records = []
+    for key, ref in REFERENCES.items():
+        embedded = tweet.pop(key, None)
+        if embedded is None:
+            continue
+        records.extend(normalize(embedded))
+        tweet[ref] = embedded["id_str"]
+        if key == "retweeted_status":
+            text = _retweet_text(embedded["text"], embedded["user"]["screen_name"])
+            if tweet.get("text") == text:
+                for copied in RETWEET_COPIED:
+                    tweet.pop(copied, None)
+    records.append((tweet["id_str"], _intern(tweet), user_json))
+    return records
+
+
+class TweetStore:
+    """
+    Normalized tweets by id, and each user's tweet ids in the order they
+    were added.  With keep=False, only the ids seen are remembered, for
+    writers that persist tweets to a log without holding them; `seen`
+    gives the ids of tweets stored before, to be treated as duplicates.
+    """
+
+    def __init__(self, tweets=None, keep=True, seen=()):
+        self.keep = keep
+        self.tweets = {}
+        self.by_user = {}
+        self.seen = set(seen)
+        for tweet_id, tweet in (tweets or {}).items():
+            self._add(tweet_id, _intern(tweet))
+
+    def __len__(self):
+        return len(self.seen)
+
+    def __contains__(self, tweet_id):
+        return tweet_id in self.seen
+
+    def _add(self, tweet_id, tweet):
+        self.seen.add(tweet_id)
+        if self.keep:
+            self.tweets[tweet_id] = tweet
+            self.by_user.setdefault(tweet["user_id"], []).append(tweet_id)
+
+    def add(self, tweet_json):
+        """
+        Add a raw status and everything it embeds.  Returns the
+        (tweet id, normalized tweet, user json) triples that were new.
+        """
+        added = []
+        for tweet_id, tweet, user_json in normalize(tweet_json):
+            if tweet_id not in self.seen:
+                self._add(tweet_id, tweet)
+                added.append((tweet_id, tweet, user_json))
+        return added
+
+    def raw(self, tweet_id, user_dict):
+        """
+        Raw-like JSON for a stored tweet, with its author taken from
+        `user_dict` (without the friends/followers lists) and any
+        retweeted or quoted status expanded in place.
+        """
+        tweet = dict(self.tweets[tweet_id])
+        user_id = tweet.pop("user_id")
+        user_json = user_dict.get(user_id, {"id_str": user_id})
+        tweet["user"] = {
+            key: value for key, value in user_json.items() if key not in COUNT_KEYS
+        }
+        for key, ref in REFERENCES.items():
+            ref_id = tweet.pop(ref, None)
+            if ref_id is not None and ref_id in self.tweets:
+                tweet[key] = self.raw(ref_id, user_dict)
+        original = tweet.get("retweeted_status")
+        if original is not None and "text" not in tweet:
+            screen_name = original["user"].get("screen_name", "")
+            tweet["text"] = _retweet_text(original["text"], screen_name)
+        return tweet
+
+    def user_tweets(self, user_id, user_dict):
+        tweet_ids = self.by_user.get(user_id, [])
+        return [self.raw(tweet_id, user_dict) for tweet_id in tweet_ids]
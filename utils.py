@@ -1,6 +1,9 @@
 import gzip
+import os
 import random
 import sys
+import time
+from functools import wraps
 from secrets import (TWITTER_APP_KEY, TWITTER_APP_SECRET, TWITTER_KEY,
                      TWITTER_SECRET)
 
@@ -8,80 +11,328 @@ import dill
 import tweepy
 import ujson
 
-from global_vars import USER_DICT_FNAME, USER_LIST_FNAME
+from adjacency import COUNT_KEYS, AdjacencyStore
+from columnar import ColumnStore, columns_dirname, has_columns, write_columns
+from follow_batches import follow_batches
+from global_vars import (ADJACENCY_FNAME, COLUMNAR_FNAMES, TWEET_ROLLUP_FNAME,
+                         TWEET_SEEN_WINDOW, TWEET_STORE_FNAME, TWEETS_FNAME,
+                         USER_DICT_FNAME, USER_LIST_FNAME)
+from instrument import FILE_WRITE_BYTES, FILE_WRITE_SECONDS
+from out_of_core import _id_array, build_adjacency
+from segment_log import SegmentLog, has_log, replay_log
+from tweet_store import TweetStore
 
 
-def authenticate_twitter():
+def authenticate_twitter(wait_on_rate_limit=True):
     auth = tweepy.OAuthHandler(TWITTER_APP_KEY, TWITTER_APP_SECRET)
     auth.set_access_token(TWITTER_KEY, TWITTER_SECRET)
-    api = tweepy.API(auth, wait_on_rate_limit=True, wait_on_rate_limit_notify=True)
+    api = tweepy.API(
+        auth,
+        wait_on_rate_limit=wait_on_rate_limit,
+        wait_on_rate_limit_notify=wait_on_rate_limit,
+    )
     return api
 
 
-def reload_object(fname_base, default_obj):
+def reload_columns(fname_base, columns=None):
+    """
+    The dict stored as columns under `fname_base`, or None if there is no
+    column store.  Only `columns` are read when given.
+    """
+    if fname_base not in COLUMNAR_FNAMES or not has_columns(fname_base):
+        return None
+    return ColumnStore(fname_base).to_dict(columns)
+
+
+def reload_object(fname_base, default_obj, columns=None):
     fname = fname_base + ".pkl.gz"
-    result = None
+    result = reload_columns(fname_base, columns)
+    if result is not None:
+        return replay_log(result, fname_base)
     try:
         with gzip.open(fname, "rb") as pickle_file:
             result = dill.load(pickle_file)
     except FileNotFoundError:
         print(f"Existing db not found at {fname}, reinitializing...")
         result = default_obj()
-    return result
+    return replay_log(result, fname_base)
 
 
-def reload_json(fname_base, default_obj, transform=None):
+def reload_json(fname_base, default_obj, transform=None, columns=None):
     fname = fname_base + ".json.gz"
     if transform is None:
         transform = lambda x: x
-    result = None
+    result = reload_columns(fname_base, columns)
+    if result is not None:
+        return transform(replay_log(result, fname_base))
     try:
         with gzip.open(fname, "rt") as json_file:
-            result = transform(ujson.load(json_file))
+            result = transform(replay_log(ujson.load(json_file), fname_base))
     except FileNotFoundError:
         sys.stderr.write(f"Existing object not found at {fname}, reinitializing")
-        result = default_obj()
+        result = replay_log(default_obj(), fname_base)
     return result
 
 
+def disk_bytes(path):
+    """
+    Size of a file, or of every file in a directory.
+    """
+    try:
+        if os.path.isdir(path):
+            return sum(entry.stat().st_size for entry in os.scandir(path))
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def instrumented_write(extension):
+    """
+    Time a function writing an object to `fname_base` + `extension` (or
+    its column store), and count the bytes it wrote.
+    """
+
+    def decorator(write):
+        @wraps(write)
+        def instrumented(obj, fname_base, *args, **kwargs):
+            with FILE_WRITE_SECONDS.time(file=fname_base):
+                written = write(obj, fname_base, *args, **kwargs)
+            if written:
+                if fname_base in COLUMNAR_FNAMES:
+                    path = columns_dirname(fname_base)
+                else:
+                    path = fname_base + extension
+                FILE_WRITE_BYTES.inc(disk_bytes(path), file=fname_base)
+            return written
+
+        return instrumented
+
+    return decorator
+
+
+@instrumented_write(".json.gz")
 def json_it(jsonable, fname_base, transform=None):
+    """
+    Write `jsonable` as `fname_base`'s snapshot.  If it has a log, the
+    object must have it applied, as reload_json() returns it; the log is
+    folded into the snapshot.
+    """
     fname = fname_base + ".json.gz"
     if transform is None:
         transform = lambda x: x
-    print(f"Dumping object as json to {fname}")
     json = transform(jsonable)
-    try:
-        with gzip.open(fname, "wt") as json_file:
-            ujson.dump(json, json_file)
-    except FileNotFoundError:
-        sys.stederr.write(f"ERROR: {fname} is not writeable!\n")
-        return False
-    return True
+    if fname_base in COLUMNAR_FNAMES:
+        return SegmentLog(fname_base).fold(
+            lambda mark: write_columns(json, fname_base, mark)
+        )
+
+    def write(mark):
+        print(f"Dumping object as json to {fname}")
+        try:
+            with gzip.open(fname + ".tmp", "wt") as json_file:
+                ujson.dump(json, json_file)
+            if mark is not None:
+                mark(fname + ".tmp", fname)
+            os.replace(fname + ".tmp", fname)
+        except OSError:
+            sys.stderr.write(f"ERROR: {fname} is not writeable!\n")
+            return False
+        return True
 
+    return SegmentLog(fname_base).fold(write)
 
+
+@instrumented_write(".pkl.gz")
 def pickle_it(picklable, fname_base):
+    """
+    Pickle `picklable` as `fname_base`'s snapshot, folding in its log
+    like json_it().
+    """
     fname = fname_base + ".pkl.gz"
-    print(f"Pickling object to {fname}")
+    if fname_base in COLUMNAR_FNAMES:
+        return SegmentLog(fname_base).fold(
+            lambda mark: write_columns(picklable, fname_base, mark)
+        )
+
+    def write(mark):
+        print(f"Pickling object to {fname}")
+        try:
+            with gzip.open(fname + ".tmp", "wb") as pickle_file:
+                dill.dump(picklable, pickle_file)
+            if mark is not None:
+                mark(fname + ".tmp", fname)
+            os.replace(fname + ".tmp", fname)
+        except OSError:
+            sys.stderr.write(f"ERROR: {fname} is not writeable!\n")
+            return False
+        return True
+
+    return SegmentLog(fname_base).fold(write)
+
+
+def fold_log(fname_base, min_bytes=0):
+    """
+    Rewrite `fname_base`'s snapshot with its log applied and drop the
+    log, if the log takes up at least `min_bytes`, so that it doesn't
+    grow, and get replayed, without bound.
+    """
+    log = SegmentLog(fname_base)
+    segments = log.segments()
+    if not segments or sum(disk_bytes(path) for _, path in segments) < min_bytes:
+        return True
+    if has_columns(fname_base) or not os.path.isfile(fname_base + ".json.gz"):
+        return pickle_it(reload_object(fname_base, dict), fname_base)
+    return json_it(reload_json(fname_base, dict), fname_base)
+
+
+def load_adjacency(mmap=True, memory_budget=None):
+    """
+    Load the friends/followers adjacency store, building it from the
+    user dictionary the first time it is needed; out of core, within
+    `memory_budget` bytes, if that is given.
+    """
+    adjacency = AdjacencyStore.load(ADJACENCY_FNAME, mmap=mmap)
+    if not adjacency and memory_budget is not None:
+        adjacency = build_adjacency(budget=memory_budget) or adjacency
+    if not adjacency and has_columns(USER_DICT_FNAME) and not has_log(USER_DICT_FNAME):
+        # only the id list columns need to be read
+        store = ColumnStore(USER_DICT_FNAME)
+        columns = [key for key in COUNT_KEYS if key in store.columns]
+        for user_ids, chunk in store.iter_chunks(columns):
+            for key, lists in chunk.items():
+                for user_id, others in zip(user_ids, lists):
+                    others = _id_array(others)
+                    if len(others):
+                        adjacency.add(user_id, key, others)
+        adjacency.save()
+    if not adjacency:
+        user_dict = reload_json(USER_DICT_FNAME, dict)
+        adjacency = AdjacencyStore.from_user_dict(user_dict, ADJACENCY_FNAME)
+        del user_dict
+        adjacency.save()
+    return adjacency
+
+
+def drop_neighbor_lists(user_dict):
+    """
+    Strip the friends/followers lists out of a user dictionary, for
+    readers that get them from the adjacency store instead.
+    """
+    for info in user_dict.values():
+        for key in COUNT_KEYS:
+            info.pop(key, None)
+    return user_dict
+
+
+def reload_users():
+    """
+    The user dictionary without its friends/followers lists; only the
+    other columns are read from a column store.
+    """
+    columns = None
+    if has_columns(USER_DICT_FNAME):
+        columns = ColumnStore(USER_DICT_FNAME).columns
+        columns = [name for name in columns if name not in COUNT_KEYS]
+    return drop_neighbor_lists(reload_object(USER_DICT_FNAME, dict, columns=columns))
+
+
+def rollup_tweet(rollups, user_id, tweet_json):
+    """
+    Fold a raw tweet into its author's rollup: tweet count, first and
+    latest tweet text, and when they were last seen.
+    """
     try:
-        with gzip.open(fname, "wb") as pickle_file:
-            dill.dump(picklable, pickle_file)
-    except FileNotFoundError:
-        sys.stderr.write(f"ERROR: {fname} is not writeable!\n")
-        return False
-    return True
+        seen = int(tweet_json["timestamp_ms"]) / 1000
+    except (KeyError, ValueError):
+        seen = time.time()
+    rollup = rollups.get(user_id)
+    if rollup is None:
+        rollup = {"count": 0, "first_text": tweet_json["text"], "first_seen": seen}
+        rollups[user_id] = rollup
+    rollup["count"] += 1
+    rollup["latest_text"] = tweet_json["text"]
+    rollup["last_seen"] = seen
+    return rollup
+
+
+def new_user(user_json):
+    """
+    A user dictionary entry for a user seen in a tweet.  It has no
+    friends/followers lists; those are added to the adjacency store when
+    the user is expanded.
+    """
+    user_json = dict(user_json)
+    for key in COUNT_KEYS:
+        user_json.pop(key, None)
+    return user_json
+
+
+def load_tweet_store(keep=True):
+    """
+    Load the normalized tweet store.  The first time, it is built from
+    the old tweet dictionary of raw tweets by user, and any embedded
+    users missing from the user dictionary are added to it through its
+    log.
+    """
+    tweets = reload_object(TWEET_STORE_FNAME, dict)
+    if tweets:
+        return TweetStore(tweets, keep)
+    tweet_dict = reload_object(TWEETS_FNAME, dict)
+    if not tweet_dict:
+        return TweetStore(keep=keep)
+
+    print(f"Normalizing {len(tweet_dict)} users' tweets into {TWEET_STORE_FNAME}")
+    user_dict = reload_users()
+    user_log = SegmentLog(USER_DICT_FNAME)
+    store = TweetStore()
+    for user_tweets in tweet_dict.values():
+        for tweet_json in user_tweets:
+            for _, _, user_json in store.add(tweet_json):
+                if user_json["id_str"] not in user_dict:
+                    user_dict[user_json["id_str"]] = new_user(user_json)
+                    user_log.set(user_json["id_str"], user_dict[user_json["id_str"]])
+    del tweet_dict, user_dict
+    pickle_it(store.tweets, TWEET_STORE_FNAME)
+    user_log.flush()
+    if not keep:
+        return TweetStore(store.tweets, keep)
+    return store
+
+
+def recent_tweet_ids(limit=TWEET_SEEN_WINDOW):
+    """
+    Ids of the tweets most recently added to the tweet store's log, for
+    recognizing redelivered tweets without loading the store.
+    """
+    return SegmentLog(TWEET_STORE_FNAME).recent_keys(limit)
+
+
+def load_tweet_rollups():
+    """
+    Load the per-user tweet rollups, building them from the tweet store
+    the first time they are needed.
+    """
+    rollups = reload_json(TWEET_ROLLUP_FNAME, dict)
+    if not rollups:
+        store = load_tweet_store()
+        user_dict = reload_object(USER_DICT_FNAME, dict, columns=["screen_name"])
+        for user_id, tweet_ids in store.by_user.items():
+            for tweet_id in tweet_ids:
+                rollup_tweet(rollups, user_id, store.raw(tweet_id, user_dict))
+        del store
+        json_it(rollups, TWEET_ROLLUP_FNAME)
+    return rollups
 
 
-def compile_users_n_others(reset=False):
+def compile_users_n_others(reset=False, by_community=False):
+    """
+    The follow-filter batches to stream: every seed user and everyone
+    they list, deduplicated and packed into FOLLOW_LIMIT-sized batches
+    (see follow_batches.py), keyed by batch name.
+    """
     if not reset:
         return reload_object(USER_LIST_FNAME, set)
-    users = {}
-    user_dict = reload_object(USER_DICT_FNAME, dict)
-    for user in user_dict:
-        this_user_set = set()
-        for follower in user_dict[user]["followers"]:
-            this_user_set.add(str(follower))
-        for friend in user_dict[user]["friends"]:
-            this_user_set.add(str(friend))
-        users[user] = this_user_set
+    adjacency = load_adjacency()
+    users = follow_batches(adjacency, adjacency.seed_ids(), by_community=by_community)
     pickle_it(users, USER_LIST_FNAME)
     return users